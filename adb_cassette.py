@@ -0,0 +1,309 @@
+import argparse
+import atexit
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from adb_client import AdbClient, AdbError, CommandResult, CommandTimeout
+from command_executor import redact
+from log_buffer import get_logger
+
+log = get_logger("cassette")
+
+BACKENDS = ("live", "record", "replay")
+DEFAULT_CASSETTE = "cassettes/{script}.jsonl.gz"
+
+
+def _encode(data: bytes) -> Tuple[str, Optional[str]]:
+    """Store output as text when it is text (almost always), else base64"""
+    try:
+        return data.decode("utf-8"), None
+    except UnicodeDecodeError:
+        return base64.b64encode(data).decode("ascii"), "b64"
+
+
+def _decode(entry: Dict) -> bytes:
+    if entry.get("enc") == "b64":
+        return base64.b64decode(entry["out"])
+    return entry["out"].encode("utf-8")
+
+
+def _fill(buffer: bytearray, output: bytes) -> int:
+    """exec_out_into on top of exec_out, for clients that only see whole outputs"""
+    buffer[:min(len(output), len(buffer))] = output[:len(buffer)]
+    return len(output)
+
+
+def _recorded_error(entry: Dict) -> AdbError:
+    error_type = CommandTimeout if entry.get("error_type") == "CommandTimeout" else AdbError
+    return error_type(entry["error"])
+
+
+class Cassette:
+    """Every device and host command of a run, its output, exit code and duration
+
+    Stored as gzip-compressed JSON lines, one command per line, in the
+    order the commands finished. Typed text (the PIN) is masked, so
+    cassettes can be shared; a command that failed keeps its error.
+    """
+
+    def __init__(self, path: str, entries: Optional[List[Dict]] = None):
+        self.path = path
+        self.entries: List[Dict] = entries or []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "Cassette":
+        import gzip
+
+        opener = gzip.open if path.endswith(".gz") else open
+        try:
+            with opener(path, "rt", encoding="utf-8") as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+        except OSError as e:
+            raise AdbError(f"Cannot read cassette {path}: {e}")
+        return cls(path, entries)
+
+    def save(self) -> None:
+        import gzip
+
+        with self._lock:
+            entries = list(self.entries)
+        if not entries:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        opener = gzip.open if self.path.endswith(".gz") else open
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with opener(tmp_path, "wt", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, self.path)
+        log.info(f"Recorded {len(entries)} adb commands to {self.path}")
+
+    def add(self, kind: str, serial: Optional[str], command: str, output: bytes,
+            returncode: Optional[int], duration: float, **extra) -> None:
+        out, encoding = _encode(output)
+        entry = {"kind": kind, "serial": serial, "command": redact(command), "out": out,
+                 "rc": returncode, "ms": round(duration * 1000, 2)}
+        if encoding:
+            entry["enc"] = encoding
+        entry.update(extra)
+        with self._lock:
+            self.entries.append(entry)
+
+
+_cassettes: Dict[str, Cassette] = {}
+_cassettes_lock = threading.Lock()
+
+
+def cassette_path(config) -> str:
+    """[ADB] cassette, with {script} replaced by the running script's name"""
+    script = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python"
+    return config.get("ADB", "cassette", fallback=DEFAULT_CASSETTE).format(script=script)
+
+
+def _shared_cassette(path: str, replay: bool) -> Cassette:
+    """One cassette per path and process, shared by the clients of every device"""
+    with _cassettes_lock:
+        cassette = _cassettes.get(path)
+        if cassette is None:
+            if replay:
+                cassette = Cassette.load(path)
+            else:
+                cassette = Cassette(path)
+                atexit.register(cassette.save)
+            _cassettes[path] = cassette
+    return cassette
+
+
+class RecordingAdbClient(AdbClient):
+    """A live client that also writes every command it runs to a cassette
+
+    A recorded run is not quite a live one: it uses no shell sessions and
+    no event stream (both read raw sockets that replay could not answer).
+    Batched commands go out one by one, each on its own connection, and
+    waits poll instead of following logcat, so timings in the cassette are
+    those of a run without sessions (as with [ADB] backend = replay).
+    """
+
+    # Shell sessions and event streams read raw sockets; run commands one by one so each is recorded
+    supports_sessions = False
+
+    def __init__(self, cassette: Cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def _failed(self, kind: str, serial: Optional[str], command: str, start: float, error: AdbError,
+                output: bytes = b"", **extra) -> None:
+        """Record a command that raised, so replay raises the same error"""
+        self.cassette.add(kind, serial, command, output, None, time.monotonic() - start,
+                          error=str(error), error_type=type(error).__name__, **extra)
+
+    def host_command(self, service: str, has_payload: bool = True) -> str:
+        start = time.monotonic()
+        try:
+            reply = super().host_command(service, has_payload)
+        except AdbError as e:
+            self._failed("host", None, service, start, e)
+            raise
+        self.cassette.add("host", None, service, reply.encode("utf-8"), 0, time.monotonic() - start)
+        return reply
+
+    def shell(self, command: str, timeout: Optional[float] = None) -> CommandResult:
+        start = time.monotonic()
+        try:
+            result = super().shell(command, timeout)
+        except AdbError as e:
+            self._failed("shell", self.serial, command, start, e)
+            raise
+        self.cassette.add("shell", self.serial, command, result.stdout, result.returncode, time.monotonic() - start)
+        return result
+
+    def exec_out(self, command: str, timeout: Optional[float] = None) -> bytes:
+        start = time.monotonic()
+        try:
+            output = super().exec_out(command, timeout)
+        except AdbError as e:
+            self._failed("exec", self.serial, command, start, e)
+            raise
+        self.cassette.add("exec", self.serial, command, output, 0, time.monotonic() - start)
+        return output
+
+    def exec_out_into(self, command: str, buffer: bytearray, timeout: Optional[float] = None) -> int:
+        return _fill(buffer, self.exec_out(command, timeout))
+
+    def stream_lines(self, command: str) -> Iterator[str]:
+        start = time.monotonic()
+        lines: List[str] = []
+        error: Optional[AdbError] = None
+        try:
+            for line in super().stream_lines(command):
+                lines.append(line)
+                yield line
+        except AdbError as e:
+            error = e
+            raise
+        finally:
+            # Only what the caller read: replay hands back the same lines
+            output = "\n".join(lines).encode("utf-8")
+            if error is not None:
+                self._failed("stream", self.serial, command, start, error, output, lines=len(lines))
+            else:
+                self.cassette.add("stream", self.serial, command, output, 0, time.monotonic() - start,
+                                  lines=len(lines))
+
+
+class ReplayAdbClient(AdbClient):
+    """Answers from a cassette instead of a device, at the recorded speed or at once
+
+    Commands are matched by kind, serial and command text; repeats of a
+    command get the recorded answers in order, and the last one again once
+    they run out (polling loops may poll a different number of times). A
+    command that was never recorded raises AdbError, and one that failed
+    while recording raises its recorded error again.
+    """
+
+    supports_sessions = False
+
+    def __init__(self, cassette: Cassette, speed: str = "recorded", **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+        self.speed = speed
+        self._queues: Dict[Tuple[str, Optional[str], str], Deque[Dict]] = {}
+        self._last: Dict[Tuple[str, Optional[str], str], Dict] = {}
+        self._lock = threading.Lock()
+        for entry in cassette.entries:
+            serial = None if entry["kind"] == "host" else entry.get("serial")
+            self._queues.setdefault((entry["kind"], serial, entry["command"]), deque()).append(entry)
+
+    def _answer(self, kind: str, command: str) -> Dict:
+        """The next recorded entry for command; raises its error if it failed (not for streams)"""
+        command = redact(command)
+        key = (kind, None if kind == "host" else self.serial, command)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue:
+                entry = self._last[key] = queue.popleft()
+            elif key in self._last:
+                entry = self._last[key]
+            else:
+                raise AdbError(f"{kind} command not in cassette {self.cassette.path}: {command}")
+        if self.speed == "recorded":
+            time.sleep(entry.get("ms", 0) / 1000)
+        log.debug("replay %s %s -> %s", kind, command, entry.get("rc"))
+        if "error" in entry and kind != "stream":
+            raise _recorded_error(entry)
+        return entry
+
+    def host_command(self, service: str, has_payload: bool = True) -> str:
+        return _decode(self._answer("host", service)).decode("utf-8", errors="ignore")
+
+    def shell(self, command: str, timeout: Optional[float] = None) -> CommandResult:
+        entry = self._answer("shell", command)
+        return CommandResult(command, _decode(entry), entry.get("rc"))
+
+    def exec_out(self, command: str, timeout: Optional[float] = None) -> bytes:
+        return _decode(self._answer("exec", command))
+
+    def exec_out_into(self, command: str, buffer: bytearray, timeout: Optional[float] = None) -> int:
+        return _fill(buffer, self.exec_out(command, timeout))
+
+    def stream_lines(self, command: str) -> Iterator[str]:
+        entry = self._answer("stream", command)
+        if entry.get("lines"):
+            yield from _decode(entry).decode("utf-8", errors="ignore").split("\n")
+        if "error" in entry:
+            # Failed after the lines that were read
+            raise _recorded_error(entry)
+
+    def open_service(self, service: str):
+        raise AdbError(f"Raw device services cannot be replayed: {service}")
+
+    def start_server(self) -> None:
+        pass
+
+
+def client_from_config(config, serial: Optional[str], backend: str, **kwargs) -> AdbClient:
+    """The client for [ADB] backend = record or replay (live clients are plain AdbClient)"""
+    path = cassette_path(config)
+    if backend == "record":
+        return RecordingAdbClient(_shared_cassette(path, replay=False), serial=serial, **kwargs)
+    if backend == "replay":
+        speed = config.get("ADB", "replay_speed", fallback="recorded")
+        return ReplayAdbClient(_shared_cassette(path, replay=True), speed=speed, serial=serial, **kwargs)
+    raise ValueError(f"Unknown [ADB] backend {backend!r}, use one of: {', '.join(BACKENDS)}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Summarise recorded adb cassettes")
+    parser.add_argument("cassettes", nargs="+")
+    parser.add_argument("--commands", action="store_true", help="List every command")
+    args = parser.parse_args(argv)
+
+    for path in args.cassettes:
+        try:
+            cassette = Cassette.load(path)
+        except AdbError as e:
+            print(e)
+            return 1
+        total_ms = sum(entry.get("ms", 0) for entry in cassette.entries)
+        output = sum(len(entry.get("out", "")) for entry in cassette.entries)
+        serials = sorted({entry["serial"] for entry in cassette.entries if entry.get("serial")})
+        print(f"{path}: {len(cassette.entries)} commands, {total_ms / 1000:.2f}s recorded, "
+              f"{output} bytes of output, devices: {', '.join(serials) or '-'}")
+        if args.commands:
+            for entry in cassette.entries:
+                status = entry.get("error_type") or f"rc={entry.get('rc')}"
+                print(f"  {entry['ms']:>9.1f} ms  {entry['kind']:<6} {status}  {entry['command'][:100]}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,339 @@
+import copy
+import logging
+import socket
+import time
+from typing import Iterator, List, Optional, Tuple
+
+# CommandResult is re-exported: callers have always imported it from here
+from command_executor import EXECUTOR, CommandResult, redact
+from log_buffer import get_logger
+from tracing import span
+
+
+# Marker appended to every shell command so the exit status survives the
+# legacy (pre shell-v2) shell protocol, which only streams output.
+EXIT_MARKER = b"__MAA_RC__"
+
+
+log = get_logger("adb")
+
+# Bytes of command output kept per record in the in-memory log
+OUTPUT_PREVIEW = 160
+
+
+class AdbError(Exception):
+    """Raised when the adb server rejects a request or the connection fails"""
+
+
+class CommandTimeout(AdbError):
+    """Raised when a device command runs past its deadline"""
+
+
+class AdbClient:
+    """Talks to the adb server over its TCP wire protocol instead of spawning adb"""
+
+    # Whether ShellSession may pipeline commands over one raw shell service
+    supports_sessions = True
+
+    def __init__(self, serial: Optional[str] = None, host: str = "127.0.0.1",
+                 port: int = 5037, adb_path: str = "adb", timeout: float = 10.0, retry=None,
+                 deadline: float = 30.0):
+        self.serial = serial
+        self.host = host
+        self.port = port
+        self.adb_path = adb_path
+        # timeout bounds each network wait, deadline a whole shell/exec command
+        self.timeout = timeout
+        self.deadline = deadline
+        # retry_policy.RetryPolicy for opening device services; None tries once
+        self.retry = retry
+        # adb serial actually used to reach the device when it differs from
+        # serial (USB, a rediscovered Wi-Fi port); serial stays its identity
+        self.transport: Optional[str] = None
+        self._server_checked = False
+
+    @classmethod
+    def from_config(cls, config, serial: Optional[str] = None) -> "AdbClient":
+        """Build a client from the [ADB] section of a ConfigParser
+
+        [ADB] backend = record or replay returns a cassette client instead
+        (see adb_cassette.py).
+        """
+        # retry_policy needs AdbError from this module
+        from retry_policy import RetryPolicy
+
+        settings = dict(
+            host=config.get("ADB", "server_host", fallback="127.0.0.1"),
+            port=config.getint("ADB", "server_port", fallback=5037),
+            adb_path=config.get("ADB", "adb_path", fallback="adb"),
+            timeout=config.getfloat("ADB", "command_timeout", fallback=10.0),
+            retry=RetryPolicy.from_config(config, "shell"),
+            deadline=config.getfloat("ADB", "command_deadline", fallback=30.0),
+        )
+        backend = config.get("ADB", "backend", fallback="live").strip().lower()
+        if backend != "live" and cls is AdbClient:
+            import adb_cassette
+
+            return adb_cassette.client_from_config(config, serial, backend, **settings)
+        return cls(serial=serial, **settings)
+
+    # ------------------------------------------------------------------
+    # Wire protocol helpers
+    # ------------------------------------------------------------------
+    def _connect(self) -> socket.socket:
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            if self._server_checked:
+                raise AdbError(f"Cannot reach adb server at {self.host}:{self.port}: {e}")
+            # Server not running yet: start it once, like the adb client does
+            log.warning("adb server not running, starting it...")
+            self.start_server()
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError as e2:
+                raise AdbError(f"Cannot reach adb server at {self.host}:{self.port}: {e2}")
+        self._server_checked = True
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    @staticmethod
+    def _recv_exact(sock: socket.socket, size: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = sock.recv(size - len(buf))
+            if not chunk:
+                raise AdbError("Connection closed by adb server")
+            buf += chunk
+        return bytes(buf)
+
+    @staticmethod
+    def _recv_all(sock: socket.socket, deadline: float, command: str) -> bytes:
+        """Read until the device closes the stream, or raise CommandTimeout at deadline"""
+        chunks = []
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout()
+                # Keeps the socket's own (shorter) timeout when it has one
+                current = sock.gettimeout()
+                sock.settimeout(remaining if current is None else min(current, remaining))
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except socket.timeout:
+            raise CommandTimeout(f"{redact(command)!r} did not finish in time, "
+                                 f"{sum(map(len, chunks))} bytes received")
+        return b"".join(chunks)
+
+    def _send_request(self, sock: socket.socket, request: str) -> None:
+        payload = request.encode("utf-8")
+        sock.sendall(b"%04x" % len(payload) + payload)
+        status = self._recv_exact(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            raise AdbError(self._read_length_prefixed(sock).decode("utf-8", errors="ignore"))
+        raise AdbError(f"Unexpected adb server response: {status!r}")
+
+    def _read_length_prefixed(self, sock: socket.socket) -> bytes:
+        length = int(self._recv_exact(sock, 4), 16)
+        return self._recv_exact(sock, length)
+
+    def open_service(self, service: str) -> socket.socket:
+        """Switch to the device transport and open a device service
+
+        A failure here happens before the device ran anything, so even
+        commands with side effects can safely be retried (per self.retry).
+        """
+        if self.retry is None:
+            return self._open_service(service)
+        return self.retry.call(lambda: self._open_service(service),
+                               description=f"Opening {service.split(':', 1)[0]} on {self.serial or 'device'}")
+
+    def _open_service(self, service: str) -> socket.socket:
+        sock = self._connect()
+        try:
+            target = self.transport or self.serial
+            if target:
+                self._send_request(sock, f"host:transport:{target}")
+            else:
+                self._send_request(sock, "host:transport-any")
+            self._send_request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    # ------------------------------------------------------------------
+    # Host services
+    # ------------------------------------------------------------------
+    def host_command(self, service: str, has_payload: bool = True) -> str:
+        """Run a host:* service and return its (length-prefixed) reply"""
+        with span("adb.host", "command", command=service) as step, self._connect() as sock:
+            self._send_request(sock, service)
+            if not has_payload:
+                return ""
+            reply = self._read_length_prefixed(sock)
+            step.set(bytes=len(reply))
+            log.debug("%s: %r", service, reply[:OUTPUT_PREVIEW])
+            return reply.decode("utf-8", errors="ignore")
+
+    def start_server(self) -> None:
+        """Start the adb server; this is the only step that needs the adb binary"""
+        try:
+            # Not captured: adb prints its "daemon started" lines to the console, and the
+            # daemon it leaves behind would hold a captured pipe open until the deadline
+            result = EXECUTOR.run([self.adb_path, "start-server"], capture=False)
+        except OSError as e:
+            raise AdbError(f"Failed to start adb server: {e}")
+        if result.timed_out:
+            raise AdbError(f"adb start-server did not finish within {EXECUTOR.timeout:.0f}s")
+        if not result.ok:
+            raise AdbError(f"Failed to start adb server (exit {result.returncode}), see the adb output above")
+        self._server_checked = True
+
+    def kill_server(self) -> None:
+        try:
+            self.host_command("host:kill", has_payload=False)
+        except AdbError:
+            pass
+        self._server_checked = False
+
+    def version(self) -> int:
+        return int(self.host_command("host:version"), 16)
+
+    def devices(self) -> List[Tuple[str, str]]:
+        """Return (serial, state) pairs, like `adb devices`"""
+        output = self.host_command("host:devices")
+        devices = []
+        for line in output.splitlines():
+            parts = line.split("\t")
+            if len(parts) >= 2:
+                devices.append((parts[0], parts[1].strip()))
+        return devices
+
+    def connect(self, address: str) -> str:
+        return self.host_command(f"host:connect:{address}")
+
+    def disconnect(self, address: str) -> str:
+        return self.host_command(f"host:disconnect:{address}")
+
+    def mdns_services(self) -> List[Tuple[str, str, str]]:
+        """Return (instance, service type, address) pairs, like `adb mdns services`"""
+        services = []
+        for line in self.host_command("host:mdns:services").splitlines():
+            parts = line.split("\t")
+            if len(parts) >= 3:
+                services.append((parts[0].strip(), parts[1].strip(), parts[2].strip()))
+        return services
+
+    def on_transport(self, transport: str) -> "AdbClient":
+        """A copy of this client that sends its device services over transport"""
+        client = copy.copy(self)
+        client.transport = transport if transport != self.serial else None
+        return client
+
+    # ------------------------------------------------------------------
+    # Device services
+    # ------------------------------------------------------------------
+    def shell(self, command: str, timeout: Optional[float] = None) -> CommandResult:
+        """Run a shell command on the device and return its output and exit code
+
+        Raises CommandTimeout if it takes longer than timeout (default: deadline).
+        """
+        service = f"shell:{command}; echo {EXIT_MARKER.decode()}$?"
+        with span("adb.shell", "command", serial=self.serial, command=redact(command)) as step:
+            start = time.monotonic()
+            deadline = start + (self.deadline if timeout is None else timeout)
+            with self.open_service(service) as sock:
+                raw = self._recv_all(sock, deadline, command)
+            result = self._split_exit_status(command, raw)
+            step.set(exit_code=result.returncode, bytes=len(result.stdout))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("shell %s -> %s in %.0f ms: %r", redact(command), result.returncode,
+                      (time.monotonic() - start) * 1000, result.stdout[:OUTPUT_PREVIEW])
+        return result
+
+    def exec_out(self, command: str, timeout: Optional[float] = None) -> bytes:
+        """Run a command through exec: (no pty, binary safe) and return raw stdout"""
+        with span("adb.exec", "command", serial=self.serial, command=redact(command)) as step:
+            start = time.monotonic()
+            deadline = start + (self.deadline if timeout is None else timeout)
+            with self.open_service(f"exec:{command}") as sock:
+                output = self._recv_all(sock, deadline, command)
+            step.set(bytes=len(output))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("exec %s -> %d bytes in %.0f ms: %r", redact(command), len(output),
+                      (time.monotonic() - start) * 1000, output[:OUTPUT_PREVIEW])
+        return output
+
+    def exec_out_into(self, command: str, buffer: bytearray, timeout: Optional[float] = None) -> int:
+        """Like exec_out, but receive straight into buffer, which can be reused between calls
+
+        Returns the length of the output. When that exceeds len(buffer)
+        the rest was read and dropped; the caller can grow the buffer and
+        try again.
+        """
+        with span("adb.exec", "command", serial=self.serial, command=redact(command)) as step:
+            deadline = time.monotonic() + (self.deadline if timeout is None else timeout)
+            view = memoryview(buffer)
+            received = 0
+            with self.open_service(f"exec:{command}") as sock:
+                try:
+                    while True:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise socket.timeout()
+                        current = sock.gettimeout()
+                        sock.settimeout(remaining if current is None else min(current, remaining))
+                        if received < len(view):
+                            count = sock.recv_into(view[received:])
+                        else:
+                            count = len(sock.recv(65536))
+                        if not count:
+                            break
+                        received += count
+                except socket.timeout:
+                    raise CommandTimeout(f"{redact(command)!r} did not finish in time, {received} bytes received")
+            step.set(bytes=received)
+        return received
+
+    def stream_lines(self, command: str) -> Iterator[str]:
+        """Yield the output of command line by line as it arrives
+
+        Closing the generator early closes the connection, which stops the
+        command on the device, so callers can bail out at the first line
+        they care about without transferring the rest.
+        """
+        with span("adb.stream", "command", serial=self.serial, command=redact(command)) as step:
+            received = 0
+            sock = self.open_service(f"exec:{command}")
+            try:
+                with sock.makefile("rb") as stream:
+                    for line in stream:
+                        received += len(line)
+                        yield line.decode("utf-8", errors="ignore").rstrip("\r\n")
+            except socket.timeout:
+                raise CommandTimeout(f"{redact(command)!r} sent nothing for {self.timeout:.0f}s")
+            finally:
+                sock.close()
+                # Bytes read before the caller stopped, not the full dump
+                step.set(bytes=received)
+
+    @staticmethod
+    def _split_exit_status(command: str, raw: bytes) -> CommandResult:
+        # Old adbd runs commands in a pty, which turns \n into \r\n; skip the copy otherwise
+        if b"\r" in raw:
+            raw = raw.replace(b"\r\n", b"\n")
+        index = raw.rfind(EXIT_MARKER)
+        if index == -1:
+            return CommandResult(command, raw, None)
+        status = raw[index + len(EXIT_MARKER):].strip()
+        try:
+            returncode = int(status)
+        except ValueError:
+            returncode = None
+        return CommandResult(command, raw[:index], returncode)
@@ -0,0 +1,176 @@
+import time
+from typing import Dict, Optional
+
+from adb_client import AdbClient, AdbError
+from discovery import TransportSelector
+from log_buffer import get_logger
+from retry_policy import CircuitBreaker, RetryPolicy
+from state_store import StateStore
+from tracing import traced
+
+log = get_logger("connection")
+
+
+class AdbConnectionManager:
+    """Keeps the Wi-Fi ADB connection up without restarting the shared adb server
+
+    The cheapest check that can succeed wins: an already connected device
+    costs two localhost round-trips. Reconnecting the device comes next and
+    restarting the server (which drops every other tool's sessions, MAA
+    included) is only done when nothing else worked. Reconnects follow the
+    "connect" retry policy, and a device that keeps failing is skipped
+    outright by its circuit breaker until it has had time to come back.
+
+    With a transport selector the device is not tied to device_ip: USB or
+    the port wireless debugging moved to after a reboot work as well, and
+    adb is pointed at whichever transport the selector picked.
+    """
+
+    def __init__(self, adb: AdbClient, device_ip: str,
+                 connect_timeout: float = 5.0, allow_server_restart: bool = True,
+                 retry: Optional[RetryPolicy] = None, breaker: Optional[CircuitBreaker] = None,
+                 selector: Optional[TransportSelector] = None):
+        self.adb = adb
+        self.device_ip = device_ip
+        self.connect_timeout = connect_timeout
+        self.allow_server_restart = allow_server_restart
+        self.retry = retry or RetryPolicy.once("connect")
+        self.breaker = breaker
+        self.selector = selector
+
+    @classmethod
+    def from_config(cls, config, adb: AdbClient, device_ip: Optional[str] = None,
+                    serial_number: str = "") -> "AdbConnectionManager":
+        device_ip = device_ip or config["ADB"]["device_ip"]
+        store = StateStore.from_config(config)
+        return cls(
+            adb,
+            device_ip,
+            connect_timeout=config.getfloat("ADB", "connect_timeout", fallback=5.0),
+            allow_server_restart=config.getboolean("ADB", "allow_server_restart", fallback=True),
+            retry=RetryPolicy.from_config(config, "connect"),
+            breaker=CircuitBreaker.from_config(config, device_ip, store),
+            selector=TransportSelector.from_config(config, adb, device_ip, serial_number, store),
+        )
+
+    def server_alive(self) -> bool:
+        """Return True if the adb server answers host:version"""
+        try:
+            self.adb.version()
+            return True
+        except AdbError:
+            return False
+
+    def device_state(self, address: Optional[str] = None) -> Optional[str]:
+        """Return the state adb reports for address (device_ip), or None if it is not listed"""
+        address = address or self.device_ip
+        for serial, state in self.adb.devices():
+            if serial == address:
+                return state
+        return None
+
+    def _wait_for_state(self, address: str) -> Optional[str]:
+        """Poll the device list until address settles or connect_timeout expires"""
+        deadline = time.monotonic() + self.connect_timeout
+        delay = 0.05
+        state = self.device_state(address)
+        while state != "device" and time.monotonic() < deadline:
+            if state == "unauthorized":
+                # Only the user can fix this, no point in waiting
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            state = self.device_state(address)
+        return state
+
+    def _connect(self, address: Optional[str] = None) -> Optional[str]:
+        address = address or self.device_ip
+        result = self.adb.connect(address).strip()
+        log.info(f"Connect result: {result}")
+        if "connected to" not in result:
+            # "failed to connect" / "cannot connect": no transport is coming, don't wait for one
+            return self.device_state(address)
+        state = self._wait_for_state(address)
+        if state == "device":
+            self._use(address, "tcp")
+        return state
+
+    def _connect_any(self) -> Optional[str]:
+        """Connect to the first address that works: device_ip, then the last good and advertised ones"""
+        if self.selector is None:
+            return self._connect()
+        state = None
+        for address in self.selector.addresses():
+            if address != self.device_ip:
+                log.info(f"Trying {address} for {self.device_ip}...")
+            state = self._connect(address)
+            if state in ("device", "unauthorized"):
+                return state
+        return state
+
+    def _reconnect(self) -> Optional[str]:
+        return self.retry.call(self._connect_any, retry_if=lambda state: state not in ("device", "unauthorized"),
+                               description=f"Connecting to {self.device_ip}")
+
+    def _use(self, serial: str, kind: Optional[str] = None) -> None:
+        """Send the device's commands over serial from now on; with kind, also for the next runs"""
+        if serial != self.device_ip:
+            log.info(f"Using {serial} for {self.device_ip}")
+        self.adb.transport = serial if serial != self.adb.serial else None
+        if self.selector is not None and kind is not None:
+            self.selector.remember(serial, kind)
+
+    @traced("adb.ensure_device")
+    def ensure_device(self) -> Optional[str]:
+        """Make sure device_ip is connected and return its final adb state
+
+        Returns "device" on success, "unauthorized" when the debugging prompt
+        has not been accepted and None/other states when the device could not
+        be reached. Raises CircuitOpenError without touching the device while
+        its circuit breaker is open.
+        """
+        if self.breaker is None:
+            return self._ensure_device()
+        self.breaker.check()
+        state = self._ensure_device()
+        if state in ("device", "unauthorized"):
+            # Unauthorized is reachable; only the user can fix that one
+            self.breaker.record_success()
+        elif self.breaker.record_failure():
+            log.warning(f"Device {self.device_ip} failed {self.breaker.failure_threshold} times in a row, "
+                        f"failing fast for the next {self.breaker.open_seconds:.0f}s")
+        return state
+
+    def _ensure_device(self) -> Optional[str]:
+        # Fast path: server up and the device already connected
+        if self.server_alive():
+            listed: Dict[str, str] = dict(self.adb.devices())
+            if self.selector is not None:
+                transport = self.selector.pick(listed)
+                if transport is not None:
+                    log.info(f"Device {self.device_ip} already connected")
+                    self._use(transport)
+                    return "device"
+            state = listed.get(self.device_ip)
+            if state == "device":
+                log.info(f"Device {self.device_ip} already connected")
+                self.adb.transport = None
+                return state
+            if state == "offline":
+                # Stale transport, usually after the phone changed networks
+                log.warning(f"Device {self.device_ip} is offline, reconnecting...")
+                self.adb.disconnect(self.device_ip)
+        else:
+            log.warning("adb server not responding, starting it...")
+            self.adb.start_server()
+
+        log.info(f"Trying to connect via IP: {self.device_ip}...")
+        state = self._reconnect()
+        if state in ("device", "unauthorized") or not self.allow_server_restart:
+            return state
+
+        # Last resort: restart the server and try once more
+        log.warning("Reconnect failed, restarting adb server...")
+        self.adb.kill_server()
+        self.adb.start_server()
+        return self._connect_any()
@@ -0,0 +1,62 @@
+import configparser
+import os
+import threading
+from typing import Dict, List
+
+
+class FrozenConfig(configparser.ConfigParser):
+    """ConfigParser that refuses changes once loaded, so one parse can be shared
+
+    Every reader (flows, ResolutionManager, notifier, daemon) gets the same
+    object; making it read-only means none of them can surprise the others.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._frozen = False
+        super().__init__(*args, **kwargs)
+        self.files: List[str] = []
+
+    def freeze(self) -> "FrozenConfig":
+        self._frozen = True
+        return self
+
+    def _check_writable(self) -> None:
+        if self._frozen:
+            raise TypeError("config is read-only once loaded; it is shared by every component")
+
+    def set(self, section, option, value=None):
+        self._check_writable()
+        super().set(section, option, value)
+
+    def add_section(self, section):
+        self._check_writable()
+        super().add_section(section)
+
+    def remove_section(self, section):
+        self._check_writable()
+        return super().remove_section(section)
+
+    def remove_option(self, section, option):
+        self._check_writable()
+        return super().remove_option(section, option)
+
+    def _read(self, fp, fpname):
+        # read(), read_file() and read_string() all end up here
+        self._check_writable()
+        super()._read(fp, fpname)
+
+
+_loaded: Dict[str, FrozenConfig] = {}
+_lock = threading.Lock()
+
+
+def load_config(path: str = "config.ini") -> FrozenConfig:
+    """Parse path once per process and return the shared, read-only result"""
+    key = os.path.abspath(path)
+    with _lock:
+        config = _loaded.get(key)
+        if config is None:
+            config = FrozenConfig()
+            config.files = config.read(path, encoding="utf-8")
+            _loaded[key] = config.freeze()
+    return config
@@ -0,0 +1,117 @@
+import re
+from typing import Optional
+
+from adb_client import AdbClient
+from log_buffer import get_logger
+from state_store import DEFAULT_SERIAL, StateStore
+from tracing import traced
+
+log = get_logger("launcher")
+
+
+_VERSION_CODE = re.compile(r"\bversionCode=(\d+)")
+_COMPONENT = re.compile(r"^\S+/\S+$")
+_LAUNCH_TIME = re.compile(r"^(TotalTime|WaitTime):\s*(\d+)", re.MULTILINE)
+
+
+class LaunchResult:
+    """How an app launch went, with am start -W timings when available"""
+
+    def __init__(self, ok: bool, method: str, output: str = "",
+                 total_time_ms: Optional[int] = None, wait_time_ms: Optional[int] = None):
+        self.ok = ok
+        self.method = method
+        self.output = output
+        self.total_time_ms = total_time_ms
+        self.wait_time_ms = wait_time_ms
+
+
+class AppLauncher:
+    """Launches an app through its real launcher activity, resolved once and cached
+
+    The resolved component is kept in the state store per device, keyed by
+    package and versionCode, so later runs skip resolution entirely until
+    the app is updated.
+    """
+
+    def __init__(self, adb: AdbClient, store: StateStore):
+        self.adb = adb
+        self.store = store
+
+    @property
+    def serial(self) -> str:
+        return self.adb.serial or DEFAULT_SERIAL
+
+    @traced("launch.version_code")
+    def version_code(self, package: str) -> Optional[str]:
+        """Return the installed versionCode, or None if the package is not installed"""
+        in_package = False
+        lines = self.adb.stream_lines(f"dumpsys package {package}")
+        try:
+            for line in lines:
+                if not in_package:
+                    # Only trust versionCode lines inside this package's own block
+                    in_package = f"Package [{package}]" in line
+                    continue
+                match = _VERSION_CODE.search(line)
+                if match:
+                    return match.group(1)
+        finally:
+            lines.close()
+        return None
+
+    def resolve_activity(self, package: str) -> Optional[str]:
+        """Ask the package manager for the launcher activity (Android 7+)"""
+        result = self.adb.shell(
+            f"cmd package resolve-activity --brief -c android.intent.category.LAUNCHER {package}"
+        )
+        if not result.ok:
+            return None
+        lines = result.text.strip().splitlines()
+        if lines and _COMPONENT.match(lines[-1].strip()):
+            return lines[-1].strip()
+        return None
+
+    @traced("launch.resolve")
+    def launcher_activity(self, package: str, version_code: str) -> Optional[str]:
+        """Return the cached component for this version, resolving it on a miss"""
+        cache = self.store.get(self.serial).get("launcher_activities", {})
+        entry = cache.get(package)
+        if entry and entry.get("version_code") == version_code:
+            return entry.get("component")
+
+        component = self.resolve_activity(package)
+        if component:
+            log.info(f"Resolved launcher activity: {component}")
+            with self.store.transaction() as data:
+                record = data.setdefault(self.serial, {})
+                record.setdefault("launcher_activities", {})[package] = {
+                    "version_code": version_code,
+                    "component": component,
+                }
+        return component
+
+    def forget(self, package: str) -> None:
+        """Drop a cached component, e.g. after it failed to start"""
+        with self.store.transaction() as data:
+            data.get(self.serial, {}).get("launcher_activities", {}).pop(package, None)
+
+    @traced("launch.start")
+    def start(self, component: str) -> LaunchResult:
+        result = self.adb.shell(f"am start -W -n {component}")
+        output = result.text
+        # am start exits 0 even when the activity does not exist
+        ok = result.ok and "Error" not in output and "Status: ok" in output
+        times = dict(_LAUNCH_TIME.findall(output))
+        return LaunchResult(
+            ok, "am start", output,
+            total_time_ms=int(times["TotalTime"]) if "TotalTime" in times else None,
+            wait_time_ms=int(times["WaitTime"]) if "WaitTime" in times else None,
+        )
+
+    @traced("launch.monkey")
+    def start_with_monkey(self, package: str) -> LaunchResult:
+        result = self.adb.shell(f"monkey -p {package} -c android.intent.category.LAUNCHER 1")
+        output = result.text
+        ok = result.ok and "No activities found" not in output
+        return LaunchResult(ok, "monkey", output)
@@ -0,0 +1,419 @@
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from fake_adb_server import FakeAdbServer, FakeDevice
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(REPO_DIR, "benchmarks", "baseline.json")
+
+# (per-request Wi-Fi hop, extra device time by command prefix) in seconds.
+# "wifi" is a rough model of a mid-range phone on a home network.
+LATENCY_PROFILES: Dict[str, Tuple[float, Dict[str, float]]] = {
+    "none": (0.0, {}),
+    "wifi": (0.015, {
+        "getprop": 0.005,
+        "dumpsys power": 0.03,
+        "dumpsys window": 0.12,
+        "dumpsys activity": 0.08,
+        "dumpsys package": 0.08,
+        "cmd package": 0.15,
+        "wm size ": 0.25,
+        "input": 0.05,
+        "am start": 0.6,
+        "monkey": 0.5,
+    }),
+}
+
+UNLOCK_RESOLUTION = "720x1280"
+
+# Drives ResolutionManager the way the two flows do, in one process
+RESOLUTION_SCRIPT = f"""
+from resolution_manager import ResolutionManager
+manager = ResolutionManager()
+assert manager.save_original_resolution()
+assert manager.set_resolution("{UNLOCK_RESOLUTION}")
+assert manager.restore_original_resolution()
+"""
+
+SCENARIOS = {
+    "unlock": ["unlock_phone_new_with_config.py"],
+    "lock": ["lock_phone_and_recovery_resolution_with_config.py"],
+    "resolution": ["-c", RESOLUTION_SCRIPT],
+    # Hook calls answered by a resident daemon.py started once per benchmark
+    "daemon-unlock": ["daemon.py", "unlock", "--no-fallback"],
+    "daemon-lock": ["daemon.py", "lock", "--no-fallback"],
+    "prewarm": ["prewarm.py", "--once"],
+    # The unlock hook right after prewarm.py readied the device
+    "prewarmed-unlock": ["unlock_phone_new_with_config.py"],
+}
+
+# Must not be imported until first used: they only matter on failure or in
+# rarely taken paths, and every scheduled run pays for what is imported
+LAZY_MODULES = ("smtplib", "ssl", "email.mime.text", "subprocess", "asyncio", "dataclasses", "http.client")
+
+# Milliseconds importing both flows may take (checked by test_imports.py too)
+IMPORT_BUDGET_MS = 150.0
+
+# Imports both flows (which also loads config.ini) and reports what it cost
+IMPORT_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import unlock_phone_new_with_config, lock_phone_and_recovery_resolution_with_config
+elapsed = time.perf_counter() - start
+print(json.dumps({{"import_ms": elapsed * 1000, "eager": [m for m in {LAZY_MODULES!r} if m in sys.modules]}}))
+"""
+
+# Unmeasured run that leaves the device where a scenario starts from
+SETUP = {
+    "lock": "unlock",
+    "daemon-lock": "daemon-unlock",
+    "daemon-unlock": "daemon-lock",
+    "prewarmed-unlock": "prewarm",
+}
+
+# Records every call of the adb executable, which only happens to start the server
+ADB_STANDIN = """import sys
+with open({log!r}, "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+"""
+
+_SENTINEL = re.compile(r"; echo __MAA_RC__\$\?$")
+_WAIT = re.compile(r"^\(i=0; while ! \((.*)\); do .*done\)$")
+
+
+def step_label(request: str) -> str:
+    """Short, stable name for a request on the server timeline"""
+    service, _, command = request.partition(":")
+    if service not in ("shell", "exec", "session"):
+        return request
+    command = _SENTINEL.sub("", command)
+    wait = _WAIT.match(command)
+    if wait:
+        command = f"wait {wait.group(1)}"
+    return f"{service}: {command}"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_config(workdir: str, server: FakeAdbServer, device_ip: str, adb_path: str) -> None:
+    with open(os.path.join(workdir, "config.ini"), "w", encoding="utf-8") as f:
+        f.write(f"""[ADB]
+device_ip = {device_ip}
+lock_password = 1234
+server_host = {server.host}
+server_port = {server.port}
+adb_path = {adb_path}
+command_timeout = 10
+
+[Email]
+smtp_server = 127.0.0.1
+smtp_port = 9
+sender = bench@example.com
+receiver = bench@example.com
+password =
+smtp_security = plain
+smtp_timeout = 1
+coalesce_window = 0
+
+[App]
+package_name = com.dev47apps.droidcam
+app_name = DroidCam
+
+[Resolution]
+unlock_resolution = {UNLOCK_RESOLUTION}
+lock_resolution = 1080x2400
+save_original_resolution = true
+
+[Daemon]
+port = {free_port()}
+""")
+
+
+def make_adb_standin(workdir: str) -> Tuple[str, str]:
+    """Write a fake adb executable; return (path, invocation log path)"""
+    log = os.path.join(workdir, "adb_calls.log")
+    script = os.path.join(workdir, "adb_standin.py")
+    with open(script, "w", encoding="utf-8") as f:
+        f.write(ADB_STANDIN.format(log=log))
+    if os.name == "nt":
+        path = os.path.join(workdir, "adb.bat")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f'@"{sys.executable}" "{script}" %*\n')
+    else:
+        path = os.path.join(workdir, "adb")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"#!{sys.executable}\n" + ADB_STANDIN.format(log=log))
+        os.chmod(path, 0o755)
+    return path, log
+
+
+def count_lines(path: str) -> int:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return sum(1 for _ in f)
+    except OSError:
+        return 0
+
+
+class Bench:
+    """One fake server + device and a scratch working directory, reused across runs"""
+
+    def __init__(self, profile: str, device: FakeDevice):
+        self.server = FakeAdbServer().start()
+        self.server.transport_latency, command_latency = LATENCY_PROFILES[profile]
+        self.server.command_latency = dict(command_latency)
+        self.device = device.install(self.server)
+        # Fresh working directory and state store, so start from a clean device too
+        self.device.lock()
+        self.device.override_size = None
+        self.device_ip = self.server.devices[0][0]
+        self.workdir = tempfile.mkdtemp(prefix="maa-bench-")
+        self.adb_path, self.adb_log = make_adb_standin(self.workdir)
+        write_config(self.workdir, self.server, self.device_ip, self.adb_path)
+        self.daemon: Optional[subprocess.Popen] = None
+
+    def close(self) -> None:
+        if self.daemon is not None:
+            self.run_script(["daemon.py", "shutdown"])
+            try:
+                self.daemon.wait(10)
+            except subprocess.TimeoutExpired:
+                self.daemon.kill()
+        self.server.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    @property
+    def env(self) -> Dict[str, str]:
+        return dict(os.environ, PYTHONPATH=REPO_DIR, PYTHONDONTWRITEBYTECODE="1")
+
+    def run_script(self, args: List[str]) -> Tuple[float, subprocess.CompletedProcess]:
+        argv = [sys.executable] + [os.path.join(REPO_DIR, a) if a.endswith(".py") else a for a in args]
+        start = time.perf_counter()
+        completed = subprocess.run(argv, cwd=self.workdir, env=self.env, capture_output=True, text=True)
+        return start, completed
+
+    def start_daemon(self) -> None:
+        if self.daemon is not None:
+            return
+        self.daemon = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "daemon.py"), "serve"],
+                                       cwd=self.workdir, env=self.env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while self.run_script(["daemon.py", "status"])[1].returncode != 0:
+            if time.monotonic() > deadline or self.daemon.poll() is not None:
+                raise RuntimeError("daemon.py did not start")
+            time.sleep(0.1)
+
+    def prepare(self, scenario: str) -> None:
+        """Put the device in the state the scenario starts from"""
+        daemon = scenario.startswith("daemon-")
+        if daemon:
+            self.start_daemon()
+        self.device.lock()
+        if not daemon:
+            # A daemon caches the display state, so only its own flows change it
+            self.device.override_size = None
+        setup = SETUP.get(scenario)
+        if setup:
+            _, completed = self.run_script(SCENARIOS[setup])
+            if not self.succeeded(setup, completed):
+                raise RuntimeError(f"setup {setup} failed:\n" + completed.stdout[-2000:])
+            self.device.lock()
+
+    def succeeded(self, scenario: str, completed: subprocess.CompletedProcess) -> bool:
+        if completed.returncode != 0:
+            return False
+        scenario = scenario.replace("daemon-", "").replace("prewarmed-", "")
+        if scenario == "unlock":
+            return not self.device.keyguard_showing
+        if scenario == "lock":
+            return self.device.foreground is not None and self.device.override_size is None
+        return self.device.override_size is None
+
+    def measure_imports(self, iterations: int) -> Dict:
+        """Median time to import both flows, and which lazy modules got imported anyway"""
+        times, eager = [], set()
+        for _ in range(iterations):
+            _, completed = self.run_script(["-c", IMPORT_SCRIPT])
+            if completed.returncode != 0:
+                raise RuntimeError("importing the flows failed:\n" + completed.stderr[-2000:])
+            report = json.loads(completed.stdout.strip().splitlines()[-1])
+            times.append(report["import_ms"])
+            eager.update(report["eager"])
+        return {"import_ms": statistics.median(times), "eager": sorted(eager)}
+
+    def measure(self, scenario: str) -> Dict:
+        self.prepare(scenario)
+        self.server.reset_stats()
+        spawns_before = count_lines(self.adb_log)
+        start, completed = self.run_script(SCENARIOS[scenario])
+        wall = time.perf_counter() - start
+        timeline = sorted(self.server.timeline)
+
+        steps: Dict[str, float] = {}
+        for step_start, step_end, request in timeline:
+            label = step_label(request)
+            steps[label] = steps.get(label, 0.0) + (step_end - step_start)
+        return {
+            "ok": self.succeeded(scenario, completed),
+            "wall_s": wall,
+            "startup_s": (timeline[0][0] - start) if timeline else wall,
+            "device_s": sum(end - begin for begin, end, _ in timeline),
+            "round_trips": len(timeline),
+            "bytes": self.server.bytes_in + self.server.bytes_out,
+            "adb_spawns": count_lines(self.adb_log) - spawns_before,
+            "steps": steps,
+            "timeline": [(begin - start, end - begin, step_label(request)) for begin, end, request in timeline],
+            "output": completed.stdout + completed.stderr,
+        }
+
+
+def summarize(runs: List[Dict]) -> Dict:
+    """Median of every metric over the measured runs"""
+    summary = {key: statistics.median(run[key] for run in runs)
+               for key in ("wall_s", "startup_s", "device_s", "round_trips", "bytes", "adb_spawns")}
+    labels: List[str] = []
+    for run in runs:
+        labels.extend(label for label in run["steps"] if label not in labels)
+    summary["steps"] = {label: statistics.median(run["steps"].get(label, 0.0) for run in runs)
+                        for label in labels}
+    summary["failures"] = sum(1 for run in runs if not run["ok"])
+    return summary
+
+
+def print_summary(scenario: str, summary: Dict, sample: Dict) -> None:
+    print(f"\n== {scenario} ==")
+    print(f"  total wall-clock   {summary['wall_s'] * 1000:8.1f} ms")
+    print(f"  startup to 1st req {summary['startup_s'] * 1000:8.1f} ms")
+    print(f"  time on device     {summary['device_s'] * 1000:8.1f} ms")
+    print(f"  round-trips        {summary['round_trips']:8.0f}")
+    print(f"  bytes transferred  {summary['bytes']:8.0f}")
+    print(f"  adb spawns         {summary['adb_spawns']:8.0f}")
+    if summary["failures"]:
+        print(f"  FAILED RUNS        {summary['failures']:8d}")
+    print("  steps (median total ms, first run order):")
+    seen = set()
+    for _, _, label in sample["timeline"]:
+        if label in seen:
+            continue
+        seen.add(label)
+        shown = label if len(label) <= 90 else label[:87] + "..."
+        print(f"    {summary['steps'][label] * 1000:8.1f}  {shown}")
+
+
+def compare(results: Dict[str, Dict], baseline: Dict, tolerance: float) -> bool:
+    """Print the change against baseline; return False on a regression beyond tolerance"""
+    ok = True
+    print(f"\nCompared with baseline (tolerance {tolerance:.0%}):")
+    for scenario, summary in results.items():
+        before = baseline.get("scenarios", {}).get(scenario)
+        if before is None:
+            print(f"  {scenario}: no baseline")
+            continue
+        for key in ("wall_s", "round_trips", "bytes", "adb_spawns"):
+            old, new = before.get(key), summary[key]
+            if old is None:
+                continue
+            change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+            regressed = change > tolerance
+            ok = ok and not regressed
+            flag = "  REGRESSION" if regressed else ""
+            print(f"  {scenario:<10} {key:<12} {old:>12.3f} -> {new:>12.3f} ({change:+.1%}){flag}")
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Time the unlock, lock and resolution flows against a simulated device")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"Any of {', '.join(sorted(SCENARIOS))} (default: all)")
+    parser.add_argument("--iterations", type=int, default=5, help="Measured runs per scenario")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured runs first (fills caches and the state store)")
+    parser.add_argument("--profile", choices=sorted(LATENCY_PROFILES), default="wifi")
+    parser.add_argument("--keyguard-style", choices=["delegate", "markers"], default="delegate")
+    parser.add_argument("--dump-padding", type=int, default=2000, help="Filler lines per dumpsys section")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="Fail if slower than the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_MS,
+                        help="Fail if importing both flows takes longer (ms)")
+    parser.add_argument("--verbose", action="store_true", help="Show the scripts' output")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+
+    device = FakeDevice(keyguard_style=args.keyguard_style, dump_padding=args.dump_padding,
+                        wake_delay=0.1, bouncer_delay=0.15, unlock_delay=0.2)
+    bench = Bench(args.profile, device)
+    try:
+        imports = bench.measure_imports(max(args.iterations, 3))
+    finally:
+        bench.close()
+    imports_ok = imports["import_ms"] <= args.import_budget and not imports["eager"]
+    print("== imports ==")
+    print(f"  import both flows  {imports['import_ms']:8.1f} ms (budget {args.import_budget:.0f} ms)")
+    if imports["eager"]:
+        print(f"  imported too early: {', '.join(imports['eager'])}")
+    if not imports_ok:
+        print("  IMPORT BUDGET EXCEEDED")
+
+    results: Dict[str, Dict] = {}
+    for scenario in args.scenarios or sorted(SCENARIOS):
+        bench = Bench(args.profile, device)
+        try:
+            for _ in range(args.warmup):
+                bench.measure(scenario)
+            runs = [bench.measure(scenario) for _ in range(args.iterations)]
+        finally:
+            bench.close()
+        for run in runs:
+            if args.verbose or not run["ok"]:
+                print(run["output"])
+        results[scenario] = summarize(runs)
+        print_summary(scenario, results[scenario], runs[0])
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "profile": args.profile,
+                "iterations": args.iterations,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "imports": imports,
+                "scenarios": results,
+            }, f, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif args.compare:
+        try:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Cannot read baseline {args.baseline}: {e}")
+            return 1
+        if not compare(results, baseline, args.tolerance):
+            return 1
+    if not imports_ok:
+        return 1
+    return 0 if all(summary["failures"] == 0 for summary in results.values()) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,101 @@
+import re
+import threading
+from typing import Optional, Sequence
+
+from tracing import span
+
+
+# The argument of `input text` is the lock screen PIN; it must not reach logs, traces or cassettes
+_INPUT_TEXT = re.compile(r"""(\binput(?:\s+[a-z]+)?\s+text\s+)(?:'[^']*'|"[^"]*"|[^\s;&|]+)""")
+
+
+def redact(command: str) -> str:
+    """command with the typed text masked, for anything that is logged or stored"""
+    return _INPUT_TEXT.sub(r"\1***", command)
+
+
+class CommandResult:
+    """Output and exit status of a single command, on the device or local
+
+    stdout is kept as the bytes that were received; text decodes them on
+    first use only. returncode is None when the status is unknown, which
+    includes commands that were killed for running past their deadline.
+    """
+
+    __slots__ = ("command", "stdout", "returncode", "timed_out", "_text")
+
+    def __init__(self, command: str, stdout: bytes, returncode: Optional[int], timed_out: bool = False):
+        self.command = command
+        self.stdout = stdout
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self._text: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.stdout.decode("utf-8", errors="ignore")
+        return self._text
+
+    def __repr__(self) -> str:
+        status = "timed out" if self.timed_out else f"returncode={self.returncode}"
+        return f"CommandResult({redact(self.command)!r}, {status}, {len(self.stdout)} bytes)"
+
+
+class CommandExecutor:
+    """Runs local child processes with a deadline and a cap on how many run at once
+
+    Every child is waited for, whether it finished, failed or was killed
+    at its deadline, so none is left behind as a zombie. Device commands do
+    not come through here: they go over the adb server socket (AdbClient),
+    which applies the same deadlines to its reads.
+    """
+
+    def __init__(self, max_children: int = 4, timeout: float = 30.0):
+        self.max_children = max(1, max_children)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_children)
+
+    def run(self, argv: Sequence[str], timeout: Optional[float] = None, input: Optional[bytes] = None,
+            capture: bool = True) -> CommandResult:
+        """Run argv and return its combined stdout/stderr as bytes
+
+        With capture=False the child writes to this process's console
+        instead and the result carries no output. Raises OSError when argv
+        cannot be started; a child still running after timeout seconds is
+        killed and reported with timed_out set.
+        """
+        # Only needed for the rare local command (starting the adb server)
+        import subprocess
+
+        timeout = self.timeout if timeout is None else timeout
+        command = " ".join(argv)
+        with self._slots, span("local.run", "command", command=command) as step:
+            process = subprocess.Popen(list(argv), stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE if capture else None,
+                                       stderr=subprocess.STDOUT if capture else None)
+            try:
+                stdout, _ = process.communicate(input, timeout=timeout)
+                stdout = stdout or b""
+                step.set(exit_code=process.returncode, bytes=len(stdout))
+                return CommandResult(command, stdout, process.returncode)
+            except subprocess.TimeoutExpired:
+                # A daemonising child (adb start-server) can leave a grandchild
+                # holding the pipe open, so don't wait for EOF after the kill
+                step.set(timed_out=True)
+                return CommandResult(command, b"", None, timed_out=True)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+                for pipe in (process.stdin, process.stdout):
+                    if pipe is not None:
+                        pipe.close()
+
+
+# Shared by every AdbClient in the process, so the cap holds across devices
+EXECUTOR = CommandExecutor()
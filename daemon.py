@@ -0,0 +1,313 @@
+import argparse
+import http.client
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, quote, urlparse
+
+from app_config import load_config
+
+
+# Only the (stdlib) modules above are imported at start-up: the same file is the
+# hook client MAA runs, which must stay cheap. The server side imports the
+# flows (and through them adb, smtplib, ...) once, when it starts.
+
+ACTIONS = ("unlock", "lock", "restore-resolution", "launch", "prewarm")
+
+# Request header carrying the shared token; browsers cannot add it to a plain cross-origin POST
+TOKEN_HEADER = "X-MAA-Token"
+
+
+class DeviceContext:
+    """Objects kept warm for one device between hook calls"""
+
+    def __init__(self, device, adb, resolution_manager, app_launcher):
+        self.device = device
+        self.adb = adb
+        self.resolution_manager = resolution_manager
+        self.app_launcher = app_launcher
+        # One action at a time per device; other devices are not blocked
+        self.lock = threading.Lock()
+        self.last_used = 0.0
+
+
+class Daemon:
+    """Runs the unlock/lock flows in one long-lived process
+
+    The parsed config, the notifier (and its SMTP session), the keyguard
+    probe choice and, per device, the adb client, display-state cache and
+    launcher cache all survive between calls, so a hook only pays for the
+    device work itself.
+    """
+
+    def __init__(self):
+        # The flow modules read config.ini when imported; reuse that parse
+        import lock_phone_and_recovery_resolution_with_config as lock_flow
+        import unlock_phone_new_with_config as unlock_flow
+        from device_config import load_devices
+
+        self.unlock_flow = unlock_flow
+        self.lock_flow = lock_flow
+        self.config = unlock_flow.config
+        self.devices = {device.name: device for device in load_devices(self.config)}
+        # Beyond this idle time the display state is read again, in case
+        # something else (MAA, the user) changed the resolution meanwhile
+        self.display_cache_ttl = self.config.getfloat("Daemon", "display_cache_ttl", fallback=60.0)
+        self.started = time.time()
+        self._contexts: Dict[str, DeviceContext] = {}
+        self._lock = threading.Lock()
+
+    def context(self, name: Optional[str]) -> DeviceContext:
+        from adb_client import AdbClient
+        from app_launcher import AppLauncher
+        from resolution_manager import ResolutionManager
+
+        if name is None:
+            if len(self.devices) != 1:
+                raise KeyError(f"several devices configured, pass one of: {', '.join(self.devices)}")
+            name = next(iter(self.devices))
+        if name not in self.devices:
+            raise KeyError(f"unknown device: {name}")
+        with self._lock:
+            context = self._contexts.get(name)
+            if context is None:
+                device = self.devices[name]
+                adb = AdbClient.from_config(self.config, serial=device.serial)
+                resolution_manager = ResolutionManager(adb=adb, device=device)
+                app_launcher = AppLauncher(adb, resolution_manager.store)
+                context = DeviceContext(device, adb, resolution_manager, app_launcher)
+                self._contexts[name] = context
+        return context
+
+    def _actions(self) -> Dict[str, Callable[[DeviceContext], bool]]:
+        return {
+            "unlock": lambda c: self.unlock_flow.unlock_phone(
+                c.device, adb=c.adb, resolution_manager=c.resolution_manager),
+            "lock": lambda c: self.lock_flow.set_resolution_and_launch_app(
+                c.device, adb=c.adb, resolution_manager=c.resolution_manager, app_launcher=c.app_launcher),
+            "restore-resolution": lambda c: c.resolution_manager.restore_original_resolution(),
+            "launch": lambda c: self.lock_flow.launch_app(c.device, c.app_launcher, c.resolution_manager.store),
+            "prewarm": lambda c: self._prewarmer(c).prewarm(),
+        }
+
+    def _prewarmer(self, context: DeviceContext):
+        from prewarm import Prewarmer
+
+        return Prewarmer(self.config, context.device, adb=context.adb,
+                         resolution_manager=context.resolution_manager, app_launcher=context.app_launcher)
+
+    def run(self, action: str, name: Optional[str] = None) -> Dict[str, Any]:
+        """Run one action on one device and describe the outcome"""
+        from device_lease import DeviceLease
+
+        if action not in ACTIONS:
+            return {"ok": False, "action": action, "error": f"unknown action, use one of: {', '.join(ACTIONS)}"}
+        try:
+            context = self.context(name)
+        except KeyError as e:
+            return {"ok": False, "action": action, "error": str(e.args[0])}
+
+        with context.lock:
+            if time.monotonic() - context.last_used > self.display_cache_ttl:
+                context.resolution_manager.invalidate_display_state()
+            start = time.monotonic()
+            try:
+                # Also keeps hooks that run without the daemon off the device meanwhile
+                lease = DeviceLease.from_config(self.config, context.device.serial, action,
+                                                store=context.resolution_manager.store)
+                ok = lease.run(lambda: self._actions()[action](context))
+                error = None
+            except Exception as e:
+                ok, error = False, f"{type(e).__name__}: {e}"
+            context.last_used = time.monotonic()
+        result = {
+            "ok": ok,
+            "action": action,
+            "device": context.device.name,
+            "duration_ms": round((context.last_used - start) * 1000, 1),
+        }
+        if error:
+            result["error"] = error
+        return result
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "ok": True,
+            "pid": os.getpid(),
+            "uptime_s": round(time.time() - self.started, 1),
+            "devices": sorted(self.devices),
+            "warm": sorted(self._contexts),
+        }
+
+
+# ----------------------------------------------------------------------
+# Server
+# ----------------------------------------------------------------------
+def serve() -> None:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import hmac
+
+    daemon = Daemon()
+    host, port = _address(daemon.config)
+    token = _token(daemon.config, create=True)
+    if host not in ("127.0.0.1", "localhost", "::1"):
+        print(f"Warning: daemon listening on {host}; anyone who can reach it can unlock the phone")
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code: int, body: Dict[str, Any]) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _refused(self, check_token: bool) -> bool:
+            """Reply 403 to requests from web pages and, for actions, to those without the token"""
+            if self.headers.get("Origin") is not None:
+                self._reply(403, {"ok": False, "error": "cross-origin requests are not accepted"})
+                return True
+            if check_token and not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ""), token):
+                self._reply(403, {"ok": False, "error": f"missing or wrong {TOKEN_HEADER} header"})
+                return True
+            return False
+
+        def do_GET(self):
+            if self._refused(check_token=False):
+                return
+            if urlparse(self.path).path == "/status":
+                self._reply(200, daemon.status())
+            else:
+                self._reply(404, {"ok": False, "error": "not found"})
+
+        def do_POST(self):
+            if self._refused(check_token=True):
+                return
+            url = urlparse(self.path)
+            action = url.path.strip("/")
+            if action == "shutdown":
+                self._reply(200, {"ok": True, "action": action})
+                threading.Thread(target=server.shutdown, daemon=True).start()
+                return
+            if action not in ACTIONS:
+                self._reply(404, {"ok": False, "error": f"unknown action: {action}"})
+                return
+            device = parse_qs(url.query).get("device", [None])[0]
+            result = daemon.run(action, device)
+            print(f"{action} {result.get('device', device or '')}: "
+                  f"{'OK' if result['ok'] else 'FAILED'} in {result.get('duration_ms', 0)} ms")
+            self._reply(200, result)
+
+        def log_message(self, format, *args):
+            # Results are printed by do_POST; skip the per-request access log
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    print(f"MAA ADB daemon listening on http://{host}:{port} (devices: {', '.join(daemon.devices)})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nDaemon stopped by user")
+    finally:
+        server.server_close()
+
+
+# ----------------------------------------------------------------------
+# Client
+# ----------------------------------------------------------------------
+def _address(config) -> tuple:
+    return (config.get("Daemon", "host", fallback="127.0.0.1"),
+            config.getint("Daemon", "port", fallback=5040))
+
+
+def _token(config, create: bool = False) -> str:
+    """[Daemon] token, or the one serve generated into token_file ("" if there is none yet)"""
+    token = config.get("Daemon", "token", fallback="").strip()
+    if token:
+        return token
+    token_file = config.get("Daemon", "token_file", fallback="daemon_token.txt")
+    try:
+        with open(token_file, "r", encoding="utf-8") as f:
+            token = f.read().strip()
+    except OSError:
+        pass
+    if token or not create:
+        return token
+    import secrets
+
+    token = secrets.token_hex(16)
+    # Readable by this user only: whoever can read it can unlock the phone
+    fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+    return token
+
+
+def call(action: str, device: Optional[str] = None, host: str = "127.0.0.1", port: int = 5040,
+         timeout: float = 120.0, token: str = "") -> Optional[Dict[str, Any]]:
+    """Ask a running daemon to run action; None if no daemon is listening"""
+    path = f"/{action}" if device is None else f"/{action}?device={quote(device)}"
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request("POST", path, headers={TOKEN_HEADER: token})
+        response = connection.getresponse()
+        return json.loads(response.read().decode("utf-8"))
+    except ConnectionRefusedError:
+        return None
+    finally:
+        connection.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Resident daemon for the MAA unlock/lock hooks, and its client")
+    parser.add_argument("command", choices=("serve", "status", "shutdown") + ACTIONS)
+    parser.add_argument("--device", help="Device name from config.ini (needed with several devices)")
+    parser.add_argument("--no-fallback", action="store_true",
+                        help="Fail instead of running the action in this process when no daemon is running")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve()
+        return 0
+
+    config = load_config()
+    host, port = _address(config)
+    timeout = config.getfloat("Daemon", "client_timeout", fallback=120.0)
+
+    if args.command == "status":
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        try:
+            connection.request("GET", "/status")
+            print(connection.getresponse().read().decode("utf-8"))
+            return 0
+        except OSError as e:
+            print(f"Daemon not reachable at {host}:{port}: {e}")
+            return 1
+        finally:
+            connection.close()
+
+    try:
+        result = call(args.command, args.device, host, port, timeout, _token(config))
+    except OSError as e:
+        print(f"Daemon at {host}:{port} failed: {e}")
+        return 1
+    if result is None:
+        if args.command == "shutdown":
+            print("Daemon not running")
+            return 0
+        if args.no_fallback:
+            print(f"Daemon not running at {host}:{port}")
+            return 1
+        # Keep the hook working without the daemon, just without the warm state
+        print(f"Daemon not running at {host}:{port}, running {args.command} directly")
+        result = Daemon().run(args.command, args.device)
+    print(json.dumps(result))
+    return 0 if result.get("ok") else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
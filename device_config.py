@@ -0,0 +1,74 @@
+import configparser
+from typing import List, NamedTuple
+
+
+DEVICE_SECTION_PREFIX = "Device:"
+
+
+class DeviceConfig(NamedTuple):
+    """Settings for one phone; the adb serial is its device_ip"""
+
+    name: str
+    device_ip: str
+    lock_password: str
+    require_unlock: bool
+    unlock_resolution: str
+    lock_resolution: str
+    save_original_resolution: bool
+    original_resolution_file: str
+    package_name: str
+    app_name: str
+    # Hardware serial (adb get-serialno): finds the phone on USB or by its mDNS name
+    serial_number: str = ""
+
+    @property
+    def serial(self) -> str:
+        return self.device_ip
+
+
+def _device_from_sections(config: configparser.ConfigParser, name: str, section: str,
+                          default_original_file: str) -> DeviceConfig:
+    """Read a device, taking anything its own section lacks from [ADB]/[Resolution]/[App]"""
+
+    def get(key: str, fallback_section: str, fallback: str = "") -> str:
+        if config.has_option(section, key):
+            return config.get(section, key)
+        return config.get(fallback_section, key, fallback=fallback)
+
+    def getboolean(key: str, fallback_section: str, fallback: bool) -> bool:
+        if config.has_option(section, key):
+            return config.getboolean(section, key)
+        return config.getboolean(fallback_section, key, fallback=fallback)
+
+    return DeviceConfig(
+        name=name,
+        device_ip=get("device_ip", "ADB"),
+        lock_password=get("lock_password", "ADB"),
+        require_unlock=getboolean("require_unlock", "ADB", True),
+        unlock_resolution=get("unlock_resolution", "Resolution", "720x1280"),
+        lock_resolution=get("lock_resolution", "Resolution", "1080x2400"),
+        save_original_resolution=getboolean("save_original_resolution", "Resolution", True),
+        original_resolution_file=get("original_resolution_file", section, default_original_file),
+        package_name=get("package_name", "App"),
+        app_name=get("app_name", "App"),
+        # Never inherited: it identifies exactly one phone
+        serial_number=config.get(section, "serial_number", fallback=""),
+    )
+
+
+def default_device(config: configparser.ConfigParser) -> DeviceConfig:
+    """The single device described by the classic [ADB]/[Resolution]/[App] sections"""
+    original_file = config.get("Resolution", "original_resolution_file", fallback="original_resolution.txt")
+    return _device_from_sections(config, "default", "ADB", original_file)
+
+
+def load_devices(config: configparser.ConfigParser) -> List[DeviceConfig]:
+    """Return every [Device:<name>] section, or the default device if there are none"""
+    devices = []
+    for section in config.sections():
+        if section.startswith(DEVICE_SECTION_PREFIX):
+            name = section[len(DEVICE_SECTION_PREFIX):].strip()
+            devices.append(_device_from_sections(config, name, section, f"original_resolution_{name}.txt"))
+    if not devices:
+        devices.append(default_device(config))
+    return devices
@@ -0,0 +1,225 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from log_buffer import get_logger
+from state_store import RUN_ID, StateStore
+from tracing import span
+
+log = get_logger("lease")
+
+
+class LeaseTimeout(Exception):
+    """Raised when another run kept the device for longer than the wait allows"""
+
+
+def _owner_alive(lease: Dict[str, Any]) -> Optional[bool]:
+    """Whether the process named in a lease or queue entry still runs; None if that cannot be checked"""
+    pid = lease.get("pid")
+    if pid == os.getpid():
+        # Our own threads always release in a finally block
+        return True
+    if not isinstance(pid, int) or os.name == "nt":
+        # os.kill would terminate it on Windows; the TTL covers crashed owners there
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class DeviceLease:
+    """Lets one flow at a time work on a device, across processes and threads
+
+    The lease is a record in the state store holding the owner's PID and
+    an expiry time, which the owner keeps pushing forward while it runs.
+    A lease is taken over when its owner died, or, where that cannot be
+    checked (Windows), once it expired. Waiting runs line up in order.
+    When a run is waiting for the same flow that last ran on the device
+    (MAA fired the unlock hook twice) and no other flow is queued before
+    it, it takes over that successful result instead of running again.
+    Time spent waiting is traced as lease.wait.
+    """
+
+    # (store path, serial) -> (thread id, depth): nested flows of one thread share the lease
+    _held: Dict[Tuple[str, str], Tuple[int, int]] = {}
+    _held_lock = threading.Lock()
+
+    def __init__(self, store: StateStore, serial: str, flow: str, ttl: float = 120.0,
+                 wait_timeout: float = 300.0, merge: bool = True):
+        self.store = store
+        self.serial = serial
+        self.flow = flow
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.merge = merge
+        self.owner = f"{RUN_ID}/{threading.get_ident()}"
+        self.waited = 0.0
+        self._released = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, config, serial: str, flow: str, store: Optional[StateStore] = None) -> "DeviceLease":
+        return cls(store or StateStore.from_config(config), serial, flow,
+                   ttl=config.getfloat("Lease", "ttl", fallback=120.0),
+                   wait_timeout=config.getfloat("Lease", "wait_timeout", fallback=300.0),
+                   merge=config.getboolean("Lease", "merge", fallback=True))
+
+    @property
+    def _key(self) -> Tuple[str, str]:
+        return (os.path.abspath(self.store.path), self.serial)
+
+    def _enter(self) -> bool:
+        """Nest into the lease if this thread already holds it; False if it does not"""
+        with self._held_lock:
+            holder = self._held.get(self._key)
+            if holder is None or holder[0] != threading.get_ident():
+                return False
+            self._held[self._key] = (holder[0], holder[1] + 1)
+            return True
+
+    def _exit(self) -> bool:
+        """Leave a nested hold; False when this was the outermost one"""
+        with self._held_lock:
+            holder = self._held.pop(self._key, None)
+            if holder is not None and holder[1] > 1:
+                self._held[self._key] = (holder[0], holder[1] - 1)
+                return True
+            return False
+
+    def _try_acquire(self, since: float) -> Tuple[bool, Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """One attempt: (acquired, result to merge with, current holder)"""
+        now = time.time()
+        with self.store.transaction() as data:
+            record = data.setdefault(self.serial, {})
+            lease = record.get("lease")
+            if lease:
+                alive = _owner_alive(lease)
+                if alive is False or (alive is None and lease.get("expires_at", 0) < now):
+                    log.warning(f"Taking over the lease of {self.serial} from {lease.get('flow')} "
+                                f"(pid {lease.get('pid')}), which {'died' if alive is False else 'expired'}")
+                    lease = None
+            queue = [entry for entry in record.get("lease_queue", [])
+                     if entry.get("owner") != self.owner and _owner_alive(entry) is not False
+                     and entry.get("enqueued_at", 0) > now - self.wait_timeout - self.ttl]
+            ahead = [entry for entry in queue if entry.get("enqueued_at", 0) <= since]
+
+            # Only a finished run leaves a result, so it is what last ran on the device
+            result = record.get("lease_result")
+            if (self.merge and lease is None and result and result.get("flow") == self.flow
+                    and result.get("ok") and result.get("finished_at", 0) >= since
+                    and all(entry.get("flow") == self.flow for entry in ahead)):
+                record["lease_queue"] = queue
+                return False, result, None
+
+            if lease is None and not ahead:
+                record["lease"] = {"owner": self.owner, "pid": os.getpid(), "flow": self.flow,
+                                   "acquired_at": now, "expires_at": now + self.ttl}
+                record.pop("lease_result", None)
+                if queue:
+                    record["lease_queue"] = queue
+                else:
+                    record.pop("lease_queue", None)
+                return True, None, None
+
+            queue.append({"owner": self.owner, "pid": os.getpid(), "flow": self.flow, "enqueued_at": since})
+            queue.sort(key=lambda entry: entry.get("enqueued_at", 0))
+            record["lease_queue"] = queue
+            return False, None, lease
+
+    def acquire(self) -> Optional[Dict[str, Any]]:
+        """Wait for the device; returns the merged result when another run already did our flow
+
+        Raises LeaseTimeout after wait_timeout seconds.
+        """
+        if self._enter():
+            return None
+        since = time.time()
+        start = time.monotonic()
+        delay = 0.05
+        announced = False
+        with span("lease.wait", serial=self.serial, flow=self.flow) as step:
+            while True:
+                try:
+                    acquired, merged, holder = self._try_acquire(since)
+                except OSError as e:
+                    # The state file can stay busy for a moment (Windows); poll again
+                    log.warning(f"Could not check the lease of {self.serial}: {e}")
+                    acquired, merged, holder = False, None, None
+                self.waited = time.monotonic() - start
+                if acquired or merged is not None:
+                    step.set(waited_s=round(self.waited, 3), merged=merged is not None)
+                    break
+                if not announced and holder:
+                    log.info(f"{self.serial} is busy with {holder.get('flow')} (pid {holder.get('pid')}), waiting...")
+                    announced = True
+                if self.waited >= self.wait_timeout:
+                    self._leave_queue()
+                    step.set(waited_s=round(self.waited, 3), timed_out=True)
+                    raise LeaseTimeout(f"{self.serial} stayed busy for {self.wait_timeout:.0f}s, giving up {self.flow}")
+                time.sleep(delay)
+                delay = min(delay * 1.5, 1.0)
+        if announced or merged is not None:
+            log.info(f"Waited {self.waited:.1f}s for {self.serial}")
+        if merged is not None:
+            return merged
+        with self._held_lock:
+            self._held[self._key] = (threading.get_ident(), 1)
+        self._released.clear()
+        self._heartbeat = threading.Thread(target=self._renew, name=f"lease-{self.serial}", daemon=True)
+        self._heartbeat.start()
+        return None
+
+    def _renew(self) -> None:
+        """Push expires_at forward while the lease is held, so long runs are not taken over"""
+        while not self._released.wait(max(self.ttl / 3, 0.05)):
+            try:
+                with self.store.transaction() as data:
+                    lease = data.get(self.serial, {}).get("lease")
+                    if not lease or lease.get("owner") != self.owner:
+                        return
+                    lease["expires_at"] = time.time() + self.ttl
+            except OSError as e:
+                log.warning(f"Could not renew the lease of {self.serial}: {e}")
+
+    def _leave_queue(self) -> None:
+        with self.store.transaction() as data:
+            record = data.get(self.serial)
+            if record and record.get("lease_queue"):
+                record["lease_queue"] = [entry for entry in record["lease_queue"] if entry.get("owner") != self.owner]
+
+    def release(self, ok: bool) -> None:
+        """Give the device back and leave ok for runs of the same flow that waited"""
+        if self._exit():
+            return
+        self._released.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            with self.store.transaction() as data:
+                record = data.setdefault(self.serial, {})
+                if (record.get("lease") or {}).get("owner") == self.owner:
+                    record.pop("lease")
+                    record["lease_result"] = {"flow": self.flow, "ok": ok, "finished_at": time.time(),
+                                              "pid": os.getpid()}
+        except OSError as e:
+            # The lease expires on its own after ttl
+            log.warning(f"Could not release the lease of {self.serial}: {e}")
+
+    def run(self, function: Callable[[], bool]) -> bool:
+        """Run function while holding the lease; a merged result counts as its return value"""
+        merged = self.acquire()
+        if merged is not None:
+            log.info(f"{self.flow} of {self.serial} was just done by pid {merged.get('pid')}, not repeating it")
+            return bool(merged.get("ok"))
+        ok = False
+        try:
+            ok = bool(function())
+            return ok
+        finally:
+            self.release(ok)
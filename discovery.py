@@ -0,0 +1,213 @@
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from adb_client import AdbClient, AdbError
+from log_buffer import get_logger
+from state_store import StateStore
+
+log = get_logger("discovery")
+
+
+# Wireless debugging advertises these; pairing services are not connectable
+MDNS_CONNECT_SERVICES = ("_adb-tls-connect._tcp", "_adb._tcp")
+
+
+def _host(address: str) -> str:
+    return address.rsplit(":", 1)[0]
+
+
+class TransportSelector:
+    """Finds the ways one device can be reached right now and picks the fastest
+
+    A device can be attached over USB (its adb serial is the hardware
+    serial number), connected over Wi-Fi at the configured device_ip, or
+    at whatever port wireless debugging picked after the last reboot,
+    which mDNS reveals. When more than one is online each gets a short
+    round-trip probe and the fastest wins. The choice is kept in the state
+    store and reused as long as that transport stays online, so the usual
+    run pays nothing beyond the device list it fetches anyway.
+    """
+
+    def __init__(self, adb: AdbClient, device_ip: str, store: StateStore, serial_number: str = "",
+                 probe_count: int = 2, recheck_after: float = 3600.0, browse_timeout: float = 2.0):
+        self.adb = adb
+        self.device_ip = device_ip
+        self.store = store
+        self.serial_number = serial_number
+        self.probe_count = max(1, probe_count)
+        self.recheck_after = recheck_after
+        self.browse_timeout = browse_timeout
+
+    @classmethod
+    def from_config(cls, config, adb: AdbClient, device_ip: str, serial_number: str = "",
+                    store: Optional[StateStore] = None) -> Optional["TransportSelector"]:
+        """Selector for device_ip from [ADB]; None when discovery is off"""
+        if not config.getboolean("ADB", "discovery", fallback=True):
+            return None
+        return cls(adb, device_ip, store or StateStore.from_config(config), serial_number=serial_number,
+                   probe_count=config.getint("ADB", "probe_count", fallback=2),
+                   recheck_after=config.getfloat("ADB", "transport_recheck", fallback=3600.0),
+                   browse_timeout=config.getfloat("ADB", "mdns_browse_timeout", fallback=2.0))
+
+    @property
+    def key(self) -> str:
+        """The device's record in the state store, the same one the flows use"""
+        return self.adb.serial or self.device_ip
+
+    def _known_serial_number(self, record: Dict) -> str:
+        return self.serial_number or record.get("serial_number", "")
+
+    def _mdns_match(self, instance: str, address: str, serial_number: str) -> bool:
+        if serial_number:
+            # Instances are named adb-<serial number>-<random suffix>
+            return instance.startswith(f"adb-{serial_number}-")
+        # Without a serial number the IP usually stays the same, only the port moves
+        return _host(address) == _host(self.device_ip)
+
+    # ------------------------------------------------------------------
+    # Transports already online
+    # ------------------------------------------------------------------
+    def online(self, listed: Dict[str, str], record: Optional[Dict] = None) -> List[Tuple[str, str]]:
+        """(adb serial, kind) of every transport to this device that adb lists as ready, USB first"""
+        record = self.store.get(self.key) if record is None else record
+        serial_number = self._known_serial_number(record)
+        cached = (record.get("transport") or {}).get("serial")
+        transports: List[Tuple[str, str]] = []
+
+        def add(serial: Optional[str], kind: str) -> None:
+            if serial and listed.get(serial) == "device" and all(serial != s for s, _ in transports):
+                transports.append((serial, kind))
+
+        add(serial_number, "usb")
+        add(self.device_ip, "tcp")
+        add(cached, "tcp")
+        if serial_number:
+            # adb itself may have connected an advertised service, listed under its mDNS name
+            for serial in listed:
+                if serial.startswith(f"adb-{serial_number}-"):
+                    add(serial, "mdns")
+        return transports
+
+    def measure(self, serial: str) -> Optional[float]:
+        """Best round trip of a trivial shell command over serial, in seconds; None if it fails"""
+        client = self.adb.on_transport(serial)
+        best: Optional[float] = None
+        for _ in range(self.probe_count):
+            start = time.perf_counter()
+            try:
+                if not client.shell("true").ok:
+                    return None
+            except AdbError as e:
+                log.debug("probe of %s failed: %s", serial, e)
+                return None
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def pick(self, listed: Dict[str, str]) -> Optional[str]:
+        """The adb serial to use among the online transports, or None if none is online"""
+        record = self.store.get(self.key)
+        transports = self.online(listed, record)
+        if not transports:
+            return None
+        cached = record.get("transport") or {}
+        fresh = 0 <= time.time() - cached.get("checked_at", 0) <= self.recheck_after
+        if fresh and any(serial == cached.get("serial") for serial, _ in transports):
+            return cached["serial"]
+
+        if len(transports) == 1:
+            serial, kind = transports[0]
+            self.remember(serial, kind)
+            return serial
+        timings = [(self.measure(serial), serial, kind) for serial, kind in transports]
+        timings = [timing for timing in timings if timing[0] is not None]
+        if not timings:
+            return None
+        rtt, serial, kind = min(timings)
+        log.info("Transports to %s: %s; using %s", self.key,
+                 ", ".join(f"{s} ({k}) {t * 1000:.0f} ms" for t, s, k in timings), serial)
+        self.remember(serial, kind, rtt)
+        return serial
+
+    def remember(self, serial: str, kind: str, rtt: Optional[float] = None) -> None:
+        """Keep serial as the transport for the next runs; learn the serial number once"""
+        fields = {"transport": {"serial": serial, "kind": kind, "checked_at": time.time(),
+                                "rtt_ms": round(rtt * 1000, 1) if rtt is not None else None}}
+        record = self.store.get(self.key)
+        if not self._known_serial_number(record):
+            # Lets the next run spot the device on USB or by its mDNS name
+            try:
+                result = self.adb.on_transport(serial).shell("getprop ro.serialno")
+                if result.ok and result.text.strip():
+                    fields["serial_number"] = result.text.strip()
+            except AdbError as e:
+                log.debug("could not read ro.serialno over %s: %s", serial, e)
+        self.store.record(self.key, **fields)
+
+    # ------------------------------------------------------------------
+    # Addresses to connect to when nothing is online
+    # ------------------------------------------------------------------
+    def addresses(self) -> Iterator[str]:
+        """Wi-Fi addresses worth an adb connect, best first: configured, last good, advertised
+
+        mDNS is only asked once the known addresses have been tried.
+        """
+        record = self.store.get(self.key)
+        tried: List[str] = []
+        cached = record.get("transport") or {}
+        known = [self.device_ip]
+        if cached.get("kind") == "tcp" and cached.get("serial"):
+            known.append(cached["serial"])
+        for address in known:
+            if address not in tried:
+                tried.append(address)
+                yield address
+        for address in self.discover(self._known_serial_number(record)):
+            if address not in tried:
+                tried.append(address)
+                yield address
+
+    def discover(self, serial_number: str = "") -> List[str]:
+        """Addresses this device advertises over mDNS, from the adb server or a local browse"""
+        try:
+            services = self.adb.mdns_services()
+        except AdbError as e:
+            # Older adb servers have no mdns support
+            log.debug("adb mdns services failed: %s", e)
+            services = []
+        if not services:
+            services = self._browse()
+        found = [address for instance, service_type, address in services
+                 if service_type.rstrip(".") in MDNS_CONNECT_SERVICES
+                 and self._mdns_match(instance, address, serial_number)]
+        if found:
+            log.info(f"Found {self.key} advertised at {', '.join(found)}")
+        return found
+
+    def _browse(self) -> List[Tuple[str, str, str]]:
+        """Browse for adb services with the optional zeroconf package"""
+        if self.browse_timeout <= 0:
+            return []
+        try:
+            from zeroconf import ServiceBrowser, ServiceStateChange, Zeroconf
+        except ImportError:
+            return []
+
+        services: List[Tuple[str, str, str]] = []
+
+        def on_change(zeroconf, service_type, name, state_change) -> None:
+            if state_change is not ServiceStateChange.Added:
+                return
+            info = zeroconf.get_service_info(service_type, name, timeout=int(self.browse_timeout * 1000))
+            if info is not None and info.parsed_addresses():
+                instance = name[:-len(service_type)].rstrip(".")
+                services.append((instance, service_type, f"{info.parsed_addresses()[0]}:{info.port}"))
+
+        zeroconf = Zeroconf()
+        try:
+            ServiceBrowser(zeroconf, [f"{service}.local." for service in MDNS_CONNECT_SERVICES],
+                           handlers=[on_change])
+            time.sleep(self.browse_timeout)
+        finally:
+            zeroconf.close()
+        return list(services)
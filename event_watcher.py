@@ -0,0 +1,228 @@
+import re
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from adb_client import AdbClient, AdbError
+from log_buffer import get_logger
+from tracing import span
+from waiting import wait_until
+
+log = get_logger("events")
+
+
+# Log tags that announce the transitions below; the events buffer ones are
+# the most reliable across vendor ROMs, the text ones cover older releases
+WATCH_TAGS = ("PowerManagerService:I", "KeyguardViewMediator:D", "ActivityTaskManager:I", "ActivityManager:I",
+              "WindowManager:I", "screen_toggled:I", "wm_set_keyguard_shown:I", "wm_set_resumed_activity:I",
+              "am_set_resumed_activity:I")
+
+# Current power state first (logcat only reports changes), then the log from
+# its last existing line on. Every line is parsed as it arrives.
+WATCH_COMMAND = ("dumpsys power | grep -m 1 mWakefulness=; "
+                 "logcat -v brief -T 1 -b main -b system -b events -s " + " ".join(WATCH_TAGS))
+
+
+def _keyguard_shown(match: "re.Match") -> Optional[bool]:
+    """keyguardShowing of a wm_set_keyguard_shown entry, by its layout; None for other displays
+
+    Up to Android 13: [keyguardShowing, aodShowing, keyguardGoingAway, reason]
+    Android 14+:      [displayId, keyguardShowing, aodShowing, keyguardGoingAway, occluded, reason]
+    """
+    fields = [field.strip() for field in match.group(1).split(",")]
+    flags = fields[:-1]
+    if len(flags) == 3:
+        return flags[0] == "1"
+    if len(flags) == 5:
+        # Secondary displays have keyguards of their own
+        return flags[1] == "1" if flags[0] == "0" else None
+    return None
+
+
+# (state, pattern, value of a match, None to ignore it); later transitions overwrite earlier ones
+EVENT_PATTERNS = (
+    ("screen", re.compile(r"\bmWakefulness=(\w+)"), lambda m: m.group(1) == "Awake"),
+    ("screen", re.compile(r"\bscreen_toggled\(\s*\d+\):\s*(\d)"), lambda m: m.group(1) == "1"),
+    ("screen", re.compile(r"PowerManagerService.*\b(Waking up|Going to sleep)"), lambda m: m.group(1) == "Waking up"),
+    ("keyguard", re.compile(r"\bwm_set_keyguard_shown\(\s*\d+\):\s*\[([^\]]*)\]"), _keyguard_shown),
+    ("keyguard", re.compile(r"KeyguardViewMediator.*\b(handleKeyguardDone|keyguardGoingAway|handleHide|handleShow)\b"),
+     lambda m: m.group(1) == "handleShow"),
+    ("activity", re.compile(r"\b(?:wm|am)_set_resumed_activity\(\s*\d+\):\s*\[\d+,([^,\]]+)"), lambda m: m.group(1)),
+    ("activity", re.compile(r"\bDisplayed (\S+/[^\s:]+)"), lambda m: m.group(1)),
+    ("display", re.compile(r"Using new display size: (\d+x\d+)"), lambda m: m.group(1)),
+)
+
+
+class DeviceEventWatcher:
+    """Follows one device's screen, keyguard, activity and display transitions as they happen
+
+    One long-lived logcat stream per device is parsed line by line in a
+    background thread; flow steps wait on the published state instead of
+    taking dumpsys snapshots in a loop, and so react within milliseconds.
+    Log formats differ between ROMs, so a waiting step still runs its
+    one-shot probe every probe_interval seconds: a transition the stream
+    misses costs at most that long, and without a stream (old devices,
+    cassette backends) the probes carry on alone.
+    """
+
+    def __init__(self, adb: AdbClient, probe_interval: float = 1.0, ready_timeout: float = 0.5):
+        self.adb = adb
+        self.probe_interval = probe_interval
+        self.ready_timeout = ready_timeout
+        # screen: bool, keyguard: bool (showing), activity: component, display: WxH
+        self.state: Dict[str, Any] = {}
+        self._changed = threading.Condition()
+        self._sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._stopped = False
+
+    @classmethod
+    def from_config(cls, config, adb: AdbClient) -> Optional["DeviceEventWatcher"]:
+        """Watcher for adb from [ADB] event_stream; None when it is off"""
+        if not config.getboolean("ADB", "event_stream", fallback=True):
+            return None
+        return cls(adb, probe_interval=config.getfloat("Timing", "probe_interval", fallback=1.0))
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> bool:
+        """Open the stream; returns False (and the probes take over) when it cannot be had"""
+        if self.running:
+            return True
+        if not self.adb.supports_sessions:
+            # Cassette backends only see one-shot commands
+            return False
+        self._stopped = False
+        self._ready.clear()
+        try:
+            self._sock = self.adb.open_service(f"exec:{WATCH_COMMAND}")
+        except AdbError as e:
+            log.info(f"No event stream, polling instead: {e}")
+            return False
+        # Wakes the reader now and then to notice stop()
+        self._sock.settimeout(0.5)
+        self._thread = threading.Thread(target=self._read, name=f"events-{self.adb.serial}", daemon=True)
+        self._thread.start()
+        # logcat starts with its last existing line; after that nothing is missed
+        self._ready.wait(self.ready_timeout)
+        return self.running
+
+    def stop(self) -> None:
+        self._stopped = True
+        if self._sock is not None:
+            try:
+                # Wakes the reader's recv at once, close() alone does not
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+        if self._thread is not None:
+            self._thread.join(1.0)
+        self._thread = self._sock = None
+        with self._changed:
+            self._changed.notify_all()
+
+    def __enter__(self) -> "DeviceEventWatcher":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _read(self) -> None:
+        buffer = b""
+        seeded = False
+        try:
+            while not self._stopped:
+                try:
+                    chunk = self._sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if not chunk:
+                    break
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for raw in lines:
+                    line = raw.decode("utf-8", errors="ignore").rstrip("\r")
+                    if line.startswith("--------- beginning of"):
+                        continue
+                    if not seeded:
+                        if "mWakefulness=" in line:
+                            self._handle(line)
+                            continue
+                        # logcat's replayed last line: old news, only says the stream is live
+                        seeded = True
+                        self._ready.set()
+                        continue
+                    self._handle(line)
+        except OSError as e:
+            if not self._stopped:
+                log.info(f"Event stream of {self.adb.serial} ended: {e}")
+        finally:
+            self._ready.set()
+            with self._changed:
+                self._changed.notify_all()
+
+    def _handle(self, line: str) -> None:
+        for name, pattern, value in EVENT_PATTERNS:
+            match = pattern.search(line)
+            if match:
+                parsed = value(match)
+                if parsed is not None:
+                    self.publish(name, parsed)
+                return
+
+    def publish(self, name: str, value: Any) -> None:
+        with self._changed:
+            if self.state.get(name) != value:
+                log.debug("event %s=%s", name, value)
+            self.state[name] = value
+            self._changed.notify_all()
+
+    def wait_for(self, name: str, value: Any, timeout: float, probe: Optional[Callable[[], bool]] = None,
+                 description: Optional[str] = None) -> bool:
+        """Wait until state name equals value, checking probe every probe_interval meanwhile
+
+        Returns True as soon as either the stream or the probe confirms it,
+        False once timeout seconds have passed. Without a running stream
+        this is plain wait_until polling of probe.
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        probes = 0
+        with span("events.wait", state=name, timeout=timeout) as step:
+            while self.running:
+                with self._changed:
+                    if self.state.get(name) != value:
+                        self._changed.wait_for(lambda: self.state.get(name) == value or not self.running,
+                                               timeout=max(0.0, min(self.probe_interval, deadline - time.monotonic())))
+                    confirmed = self.state.get(name) == value
+                if confirmed:
+                    step.set(ok=True, via="event", probes=probes)
+                    break
+                if probe is not None:
+                    probes += 1
+                    try:
+                        if probe():
+                            step.set(ok=True, via="probe", probes=probes)
+                            break
+                    except AdbError as e:
+                        log.warning(f"Check failed, retrying: {e}")
+                if time.monotonic() >= deadline:
+                    step.set(ok=False, probes=probes)
+                    if description:
+                        log.warning(f"Timed out after {timeout:.1f}s waiting for: {description}")
+                    return False
+            else:
+                # The stream is gone (or never came): poll like every other wait
+                step.set(via="polling")
+                if probe is None:
+                    return False
+                return wait_until(probe, timeout=max(0.0, deadline - time.monotonic()), description=description)
+        if description:
+            log.info(f"{description} after {time.monotonic() - start:.2f}s")
+        return True
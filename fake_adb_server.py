@@ -0,0 +1,626 @@
+import re
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from adb_client import EXIT_MARKER
+from event_watcher import WATCH_COMMAND
+
+
+SESSION_COMMAND = "stty -echo 2>/dev/null; cat | sh 2>&1"
+_MARKER_LINE = re.compile(r"^printf '\\n__MAA_E''ND_%s__:%s\\n' (\d+) \$\?$")
+_GREP = re.compile(r"^grep (?:-q(E)? '([^']*)'|-A (\d+) (\S+))$")
+_DEVICE_WAIT = re.compile(r"^\(i=0; while ! \((.*)\); do i=\$\(\(i\+1\)\); "
+                          r"if \[ \$i -ge (\d+) \]; then exit 1; fi; sleep ([\d.]+); done\)$")
+
+
+# A shell handler returns either the output or (output, exit code)
+ShellResponse = Union[str, bytes, Tuple[Union[str, bytes], int]]
+
+# What screencap shows per state: background and (x1, y1, x2, y2, color) boxes in screen fractions
+_SCREENS: Dict[str, Tuple[Tuple[int, int, int], List[Tuple[float, float, float, float, Tuple[int, int, int]]]]] = {
+    "off": ((0, 0, 0), []),
+    "lock": ((25, 35, 70), [(0.2, 0.12, 0.8, 0.22, (255, 255, 255)), (0.3, 0.24, 0.7, 0.27, (200, 200, 210)),
+                            (0.45, 0.88, 0.55, 0.92, (255, 255, 255))]),
+    "pin": ((15, 15, 15), [(0.35, 0.35, 0.65, 0.38, (255, 255, 255))]
+            + [(0.15 + 0.27 * col, 0.5 + 0.11 * row, 0.31 + 0.27 * col, 0.58 + 0.11 * row, (90, 90, 90))
+               for row in range(4) for col in range(3)]),
+    "home": ((200, 120, 60), [(0.1 + 0.22 * col, 0.15 + 0.14 * row, 0.24 + 0.22 * col, 0.23 + 0.14 * row,
+                               ((60 * col) % 256, 180, (90 * row) % 256)) for row in range(4) for col in range(4)]
+             + [(0.0, 0.85, 1.0, 1.0, (230, 230, 230))]),
+    "app": ((250, 250, 250), [(0.0, 0.0, 1.0, 0.08, (30, 90, 200))]),
+}
+
+
+class FakeAdbServer:
+    """Minimal local adb server speaking the host wire protocol, for testing AdbClient"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.devices: List[Tuple[str, str]] = [("127.0.0.1:5555", "device")]
+        self.shell_responses: Dict[str, Union[ShellResponse, Callable[[str], ShellResponse]]] = {}
+        self.exec_responses: Dict[str, Union[bytes, Callable[[str], bytes]]] = {}
+        # Consulted for commands missing from shell_responses, e.g. by FakeDevice
+        self.default_response: Optional[Callable[[str], ShellResponse]] = None
+        # Long-running exec commands (logcat): returns chunks to send until the
+        # client hangs up (b"" when there is nothing new), or None for the rest
+        self.stream_handler: Optional[Callable[[str], Optional[Iterator[bytes]]]] = None
+        self.requests: List[str] = []
+        self.killed = False
+        # Addresses host:connect cannot reach, like a phone that is switched off
+        self.unreachable: List[str] = []
+        # (instance, service type, address) answered to host:mdns:services
+        self.mdns_services: List[Tuple[str, str, str]] = []
+        # Simulated Wi-Fi hop per device service or session command (or per
+        # transport serial), plus extra device-side time for commands
+        # starting with a given prefix
+        self.transport_latency = 0.0
+        self.serial_latency: Dict[str, float] = {}
+        self.command_latency: Dict[str, float] = {}
+        # Traffic and (start, end, request) timings, for benchmarks
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.timeline: List[Tuple[float, float, str]] = []
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                server._handle(self.request)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "FakeAdbServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeAdbServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.requests.clear()
+            self.timeline.clear()
+            self.bytes_in = self.bytes_out = 0
+
+    # ------------------------------------------------------------------
+    def _read_request(self, sock) -> Optional[str]:
+        header = b""
+        while len(header) < 4:
+            chunk = sock.recv(4 - len(header))
+            if not chunk:
+                return None
+            header += chunk
+        length = int(header, 16)
+        payload = b""
+        while len(payload) < length:
+            chunk = sock.recv(length - len(payload))
+            if not chunk:
+                return None
+            payload += chunk
+        request = payload.decode("utf-8")
+        with self._lock:
+            self.requests.append(request)
+            self.bytes_in += 4 + length
+        return request
+
+    def _send(self, sock, data: bytes) -> None:
+        sock.sendall(data)
+        with self._lock:
+            self.bytes_out += len(data)
+
+    def _okay(self, sock, payload: Optional[bytes] = None) -> None:
+        if payload is None:
+            self._send(sock, b"OKAY")
+        else:
+            self._send(sock, b"OKAY" + b"%04x" % len(payload) + payload)
+
+    def _fail(self, sock, message: str) -> None:
+        data = message.encode("utf-8")
+        self._send(sock, b"FAIL" + b"%04x" % len(data) + data)
+
+    def _record(self, start: float, request: str) -> None:
+        with self._lock:
+            self.timeline.append((start, time.perf_counter(), request))
+
+    def _latency(self, command: str) -> None:
+        matches = [prefix for prefix in self.command_latency if command.startswith(prefix)]
+        if matches:
+            time.sleep(self.command_latency[max(matches, key=len)])
+
+    def _handle(self, sock) -> None:
+        request = self._read_request(sock)
+        if request is None:
+            return
+        start = time.perf_counter()
+        try:
+            self._dispatch(sock, request)
+        finally:
+            if not request.startswith("host:transport"):
+                self._record(start, request)
+
+    def _dispatch(self, sock, request: str) -> None:
+        if request == "host:version":
+            self._okay(sock, b"0029")
+        elif request == "host:devices":
+            listing = "".join(f"{serial}\t{state}\n" for serial, state in self.devices)
+            self._okay(sock, listing.encode("utf-8"))
+        elif request.startswith("host:connect:"):
+            address = request[len("host:connect:"):]
+            if address in self.unreachable:
+                self._okay(sock, f"failed to connect to {address}".encode("utf-8"))
+                return
+            if not any(serial == address for serial, _ in self.devices):
+                self.devices.append((address, "device"))
+            self._okay(sock, f"connected to {address}".encode("utf-8"))
+        elif request.startswith("host:disconnect:"):
+            address = request[len("host:disconnect:"):]
+            self.devices = [d for d in self.devices if d[0] != address]
+            self._okay(sock, f"disconnected {address}".encode("utf-8"))
+        elif request == "host:mdns:services":
+            listing = "".join(f"{instance}\t{service}\t{address}\n" for instance, service, address in self.mdns_services)
+            self._okay(sock, listing.encode("utf-8"))
+        elif request == "host:kill":
+            self.killed = True
+            self._okay(sock)
+        elif request.startswith("host:transport"):
+            self._handle_transport(sock, request)
+        else:
+            self._fail(sock, f"unknown host service: {request}")
+
+    def _handle_transport(self, sock, request: str) -> None:
+        serial = None
+        if request.startswith("host:transport:"):
+            serial = request[len("host:transport:"):]
+            if not any(s == serial and state == "device" for s, state in self.devices):
+                self._fail(sock, f"device '{serial}' not found")
+                return
+        elif not any(state == "device" for _, state in self.devices):
+            self._fail(sock, "no devices/emulators found")
+            return
+        self._okay(sock)
+
+        service = self._read_request(sock)
+        if service is None:
+            return
+        start = time.perf_counter()
+        if service == "shell:" + SESSION_COMMAND:
+            self._okay(sock)
+            self._run_session(sock, self.serial_latency.get(serial, self.transport_latency))
+            return
+        time.sleep(self.serial_latency.get(serial, self.transport_latency))
+        if service.startswith("shell:"):
+            self._okay(sock)
+            self._send(sock, self._run_shell(service[len("shell:"):]))
+        elif service.startswith("exec:"):
+            self._okay(sock)
+            command = service[len("exec:"):]
+            stream = self.stream_handler(command) if self.stream_handler is not None else None
+            if stream is not None:
+                # One round trip to open it; how long it stays open is not device time
+                self._record(start, service)
+                self._stream(sock, stream)
+                return
+            if command in self.exec_responses:
+                response = self.exec_responses[command]
+                if callable(response):
+                    response = response(command)
+            else:
+                response = self._evaluate(command)[0]
+            try:
+                self._send(sock, response)
+            except OSError:
+                # Client stopped reading early, like a streaming probe does
+                pass
+        else:
+            self._fail(sock, f"unknown device service: {service}")
+        self._record(start, service)
+
+    def _stream(self, sock, stream: Iterator[bytes]) -> None:
+        try:
+            for chunk in stream:
+                if chunk:
+                    self._send(sock, chunk)
+                elif select.select([sock], [], [], 0)[0] and not sock.recv(1, socket.MSG_PEEK):
+                    return
+        except OSError:
+            pass
+        finally:
+            stream.close()
+
+    def _evaluate(self, command: str) -> Tuple[bytes, int]:
+        """Produce (output, exit code) for a command from shell_responses"""
+        with self._lock:
+            self.requests.append(f"run:{command}")
+        wait = _DEVICE_WAIT.match(command)
+        if wait:
+            check, tries, interval = wait.group(1), int(wait.group(2)), float(wait.group(3))
+            for _ in range(tries + 1):
+                if self._evaluate(check)[1] == 0:
+                    return b"", 0
+                time.sleep(interval)
+            return b"", 1
+        if " || " in command:
+            first, second = command.split(" || ", 1)
+            output, returncode = self._evaluate(first)
+            if returncode == 0:
+                return output, returncode
+            return self._evaluate(second)
+        if " | grep " in command and command not in self.shell_responses:
+            return self._grep(command)
+
+        self._latency(command)
+        response = self.shell_responses.get(command)
+        if response is None:
+            response = self.default_response if self.default_response is not None else ""
+        if callable(response):
+            response = response(command)
+        if isinstance(response, tuple):
+            output, returncode = response
+        else:
+            output, returncode = response, 0
+        if isinstance(output, str):
+            output = output.encode("utf-8")
+        return output, returncode
+
+    def _grep(self, command: str) -> Tuple[bytes, int]:
+        """Emulate the grep filters the probes append to dumpsys commands"""
+        source, filter_ = command.rsplit(" | ", 1)
+        output = self._evaluate(source)[0].decode("utf-8", errors="ignore")
+        match = _GREP.match(filter_)
+        if not match:
+            return b"", 2
+        extended, pattern, after, word = match.groups()
+        if pattern is not None:
+            found = re.search(pattern if extended else re.escape(pattern), output, re.M)
+            return b"", 0 if found else 1
+        lines = output.splitlines(keepends=True)
+        selected = []
+        remaining = -1
+        for line in lines:
+            if word in line:
+                remaining = int(after)
+                selected.append(line)
+            elif remaining > 0:
+                remaining -= 1
+                selected.append(line)
+        return "".join(selected).encode("utf-8"), 0 if selected else 1
+
+    def _run_shell(self, command: str) -> bytes:
+        suffix = f"; echo {EXIT_MARKER.decode()}$?"
+        wants_status = command.endswith(suffix)
+        if wants_status:
+            command = command[:-len(suffix)]
+        output, returncode = self._evaluate(command)
+        if wants_status:
+            output += EXIT_MARKER + str(returncode).encode() + b"\n"
+        return output
+
+    def _run_session(self, sock, latency: float) -> None:
+        """Serve a ShellSession: run each line, answer marker lines with the last status"""
+        buffer = b""
+        returncode = 0
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            with self._lock:
+                self.bytes_in += len(chunk)
+            buffer += chunk
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                command = line.decode("utf-8")
+                if command == "exit":
+                    return
+                marker = _MARKER_LINE.match(command)
+                if marker:
+                    self._send(sock, b"\n__MAA_END_%s__:%d\n" % (marker.group(1).encode(), returncode))
+                    continue
+                start = time.perf_counter()
+                time.sleep(latency)
+                output, returncode = self._evaluate(command)
+                self._send(sock, output)
+                self._record(start, f"session:{command}")
+
+
+class FakeDevice:
+    """Scriptable phone behind a FakeAdbServer: screen, keyguard, display and apps
+
+    install() makes it answer every command the flows send. The delays model
+    how long the phone takes to react, e.g. the keyguard animating away after
+    the PIN; command latency itself is set on the server.
+    """
+
+    def __init__(self, sdk: str = "33", keyguard_style: str = "delegate", pin: str = "1234",
+                 physical_size: str = "1080x2400", physical_density: int = 440,
+                 packages: Optional[Dict[str, Tuple[str, str]]] = None,
+                 wake_delay: float = 0.0, bouncer_delay: float = 0.0, unlock_delay: float = 0.0,
+                 dump_padding: int = 0, swipe_min_travel: float = 0.3, log_events: bool = True):
+        self.sdk = sdk
+        self.keyguard_style = keyguard_style
+        self.pin = pin
+        self.physical_size = physical_size
+        self.physical_density = physical_density
+        # package -> (versionCode, launcher component)
+        self.packages = packages if packages is not None else {
+            "com.dev47apps.droidcam": ("227", "com.dev47apps.droidcam/.DroidCamActivity"),
+        }
+        self.wake_delay = wake_delay
+        self.bouncer_delay = bouncer_delay
+        self.unlock_delay = unlock_delay
+        # Filler lines around the interesting parts, real dumps are large
+        self.dump_padding = dump_padding
+        # The keyguard ignores swipes that start or end off screen or are too short
+        self.swipe_min_travel = swipe_min_travel
+        # Whether logcat reports transitions to the event watcher
+        self.log_events = log_events
+
+        self.screen_on = False
+        self.keyguard_showing = True
+        self.bouncer = False
+        self.override_size: Optional[str] = None
+        self.override_density: Optional[int] = None
+        self.foreground: Optional[str] = None
+        self._pending: List[Tuple[float, Callable[[], None]]] = []
+        self._lock = threading.RLock()
+
+    def install(self, server: FakeAdbServer) -> "FakeDevice":
+        server.default_response = self.respond
+        server.stream_handler = self.stream
+        return self
+
+    def stream(self, command: str) -> Optional[Iterator[bytes]]:
+        if command == WATCH_COMMAND and self.log_events:
+            return self._watch_stream()
+        return None
+
+    def _watched(self) -> Tuple[bool, bool, Optional[str], Optional[str]]:
+        with self._lock:
+            self._settle()
+            return self.screen_on, self.keyguard_showing, self.override_size, self.foreground
+
+    def _watch_stream(self) -> Iterator[bytes]:
+        """The event watcher's stream: power state, then log lines for every change"""
+        seen = self._watched()
+        yield (f"  mWakefulness={'Awake' if seen[0] else 'Asleep'}\n--------- beginning of main\n"
+               "I/ActivityManager( 1000): Start proc 4321:com.android.settings (an earlier event)\n").encode("utf-8")
+        while True:
+            time.sleep(0.01)
+            now = self._watched()
+            screen, keyguard, size, foreground = now
+            lines = []
+            if screen != seen[0]:
+                lines.append(f"I/screen_toggled( 1000): {1 if screen else 0}\n")
+            if keyguard != seen[1]:
+                if int(self.sdk) >= 34:
+                    # [displayId, keyguardShowing, aodShowing, keyguardGoingAway, occluded, reason]
+                    lines.append(f"I/wm_set_keyguard_shown( 1000): [0,{int(keyguard)},0,{int(not keyguard)},0,"
+                                 "setKeyguardShown]\n")
+                else:
+                    lines.append(f"I/wm_set_keyguard_shown( 1000): [{int(keyguard)},0,{int(not keyguard)},"
+                                 "setKeyguardShown]\n")
+            if size != seen[2]:
+                lines.append(f"I/WindowManager( 1000): Using new display size: {size or self.physical_size}\n")
+            if foreground != seen[3] and foreground:
+                lines.append(f"I/wm_set_resumed_activity( 1000): [0,{foreground},startActivityUnchecked]\n")
+            seen = now
+            yield "".join(lines).encode("utf-8")
+
+    def lock(self) -> None:
+        """Put the device back to screen off and locked"""
+        with self._lock:
+            self._pending.clear()
+            self.screen_on = False
+            self.keyguard_showing = True
+            self.bouncer = False
+            self.foreground = None
+
+    # ------------------------------------------------------------------
+    def _after(self, delay: float, change: Callable[[], None]) -> None:
+        if delay <= 0:
+            change()
+        else:
+            self._pending.append((time.monotonic() + delay, change))
+
+    def _settle(self) -> None:
+        now = time.monotonic()
+        due = [item for item in self._pending if item[0] <= now]
+        self._pending = [item for item in self._pending if item[0] > now]
+        for _, change in sorted(due, key=lambda item: item[0]):
+            change()
+
+    def _padding(self, label: str) -> str:
+        return "".join(f"    {label}{i}=0\n" for i in range(self.dump_padding))
+
+    def respond(self, command: str) -> ShellResponse:
+        with self._lock:
+            self._settle()
+            if "; " in command:
+                parts = [self.respond(part) for part in command.split("; ")]
+                output = "".join(p[0] if isinstance(p, tuple) else p for p in parts)
+                last = parts[-1]
+                return output, last[1] if isinstance(last, tuple) else 0
+            args = command.split()
+            if not args:
+                return ""
+            handler = getattr(self, "_cmd_" + args[0].replace("-", "_"), None)
+            if handler is None:
+                return f"/system/bin/sh: {args[0]}: inaccessible or not found\n", 127
+            return handler(args[1:])
+
+    # ------------------------------------------------------------------
+    # Commands
+    # ------------------------------------------------------------------
+    def _cmd_getprop(self, args: List[str]) -> ShellResponse:
+        if args == ["ro.build.version.sdk"]:
+            return f"{self.sdk}\n"
+        return "\n"
+
+    def _cmd_input(self, args: List[str]) -> ShellResponse:
+        if args[:1] == ["keyevent"] and args[1:2] in (["26"], ["KEYCODE_POWER"]):
+            if self.screen_on:
+                self.lock()
+            else:
+                self._after(self.wake_delay, lambda: setattr(self, "screen_on", True))
+        elif args[:1] == ["swipe"]:
+            if self.screen_on and self.keyguard_showing and self._reveals_bouncer(args[1:5]):
+                self._after(self.bouncer_delay, lambda: setattr(self, "bouncer", True))
+        elif args[:1] == ["text"]:
+            if self.bouncer and " ".join(args[1:]) == self.pin:
+                self._after(self.unlock_delay, self._unlock)
+        return ""
+
+    def _reveals_bouncer(self, coordinates: List[str]) -> bool:
+        """An upward swipe inside the display over swipe_min_travel of its height"""
+        try:
+            x1, y1, x2, y2 = (int(v) for v in coordinates)
+        except ValueError:
+            return False
+        width, height = (int(v) for v in (self.override_size or self.physical_size).split("x"))
+        inside = all(0 <= x < width for x in (x1, x2)) and all(0 <= y < height for y in (y1, y2))
+        return inside and y1 - y2 >= height * self.swipe_min_travel
+
+    def _unlock(self) -> None:
+        self.keyguard_showing = False
+        self.bouncer = False
+
+    def _cmd_dumpsys(self, args: List[str]) -> ShellResponse:
+        section = " ".join(args)
+        if section == "power":
+            wakefulness = "Awake" if self.screen_on else "Asleep"
+            return (f"POWER MANAGER (dumpsys power)\n\nPower Manager State:\n{self._padding('mPower')}"
+                    f"  mWakefulness={wakefulness}\n{self._padding('mPowerTail')}")
+        if section == "window policy":
+            return f"WINDOW MANAGER POLICY STATE (dumpsys window policy)\n{self._keyguard_lines()}"
+        if section == "window windows":
+            return f"WINDOW MANAGER WINDOWS (dumpsys window windows)\n{self._padding('mWindow')}{self._focus_line()}"
+        if section == "window":
+            return (f"WINDOW MANAGER LAST ANR\n{self._padding('mAnr')}"
+                    f"WINDOW MANAGER POLICY STATE\n{self._keyguard_lines()}"
+                    f"WINDOW MANAGER WINDOWS\n{self._padding('mWindow')}{self._focus_line()}")
+        if section == "activity service com.android.systemui":
+            bouncer = "true" if self.bouncer else "false"
+            return (f"SERVICE com.android.systemui/.SystemUIService 1a2b pid=2345\n{self._padding('mSystemUi')}"
+                    f"  StatusBarKeyguardViewManager:\n    mBouncerShowing={bouncer}\n")
+        if section == "activity activities":
+            resumed = self.foreground if self.foreground and not self.keyguard_showing else None
+            line = f"  mResumedActivity: ActivityRecord{{1 u0 {resumed} t1}}\n" if resumed else ""
+            return f"ACTIVITY MANAGER ACTIVITIES (dumpsys activity activities)\n{line}"
+        if args[:1] == ["package"] and len(args) == 2:
+            package = args[1]
+            if package not in self.packages:
+                return "Unable to find package: " + package + "\n"
+            version_code = self.packages[package][0]
+            return (f"Activity Resolver Table:\n  Non-Data Actions:\n      versionCode=1 (other block)\n"
+                    f"Packages:\n  Package [{package}] (1a2b3c):\n    userId=10123\n"
+                    f"    versionCode={version_code} minSdk=21 targetSdk=33\n{self._padding('mPackage')}")
+        return f"Can't find service: {section}\n"
+
+    def _keyguard_lines(self) -> str:
+        showing = "true" if self.keyguard_showing else "false"
+        if self.keyguard_style == "none":
+            # Vendor ROMs that print no keyguard state at all
+            return ""
+        if self.keyguard_style == "delegate":
+            return f"    KeyguardServiceDelegate\n      showing={showing}\n      inputRestricted={showing}\n"
+        return f"    mKeyguardShowing={showing}\n"
+
+    def _focus_line(self) -> str:
+        if self.bouncer or (self.keyguard_showing and self.screen_on and int(self.sdk) >= 31):
+            # Android 12+ shows the lock screen and the bouncer in the notification shade
+            window = "NotificationShade"
+        elif self.keyguard_showing:
+            window = "StatusBar" if self.screen_on else "null"
+        else:
+            window = self.foreground or "com.android.launcher3/.Launcher"
+        return f"  mCurrentFocus=Window{{1 u0 {window}}}\n"
+
+    def _cmd_wm(self, args: List[str]) -> ShellResponse:
+        if args == ["size"]:
+            override = f"Override size: {self.override_size}\n" if self.override_size else ""
+            return f"Physical size: {self.physical_size}\n{override}"
+        if args == ["density"]:
+            override = f"Override density: {self.override_density}\n" if self.override_density else ""
+            return f"Physical density: {self.physical_density}\n{override}"
+        if args[:1] == ["size"] and len(args) == 2:
+            if args[1] == "reset":
+                self.override_size = None
+            elif re.match(r"^\d+x\d+$", args[1]):
+                self.override_size = None if args[1] == self.physical_size else args[1]
+            else:
+                return f"Error: bad size {args[1]}\n", 255
+            return ""
+        if args[:1] == ["density"] and len(args) == 2:
+            self.override_density = None if args[1] == "reset" else int(args[1])
+            return ""
+        return "usage: wm [size|density] ...\n", 255
+
+    def _cmd_cmd(self, args: List[str]) -> ShellResponse:
+        if args[:2] == ["package", "resolve-activity"]:
+            package = args[-1]
+            if package not in self.packages:
+                return "No activity found\n"
+            return ("priority=0 preferredOrder=0 match=0x108000 specificIndex=-1 isDefault=true\n"
+                    f"{self.packages[package][1]}\n")
+        return f"Unknown command: {' '.join(args)}\n", 255
+
+    def _cmd_am(self, args: List[str]) -> ShellResponse:
+        if args[:1] == ["start"] and "-n" in args:
+            component = args[args.index("-n") + 1]
+            if not any(component == launch for _, launch in self.packages.values()):
+                return (f"Starting: Intent {{ cmp={component} }}\nError type 3\n"
+                        f"Error: Activity class {{{component}}} does not exist.\n")
+            self.foreground = component
+            return (f"Starting: Intent {{ cmp={component} }}\nStatus: ok\nLaunchState: COLD\n"
+                    f"Activity: {component}\nTotalTime: 812\nWaitTime: 815\nComplete\n")
+        return "", 255
+
+    def _cmd_monkey(self, args: List[str]) -> ShellResponse:
+        package = args[args.index("-p") + 1] if "-p" in args else None
+        if package not in self.packages:
+            return "** No activities found to run, monkey aborted.\n", 252
+        self.foreground = self.packages[package][1]
+        return "Events injected: 1\n## Network stats: elapsed time=12ms\n"
+
+    def _cmd_screencap(self, args: List[str]) -> ShellResponse:
+        """Raw RGBA frame with the Android 9+ header, drawn for the current state"""
+        if args:
+            return "screencap: only raw output to stdout is emulated\n", 1
+        if not self.screen_on:
+            screen = "off"
+        elif self.bouncer:
+            screen = "pin"
+        elif self.keyguard_showing:
+            screen = "lock"
+        else:
+            screen = "app" if self.foreground else "home"
+        background, boxes = _SCREENS[screen]
+        width, height = (int(v) for v in (self.override_size or self.physical_size).split("x"))
+        rows: Dict[Tuple[int, ...], bytes] = {}
+        frame = [struct.pack("<IIII", width, height, 1, 0)]
+        for y in range(height):
+            active = tuple(i for i, box in enumerate(boxes) if box[1] * height <= y < box[3] * height)
+            row = rows.get(active)
+            if row is None:
+                line = bytearray(bytes((*background, 255)) * width)
+                for i in active:
+                    x1, x2 = int(boxes[i][0] * width), int(boxes[i][2] * width)
+                    line[x1 * 4:x2 * 4] = bytes((*boxes[i][4], 255)) * (x2 - x1)
+                row = rows[active] = bytes(line)
+            frame.append(row)
+        return b"".join(frame)
@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from app_config import load_config
+from device_config import DeviceConfig, load_devices
+
+
+class DeviceResult:
+    """Outcome of one flow on one device"""
+
+    def __init__(self, device: str, flow: str, ok: bool, duration: float, error: Optional[str] = None):
+        self.device = device
+        self.flow = flow
+        self.ok = ok
+        self.duration = duration
+        self.error = error
+
+    def __repr__(self) -> str:
+        status = "OK" if self.ok else f"FAILED ({self.error})" if self.error else "FAILED"
+        return f"{self.device}: {self.flow} {status} in {self.duration:.2f}s"
+
+
+def _flow_function(flow: str) -> Callable[[DeviceConfig], bool]:
+    # Imported lazily: each script reads config.ini when it is first imported
+    if flow == "unlock":
+        from unlock_phone_new_with_config import unlock_phone
+        return unlock_phone
+    if flow == "lock":
+        from lock_phone_and_recovery_resolution_with_config import set_resolution_and_launch_app
+        return set_resolution_and_launch_app
+    if flow == "prewarm":
+        from prewarm import Prewarmer
+        return lambda device: Prewarmer(load_config(), device).prewarm()
+    raise ValueError(f"Unknown flow: {flow}")
+
+
+async def run_fleet(flow: str, devices: List[DeviceConfig], concurrency: int = 4) -> List[DeviceResult]:
+    """Run flow on every device, at most concurrency devices at a time
+
+    The flows do blocking socket I/O, so each device runs in a worker
+    thread while the event loop only schedules and collects results.
+    """
+    function = _flow_function(flow)
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fleet") as executor:
+        async def run_one(device: DeviceConfig) -> DeviceResult:
+            async with semaphore:
+                start = time.monotonic()
+                try:
+                    ok = await loop.run_in_executor(executor, function, device)
+                    return DeviceResult(device.name, flow, bool(ok), time.monotonic() - start)
+                except Exception as e:
+                    return DeviceResult(device.name, flow, False, time.monotonic() - start, str(e))
+
+        return list(await asyncio.gather(*(run_one(device) for device in devices)))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run the unlock, lock/launch or pre-warm flow on several devices at once")
+    parser.add_argument("flow", choices=["unlock", "lock", "prewarm"])
+    parser.add_argument("--concurrency", type=int, help="Maximum devices processed at the same time")
+    parser.add_argument("--device", action="append", dest="names", help="Only run these device names")
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    devices = load_devices(config)
+    if args.names:
+        devices = [device for device in devices if device.name in args.names]
+    if not devices:
+        print("No matching devices configured")
+        return 1
+    concurrency = args.concurrency or config.getint("Fleet", "concurrency", fallback=4)
+
+    start = time.monotonic()
+    results = asyncio.run(run_fleet(args.flow, devices, concurrency))
+    print(f"\nFleet {args.flow} finished in {time.monotonic() - start:.2f}s")
+    for result in results:
+        print(f"  {result}")
+    return 0 if all(result.ok for result in results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
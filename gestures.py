@@ -0,0 +1,72 @@
+from typing import Dict, NamedTuple, Optional, Tuple
+
+
+GESTURE_SECTION = "Gestures"
+GESTURE_SECTION_PREFIX = "Gestures:"
+
+
+class Gesture(NamedTuple):
+    """A swipe in normalized screen coordinates (0..1 of width and height) with a duration
+
+    Mapped to pixels only when it is sent, through the size the display
+    uses at that moment, so it lands in the same place whatever
+    unlock_resolution the display was just switched to.
+    """
+
+    name: str
+    x1: float
+    y1: float
+    x2: float
+    y2: float
+    duration_ms: int
+
+    @classmethod
+    def parse(cls, name: str, value: str) -> "Gesture":
+        """Read "x1, y1, x2, y2, duration_ms" as written in [Gestures]"""
+        parts = [part.strip() for part in value.split(",")]
+        try:
+            if len(parts) != 5:
+                raise ValueError(f"expected x1, y1, x2, y2, duration_ms, got {len(parts)} values")
+            x1, y1, x2, y2 = (float(part) for part in parts[:4])
+            duration_ms = int(parts[4])
+        except ValueError as e:
+            raise ValueError(f"Invalid gesture {name} = {value}: {e}")
+        if not all(0.0 <= v <= 1.0 for v in (x1, y1, x2, y2)):
+            raise ValueError(f"Invalid gesture {name} = {value}: coordinates must be between 0 and 1")
+        return cls(name, x1, y1, x2, y2, max(0, duration_ms))
+
+    def points(self, width: int, height: int) -> Tuple[int, int, int, int]:
+        """Pixel coordinates on a width x height display, kept inside the screen"""
+        def scale(fraction: float, extent: int) -> int:
+            return min(extent - 1, max(0, round(fraction * extent)))
+
+        return (scale(self.x1, width), scale(self.y1, height),
+                scale(self.x2, width), scale(self.y2, height))
+
+    def command(self, size: str) -> str:
+        """The input command for a display of size ("WxH")"""
+        width, height = (int(v) for v in size.split("x"))
+        x1, y1, x2, y2 = self.points(width, height)
+        return f"input swipe {x1} {y1} {x2} {y2} {self.duration_ms}"
+
+
+# Built-in gestures; [Gestures] and then [Gestures:<device name>] override them
+DEFAULTS = {
+    # Up from the lower part of the lock screen to reveal the PIN bouncer.
+    # The keyguard wants a long, unhurried drag (the old fixed swipe was
+    # 400,1000 -> 400,300 on a 720x1280 display).
+    "unlock_swipe": Gesture("unlock_swipe", 0.5, 0.8, 0.5, 0.25, 250),
+}
+
+
+def load_gestures(config, device_name: Optional[str] = None) -> Dict[str, Gesture]:
+    """Every gesture for a device: [Gestures:<device_name>], then [Gestures], then DEFAULTS"""
+    gestures = dict(DEFAULTS)
+    sections = [GESTURE_SECTION]
+    if device_name:
+        sections.append(GESTURE_SECTION_PREFIX + device_name)
+    for section in sections:
+        if config.has_section(section):
+            for name, value in config.items(section):
+                gestures[name] = Gesture.parse(name, value)
+    return gestures
@@ -0,0 +1,222 @@
+import re
+import threading
+from typing import Dict, Optional, Tuple
+
+from adb_client import AdbClient, AdbError
+from log_buffer import get_logger
+from state_store import DEFAULT_SERIAL, StateStore
+
+log = get_logger("keyguard")
+
+
+# Narrowest source first; the full window dump is the last resort
+KEYGUARD_PROBES = (
+    ("window_policy", "dumpsys window policy"),
+    ("window", "dumpsys window"),
+)
+
+# Lines that settle the keyguard state on their own
+_DECISIVE = re.compile(r"\b(mKeyguardShowing|isStatusBarKeyguard|mShowingLockscreen)=(true|false)")
+# Only used when nothing decisive shows up (it is false whenever no dream runs)
+_WEAK = re.compile(r"\bmDreamingLockscreen=(true|false)")
+# Android 10+ prints keyguard state inside a KeyguardServiceDelegate block
+_DELEGATE_SHOWING = re.compile(r"^\s*showing=(true|false)")
+_WAKEFULNESS = re.compile(r"\bmWakefulness=(\w+)")
+_RESUMED = re.compile(r"\b(?:mResumedActivity|topResumedActivity|ResumedActivity):.*?\s(\S+/\S+)")
+
+# Device-side equivalents of the parsers above, per marker style.
+# mDreamingLockscreen is left out: grep cannot tell it is only a weak hint.
+UNLOCKED_FILTERS = {
+    "markers": "grep -qE 'mKeyguardShowing=false|isStatusBarKeyguard=false|mShowingLockscreen=false'",
+    "delegate": "grep -A 20 KeyguardServiceDelegate | grep -qE '^ *showing=false'",
+}
+
+# Shown only while the PIN pad is up. A focused NotificationShade is not
+# enough: on Android 12+ the plain lock screen lives in that window too.
+BOUNCER_CHECKS = (
+    "dumpsys window windows | grep -qE 'mCurrentFocus.*Bouncer'",
+    "dumpsys activity service com.android.systemui | grep -qE '(mBouncerShowing|isBouncerShowing)[=:] ?true'",
+)
+
+
+class KeyguardProbe:
+    """Cheap screen/keyguard state queries that stop reading at the first decisive line
+
+    Which dumpsys section carries the keyguard markers depends on the
+    Android version, so the first working probe is remembered per device
+    serial and SDK level and reused by every later probe instance. With a
+    state store the choice also survives between runs (see prewarm.py),
+    which saves the detection round-trips on the unlock path; a stored
+    choice is dropped when the SDK level changed or its section stops
+    carrying the keyguard state.
+    """
+
+    # (serial, sdk) -> (probe name, marker style)
+    _probe_cache: Dict[Tuple[str, str], Tuple[str, str]] = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, adb: AdbClient, store: Optional[StateStore] = None):
+        self.adb = adb
+        self.store = store
+        self._sdk: Optional[str] = None
+        self._probe: Optional[Tuple[str, str]] = None
+        # Whether self._probe came from the state store rather than detection in this process
+        self._stored = False
+
+    @property
+    def cache_key(self) -> Tuple[str, str]:
+        if self._sdk is None:
+            self._sdk = self.adb.shell("getprop ro.build.version.sdk").text.strip()
+        return (self.serial, self._sdk)
+
+    @property
+    def serial(self) -> str:
+        return self.adb.serial or DEFAULT_SERIAL
+
+    @property
+    def probe(self) -> Tuple[str, str]:
+        """(probe name, marker style) that works for this device, detecting it if needed"""
+        if self._probe is None:
+            self._probe = self._stored_probe() or self._cached_probe(refresh=False)
+        return self._probe
+
+    def refresh(self) -> Tuple[str, str]:
+        """Detect the probe again and remember the result"""
+        self._probe = self._cached_probe(refresh=True)
+        return self._probe
+
+    def forget(self) -> None:
+        """Drop the remembered choice, e.g. when it stopped matching after an OS update"""
+        with self._cache_lock:
+            for key in [key for key in self._probe_cache if key[0] == self.serial]:
+                del self._probe_cache[key]
+        if self.store is not None:
+            self.store.clear(self.serial, "keyguard_probe")
+        self._probe = None
+        self._stored = False
+
+    def _stored_probe(self) -> Optional[Tuple[str, str]]:
+        if self.store is None:
+            return None
+        stored = self.store.get_field(self.serial, "keyguard_probe")
+        if not isinstance(stored, dict):
+            return None
+        name, style = stored.get("name"), stored.get("style")
+        if name not in dict(KEYGUARD_PROBES) or style not in UNLOCKED_FILTERS:
+            return None
+        sdk = self.cache_key[1]
+        if stored.get("sdk") != sdk:
+            log.info(f"SDK level of {self.serial} changed ({stored.get('sdk')} -> {sdk}), "
+                     f"detecting the keyguard probe again")
+            return None
+        self._stored = True
+        return name, style
+
+    def _cached_probe(self, refresh: bool) -> Tuple[str, str]:
+        key = self.cache_key
+        with self._cache_lock:
+            probe = None if refresh else self._probe_cache.get(key)
+        if probe is None:
+            probe = self._detect_probe()
+            if probe is None:
+                # Nothing matched anywhere; keep the full dump so callers see the usual markers
+                probe = KEYGUARD_PROBES[-1][0], "markers"
+            elif self.store is not None:
+                self.store.record(self.serial, keyguard_probe={"sdk": key[1], "name": probe[0], "style": probe[1]})
+            with self._cache_lock:
+                self._probe_cache[key] = probe
+        return probe
+
+    @property
+    def probe_command(self) -> str:
+        return dict(KEYGUARD_PROBES)[self.probe[0]]
+
+    def _detect_probe(self) -> Optional[Tuple[str, str]]:
+        for name, command in KEYGUARD_PROBES:
+            showing, style = self._scan_keyguard(command)
+            if showing is not None and style in UNLOCKED_FILTERS:
+                log.info(f"Using '{command}' for keyguard checks")
+                return name, style
+        return None
+
+    def _scan_keyguard(self, command: str) -> Tuple[Optional[bool], Optional[str]]:
+        """Stream command's output until the keyguard state is known
+
+        Returns (showing, marker style); showing is None if the output
+        never says.
+        """
+        weak = None
+        in_delegate = False
+        lines = self.adb.stream_lines(command)
+        try:
+            for line in lines:
+                match = _DECISIVE.search(line)
+                if match:
+                    return match.group(2) == "true", "markers"
+                if "KeyguardServiceDelegate" in line:
+                    in_delegate = True
+                elif in_delegate:
+                    match = _DELEGATE_SHOWING.match(line)
+                    if match:
+                        return match.group(1) == "true", "delegate"
+                if weak is None:
+                    match = _WEAK.search(line)
+                    if match:
+                        weak = match.group(1) == "true"
+        finally:
+            lines.close()
+        return weak, "weak" if weak is not None else None
+
+    # ------------------------------------------------------------------
+    # Host-side queries
+    # ------------------------------------------------------------------
+    def keyguard_showing(self) -> Optional[bool]:
+        """Return whether the keyguard is up, or None if the device does not say"""
+        showing = self._scan_keyguard(self.probe_command)[0]
+        if showing is None and self._stored:
+            log.info(f"'{self.probe_command}' no longer shows the keyguard state, detecting the probe again")
+            self.forget()
+            showing = self._scan_keyguard(self.probe_command)[0]
+        return showing
+
+    def screen_on(self) -> Optional[bool]:
+        lines = self.adb.stream_lines("dumpsys power")
+        try:
+            for line in lines:
+                match = _WAKEFULNESS.search(line)
+                if match:
+                    return match.group(1) == "Awake"
+        finally:
+            lines.close()
+        return None
+
+    def top_activity(self) -> Optional[str]:
+        """Return the resumed activity component, e.g. com.example/.MainActivity"""
+        lines = self.adb.stream_lines("dumpsys activity activities")
+        try:
+            for line in lines:
+                match = _RESUMED.search(line)
+                if match:
+                    return match.group(1).rstrip("}")
+        finally:
+            lines.close()
+        return None
+
+    def unlocked(self) -> bool:
+        """Predicate for wait_until: True once the keyguard is known to be gone"""
+        try:
+            return self.keyguard_showing() is False
+        except AdbError:
+            return False
+
+    # ------------------------------------------------------------------
+    # Device-side checks for ShellSession batches
+    # ------------------------------------------------------------------
+    def unlocked_check(self) -> str:
+        """Shell check that exits 0 once the keyguard is gone"""
+        name, style = self.probe
+        return f"{dict(KEYGUARD_PROBES)[name]} | {UNLOCKED_FILTERS[style]}"
+
+    def bouncer_check(self) -> str:
+        """Shell check that exits 0 once the bouncer (PIN pad) is up or the keyguard is gone"""
+        return " || ".join((self.unlocked_check(),) + BOUNCER_CHECKS)
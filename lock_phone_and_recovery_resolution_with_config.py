@@ -1,254 +1,210 @@
-import subprocess
-from time import sleep
-import smtplib
-from email.mime.text import MIMEText
-from email.header import Header
-from datetime import datetime
-import configparser
-import ssl
+from typing import Dict, Optional, Tuple
+from adb_client import AdbClient, AdbError
+from adb_connection import AdbConnectionManager
+from app_config import load_config
+from app_launcher import AppLauncher
+from device_config import DeviceConfig, default_device
+from device_lease import DeviceLease, LeaseTimeout
+from log_buffer import configure as configure_logging, get_logger
+from notifier import Notifier
 from resolution_manager import ResolutionManager
+from retry_policy import CircuitOpenError
+from state_store import StateStore
+from step_runner import StepRunner
+from tracing import configure as configure_tracing, traced
 
 # 读取配置文件
-config = configparser.ConfigParser()
-config.read("config.ini")
+config = load_config()
 
-# 初始化分辨率管理器
-resolution_manager = ResolutionManager()
+# 日志输出到控制台，并在内存中保留最近的记录，失败时随邮件发送
+configure_logging(config)
+log = get_logger("lock")
+
+# 按[Trace]配置记录每个步骤的耗时，未配置时不产生任何开销
+configure_tracing(config)
+
+# 失败通知在后台线程发送，短时间内的多条错误合并为一封邮件
+notifier = Notifier(config, subject="MAA Task Failed", heading="Task execution failed")
+
+# 互不依赖的步骤最多同时执行的数量（每个步骤使用独立的adb连接）
+parallel_steps = config.getint("ADB", "parallel_steps", fallback=4)
 
 
 def send_error_email(error_message):
-    """Send error notification email"""
-    try:
-        # Email settings
-        smtp_server = config["Email"]["smtp_server"]
-        smtp_port = int(config["Email"]["smtp_port"])
-        sender = config["Email"]["sender"]
-        receiver = config["Email"]["receiver"]
-        password = config["Email"]["password"]
-
-        # Create message
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        subject = f"MAA Task Failed - {current_time}"
-        content = f"""
-        Task execution failed at {current_time}
-
-        Error details:
-        {error_message}
-        """
-
-        msg = MIMEText(content, "plain", "utf-8")
-        msg["Subject"] = Header(subject, "utf-8")
-        msg["From"] = sender
-        msg["To"] = receiver
-
-        # Try sending email with different methods
-        email_sent = False
-        last_error = None
-        
-        # Method 1: STARTTLS
-        try:
-            context = ssl.create_default_context()
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls(context=context)
-                server.login(sender, password)
-                server.sendmail(sender, [receiver], msg.as_string())
-                email_sent = True
-                print("Error notification email sent successfully (STARTTLS)")
-        except smtplib.SMTPResponseException as e:
-            # Handle QQ mail's harmless connection close error
-            if (e.smtp_code in [250, 221] or 
-                "successful" in str(e).lower() or 
-                str(e.smtp_code) == "-1" or
-                b'\x00\x00\x00' in str(e).encode('utf-8', errors='ignore')):
-                email_sent = True
-                print("Error notification email sent successfully (STARTTLS)")
-            else:
-                last_error = e
-                print(f"STARTTLS method failed: {str(e)}")
-        except Exception as e:
-            # Special handling for QQ mail connection close error
-            if ("b'\\x00\\x00\\x00'" in str(e) or 
-                "(-1, b'\\x00\\x00\\x00')" in str(e)):
-                email_sent = True
-                print("Error notification email sent successfully (STARTTLS)")
-            else:
-                last_error = e
-                print(f"STARTTLS method failed: {str(e)}")
-            
-        # Method 2: Direct SSL if STARTTLS failed
-        if not email_sent:
-            try:
-                context = ssl.create_default_context()
-                with smtplib.SMTP_SSL(smtp_server, 465, context=context) as server:
-                    server.login(sender, password)
-                    server.sendmail(sender, [receiver], msg.as_string())
-                    email_sent = True
-                    print("Error notification email sent successfully (SSL)")
-            except smtplib.SMTPResponseException as e:
-                # Handle QQ mail's harmless connection close error
-                if (e.smtp_code in [250, 221] or 
-                    "successful" in str(e).lower() or 
-                    str(e.smtp_code) == "-1" or
-                    b'\x00\x00\x00' in str(e).encode('utf-8', errors='ignore')):
-                    email_sent = True
-                    print("Error notification email sent successfully (SSL)")
-                else:
-                    last_error = e
-                    print(f"SSL method failed: {str(e)}")
-            except Exception as e:
-                # Special handling for QQ mail connection close error
-                if ("b'\\x00\\x00\\x00'" in str(e) or 
-                    "(-1, b'\\x00\\x00\\x00')" in str(e)):
-                    email_sent = True
-                    print("Error notification email sent successfully (SSL)")
-                else:
-                    last_error = e
-                    print(f"SSL method failed: {str(e)}")
-                
-        if not email_sent and last_error:
-            print(f"Failed to send error email: {str(last_error)}")
-            
-    except Exception as e:
-        print(f"Failed to send error email: {str(e)}")
+    """Queue an error notification email; it is sent in the background"""
+    notifier.notify(error_message)
 
 
-def check_adb_device():
-    """Check if any ADB device is connected and authorized"""
+def check_adb_device(connection_manager: AdbConnectionManager):
+    """Check that the configured ADB device is connected and authorized"""
     try:
-        # Kill existing ADB server to ensure fresh start
-        subprocess.run("adb kill-server", shell=True, check=True)
-        sleep(2)
-        # Start ADB server
-        subprocess.run("adb start-server", shell=True, check=True)
-        sleep(2)
-
-        # Try to connect via IP
-        device_ip = config["ADB"]["device_ip"]
-        print(f"Trying to connect via IP: {device_ip}...")
-        connect_result = subprocess.run(
-            f"adb connect {device_ip}",
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-        print(f"Connect result: {connect_result.stdout}")
-        sleep(2)
-
-        # Get device list
-        result = subprocess.run(
-            "adb devices", shell=True, capture_output=True, text=True, check=True
-        )
-
-        # Parse the output
-        lines = result.stdout.strip().split("\n")
-        if len(lines) <= 1:  # Only has the "List of devices attached" header
-            error_msg = "No ADB devices found. Please check your connection."
-            print(error_msg)
-            send_error_email(error_msg)
-            return False
-
-        # Check if any device is properly authorized
-        for line in lines[1:]:  # Skip the header line
-            if line.strip() and not line.strip().endswith("unauthorized"):
-                print("Found connected device:", line.strip())
-                return True
+        state = connection_manager.ensure_device()
+        if state == "device":
+            log.info(f"Found connected device: {connection_manager.device_ip}")
+            return True
 
-        error_msg = "Found device but it's not authorized. Please check your phone and accept the debugging prompt."
-        print(error_msg)
+        if state == "unauthorized":
+            error_msg = "Found device but it's not authorized. Please check your phone and accept the debugging prompt."
+        else:
+            error_msg = "No ADB devices found. Please check your connection."
+        log.error(error_msg)
         send_error_email(error_msg)
         return False
 
-    except subprocess.CalledProcessError as e:
+    except CircuitOpenError:
+        # Already reported when the breaker opened; the caller skips the device
+        raise
+    except AdbError as e:
         error_msg = f"Error checking ADB devices: {e}"
-        print(error_msg)
+        log.error(error_msg)
         send_error_email(error_msg)
         return False
 
 
-def set_resolution_and_launch_app():
+def resolve_app(device: DeviceConfig, app_launcher: AppLauncher) -> Tuple[bool, Optional[str]]:
+    """Look up the configured app: (installed, launcher activity or None for monkey)
+
+    AdbError is left to the caller.
+    """
+    # 从 config.ini 中读取包名和应用名称
+    package_name = device.package_name
+    app_name = device.app_name
+    log.info(f"Checking for package: {package_name}")
+
+    # The installed versionCode doubles as the "is it installed" check
+    version_code = app_launcher.version_code(package_name)
+    if not version_code:
+        error_msg = f"{app_name} is not installed on the device (package {package_name} not found)"
+        log.error(error_msg)
+        send_error_email(error_msg)
+        return False, None
+
+    log.info(f"Found {app_name} package: {package_name} (versionCode {version_code})")
+    # The real launcher activity, cached per versionCode
+    return True, app_launcher.launcher_activity(package_name, version_code)
+
+
+def start_app(device: DeviceConfig, app_launcher: AppLauncher, store: StateStore,
+              component: Optional[str]) -> bool:
+    """Start component (monkey as fallback); returns True if the app was launched"""
+    package_name = device.package_name
+    app_name = device.app_name
+    log.info(f"Attempting to launch {app_name}...")
+    if component:
+        launch_result = app_launcher.start(component)
+        if launch_result.ok:
+            timing = f" in {launch_result.total_time_ms} ms" if launch_result.total_time_ms is not None else ""
+            log.info(f"{app_name} launched successfully{timing}!")
+            store.record(device.serial, app=package_name)
+            return True
+        # The cached activity may be gone, resolve it again next time
+        app_launcher.forget(package_name)
+        error_msg = f"Failed to launch {app_name} with {component}, trying fallback method..."
+    else:
+        error_msg = f"Could not resolve the launcher activity of {app_name}, trying fallback method..."
+    log.warning(error_msg)
+
+    # Fallback to monkey
+    monkey_result = app_launcher.start_with_monkey(package_name)
+    if monkey_result.ok:
+        log.info(f"{app_name} launched using fallback method")
+        store.record(device.serial, app=package_name)
+        return True
+    error_msg = f"Fallback launch failed: {monkey_result.output}"
+    log.error(error_msg)
+    send_error_email(error_msg)
+    return False
+
+
+def launch_app(device: DeviceConfig, app_launcher: AppLauncher, store: StateStore) -> bool:
+    """Start the configured app (cached launcher activity, monkey as fallback)
+
+    Returns True if the app was launched; AdbError is left to the caller.
+    """
+    installed, component = resolve_app(device, app_launcher)
+    return installed and start_app(device, app_launcher, store, component)
+
+
+@traced("lock")
+def set_resolution_and_launch_app(device: Optional[DeviceConfig] = None, adb: Optional[AdbClient] = None,
+                                  resolution_manager: Optional[ResolutionManager] = None,
+                                  app_launcher: Optional[AppLauncher] = None) -> bool:
+    """Restore the resolution and launch the configured app on one device
+
+    Returns True if the app was launched. A long-running caller (daemon.py)
+    can pass in the adb client and managers it keeps for the device.
+    Overlapping runs for the same device wait for each other ([Lease]).
+    """
+    device = device or default_device(config)
     try:
-        # First check ADB device connection
-        if not check_adb_device():
-            print("Please connect your device and try again.")
-            return
+        return DeviceLease.from_config(config, device.serial, "lock").run(
+            lambda: _set_resolution_and_launch_app(device, adb, resolution_manager, app_launcher))
+    except LeaseTimeout as e:
+        error_msg = str(e)
+        log.error(error_msg)
+        send_error_email(error_msg)
+        return False
+
 
+def _set_resolution_and_launch_app(device: DeviceConfig, adb: Optional[AdbClient],
+                                   resolution_manager: Optional[ResolutionManager],
+                                   app_launcher: Optional[AppLauncher]) -> bool:
+
+    # 通过TCP直接与adb server通信，所有命令都指定该设备的serial
+    adb = adb or AdbClient.from_config(config, serial=device.serial)
+    connection_manager = AdbConnectionManager.from_config(config, adb, device.device_ip, device.serial_number)
+
+    # 初始化分辨率管理器
+    resolution_manager = resolution_manager or ResolutionManager(adb=adb, device=device, config=config)
+
+    # 应用启动器，启动Activity按包名和versionCode缓存在状态文件中
+    app_launcher = app_launcher or AppLauncher(adb, resolution_manager.store)
+
+    target: Dict[str, Optional[str]] = {}
+
+    def restore() -> bool:
         # Restore original resolution or set lock resolution
-        print("Restoring original resolution...")
-        if not resolution_manager.restore_original_resolution():
-            error_msg = "Failed to restore original resolution"
-            print(error_msg)
-            send_error_email(error_msg)
-            # Continue anyway, as resolution change is not critical for app launch
-
-        sleep(2)
-
-        # 从 config.ini 中读取包名和应用名称
-        package_name = config["App"]["package_name"]
-        app_name = config["App"]["app_name"]
-        print(f"Checking for package: {package_name}")
-
-        # First, list all packages and print the grep result for debugging
-        print(f"Searching for {app_name} package...")
-        list_result = subprocess.run(
-            "adb shell pm list packages",
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-        print("All packages:", list_result.stdout)
-
-        # Direct check if the package exists
-        check_result = subprocess.run(
-            f"adb shell pm path {package_name}",
-            shell=True,
-            capture_output=True,
-            text=True,
-        )
-
-        if check_result.returncode == 0 and check_result.stdout.strip():
-            print(f"Found {app_name} package: {package_name}")
-            print(f"Package path: {check_result.stdout.strip()}")
-
-            # Try to launch directly with known activity
-            print(f"Attempting to launch {app_name}...")
-            launch_result = subprocess.run(
-                f"adb shell am start -n {package_name}/.DroidCamActivity",
-                shell=True,
-                capture_output=True,
-                text=True,
-            )
-
-            if launch_result.returncode == 0:
-                print(f"{app_name} launched successfully!")
-            else:
-                error_msg = f"Failed to launch {app_name} with main activity, trying fallback method..."
-                print(error_msg)
-                # Fallback to monkey
-                monkey_result = subprocess.run(
-                    f"adb shell monkey -p {package_name} 1",
-                    shell=True,
-                    capture_output=True,
-                    text=True,
-                )
-                if monkey_result.returncode == 0:
-                    print(f"{app_name} launched using fallback method")
-                else:
-                    error_msg = f"Fallback launch failed: {monkey_result.stdout}"
-                    print(error_msg)
-                    send_error_email(error_msg)
-        else:
-            error_msg = f"{app_name} is not installed on the device\npm path result: {check_result.stdout}\npm path return code: {check_result.returncode}"
-            print(error_msg)
-            send_error_email(error_msg)
+        log.info("Restoring original resolution...")
+        if resolution_manager.restore_original_resolution():
+            return True
+        error_msg = "Failed to restore original resolution"
+        log.error(error_msg)
+        send_error_email(error_msg)
+        return False
 
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Error executing ADB command: {e}\nCommand output: {e.output.decode() if e.output else 'No output'}"
-        print(error_msg)
+    def resolve() -> bool:
+        installed, target["component"] = resolve_app(device, app_launcher)
+        return installed
+
+    # 恢复分辨率与查找启动Activity互不依赖，同时进行；启动应用需等两者都完成
+    runner = StepRunner(max_workers=parallel_steps, name="lock")
+    runner.add("connect", lambda: check_adb_device(connection_manager))
+    # Not critical: the app is launched even if the resolution could not be restored
+    runner.add("restore", restore, after=("connect",), critical=False)
+    runner.add("resolve", resolve, after=("connect",))
+    runner.add("launch", lambda: start_app(device, app_launcher, resolution_manager.store, target.get("component")),
+               after=("restore", "resolve"))
+
+    try:
+        results = runner.run()
+        if not results["connect"].ok:
+            log.info("Please connect your device and try again.")
+            return False
+        return results["launch"].ok
+
+    except CircuitOpenError as e:
+        log.info(f"Skipping {device.name}: {e}")
+        return False
+    except AdbError as e:
+        error_msg = f"Error executing ADB command: {e}"
+        log.error(error_msg)
         send_error_email(error_msg)
+        return False
     except Exception as e:
         error_msg = f"An error occurred: {e}"
-        print(error_msg)
+        log.error(error_msg)
         send_error_email(error_msg)
+        return False
 
 
 if __name__ == "__main__":
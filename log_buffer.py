@@ -0,0 +1,81 @@
+import logging
+import sys
+import threading
+from collections import deque
+from typing import List, Optional
+
+LOGGER_NAME = "maa"
+
+# How records look in a failure report; console output stays plain messages
+RECORD_FORMAT = "%(asctime)s.%(msecs)03d %(levelname).1s %(threadName)s %(name)s: %(message)s"
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last capacity records in memory and formats them only when asked
+
+    Appending to a bounded deque is all a record costs, so the successful
+    path never formats, writes or sends anything for it.
+    """
+
+    def __init__(self, capacity: int = 200, max_line: int = 400):
+        super().__init__(logging.DEBUG)
+        self.records: "deque[logging.LogRecord]" = deque(maxlen=capacity)
+        self.max_line = max_line
+        self.setFormatter(logging.Formatter(RECORD_FORMAT, "%H:%M:%S"))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # Handler.handle() already holds self.lock
+        self.records.append(record)
+
+    def lines(self) -> List[str]:
+        with self.lock:
+            records = list(self.records)
+        lines = []
+        for record in records:
+            try:
+                line = self.format(record)
+            except Exception as e:
+                line = f"<unformattable record {record.msg!r}: {e}>"
+            if len(line) > self.max_line:
+                line = line[:self.max_line] + "..."
+            lines.append(line)
+        return lines
+
+
+_buffer: Optional[RingBufferHandler] = None
+_configured = False
+_lock = threading.Lock()
+
+
+def configure(config) -> logging.Logger:
+    """Set up console output and the ring buffer from [Log], once per process"""
+    global _buffer, _configured
+    logger = logging.getLogger(LOGGER_NAME)
+    with _lock:
+        if _configured:
+            return logger
+        console = logging.StreamHandler(sys.stdout)
+        console.setLevel(config.get("Log", "console_level", fallback="INFO").upper())
+        # Same output the scripts printed before
+        console.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(console)
+        capacity = config.getint("Log", "buffer_size", fallback=200)
+        if capacity > 0:
+            _buffer = RingBufferHandler(capacity, config.getint("Log", "max_line", fallback=400))
+            logger.addHandler(_buffer)
+            # Device commands are logged at DEBUG for the buffer only
+            logger.setLevel(logging.DEBUG)
+        else:
+            logger.setLevel(console.level)
+        logger.propagate = False
+        _configured = True
+    return logger
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def recent_lines() -> List[str]:
+    """The buffered records, oldest first; empty when the buffer is off"""
+    return _buffer.lines() if _buffer is not None else []
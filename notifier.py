@@ -0,0 +1,264 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from log_buffer import get_logger, recent_lines
+from tracing import span
+
+
+log = get_logger("notifier")
+
+# Order in which transports are tried when nothing is known yet
+TRANSPORTS = ("starttls", "ssl")
+
+
+def _is_harmless_close(e: Exception) -> bool:
+    """QQ mail drops the connection right after accepting a message; that is a success"""
+    smtp_code = getattr(e, "smtp_code", None)
+    if smtp_code is not None:
+        return (smtp_code in [250, 221] or
+                "successful" in str(e).lower() or
+                str(smtp_code) == "-1" or
+                b'\x00\x00\x00' in str(e).encode('utf-8', errors='ignore'))
+    return ("b'\\x00\\x00\\x00'" in str(e) or
+            "(-1, b'\\x00\\x00\\x00')" in str(e))
+
+
+class Notifier:
+    """Sends error emails from a background thread
+
+    notify() only queues the message, so the automation flow never waits
+    on SMTP. Messages arriving within coalesce_window seconds of each other
+    are merged into one digest (identical ones are counted, not repeated).
+    The in-memory log (log_buffer) as it was when the first failure was
+    reported is attached, so a failed run can be diagnosed from the email.
+    One authenticated SMTP session is kept for the whole run, and the
+    transport that worked last time is remembered in transport_cache_file
+    and tried first.
+    """
+
+    def __init__(self, config, subject: str = "MAA Task Failed", heading: str = "Task execution failed",
+                 coalesce_window: Optional[float] = None, smtp_factory: Optional[Callable] = None,
+                 log_tail: Optional[Callable[[], List[str]]] = recent_lines):
+        self.config = config
+        self.subject = subject
+        self.heading = heading
+        self.coalesce_window = (coalesce_window if coalesce_window is not None
+                                else config.getfloat("Email", "coalesce_window", fallback=2.0))
+        self.transport_cache_file = config.get("Email", "transport_cache_file", fallback="smtp_transport.txt")
+        self.security = config.get("Email", "smtp_security", fallback="auto")
+        self._smtp_factory = smtp_factory
+        self._log_tail = log_tail if config.getboolean("Log", "attach_to_email", fallback=True) else None
+        self._server = None
+        self._transport: Optional[str] = None
+        self._queue: "queue.Queue[Optional[Tuple[str, List[str]]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.sent_count = 0
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    def notify(self, message: str) -> None:
+        """Queue a failure message; returns immediately"""
+        # Taken now: by the time the digest is sent the log has moved on
+        log_lines = self._log_tail() if self._log_tail is not None else []
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="notifier", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        self._queue.put((message, log_lines))
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Send whatever is queued, then end the SMTP session"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+    # ------------------------------------------------------------------
+    # Worker
+    # ------------------------------------------------------------------
+    def _worker(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            message, log_lines = item
+            # Collect everything that arrives within the window into one digest
+            pending = OrderedDict([(message, 1)])
+            deadline = time.monotonic() + self.coalesce_window
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    more = self._queue.get(timeout=max(remaining, 0)) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    stopping = True
+                    break
+                pending[more[0]] = pending.get(more[0], 0) + 1
+            self._send_digest(pending, log_lines)
+        self._quit()
+
+    def _build_message(self, pending: "OrderedDict[str, int]", log_lines: Optional[List[str]] = None):
+        from email.header import Header
+        from email.mime.text import MIMEText
+
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        subject = f"{self.subject} - {current_time}"
+        details: List[str] = []
+        for message, count in pending.items():
+            details.append(message if count == 1 else f"{message} (x{count})")
+        if len(details) == 1:
+            body = details[0]
+        else:
+            body = "\n\n".join(f"- {detail}" for detail in details)
+        content = f"""
+        {self.heading} at {current_time}
+
+        Error details:
+        {body}
+        """
+        if log_lines:
+            content += f"\nRecent log ({len(log_lines)} lines, oldest first):\n" + "\n".join(log_lines) + "\n"
+
+        msg = MIMEText(content, "plain", "utf-8")
+        msg["Subject"] = Header(subject, "utf-8")
+        msg["From"] = self.config["Email"]["sender"]
+        msg["To"] = self.config["Email"]["receiver"]
+        return msg
+
+    def _send_digest(self, pending: "OrderedDict[str, int]", log_lines: Optional[List[str]] = None) -> None:
+        try:
+            msg = self._build_message(pending, log_lines)
+        except Exception as e:
+            log.error(f"Failed to send error email: {e}")
+            return
+
+        sender = self.config["Email"]["sender"]
+        receiver = self.config["Email"]["receiver"]
+        last_error = None
+        for transport in self._transport_order():
+            reused = self._server is not None and self._transport == transport
+            error = self._try_send(transport, sender, receiver, msg)
+            if error is not None and reused:
+                # The kept-open session may have timed out; reconnect once
+                error = self._try_send(transport, sender, receiver, msg)
+            if error is None:
+                self.sent_count += 1
+                log.info(f"Error notification email sent successfully ({transport.upper()})")
+                return
+            last_error = error
+            log.warning(f"{transport.upper()} method failed: {error}")
+        if last_error:
+            log.error(f"Failed to send error email: {last_error}")
+
+    def _try_send(self, transport: str, sender: str, receiver: str, msg) -> Optional[Exception]:
+        """Send msg over transport; return the error, or None on success"""
+        with span("smtp.send", "smtp", transport=transport, reused=self._server is not None) as step:
+            try:
+                server = self._session(transport)
+                server.sendmail(sender, [receiver], msg.as_string())
+            except Exception as e:
+                if not _is_harmless_close(e):
+                    self._drop_session()
+                    step.set(ok=False, error=str(e))
+                    return e
+                # The server hung up after accepting the message
+                self._server = None
+            step.set(ok=True)
+        self._remember(transport)
+        return None
+
+    # ------------------------------------------------------------------
+    # SMTP session handling
+    # ------------------------------------------------------------------
+    def _transport_order(self) -> List[str]:
+        if self.security != "auto":
+            return [self.security]
+        order = list(TRANSPORTS)
+        preferred = self._transport or self._load_remembered()
+        if preferred in order:
+            order.remove(preferred)
+            order.insert(0, preferred)
+        return order
+
+    def _load_remembered(self) -> Optional[str]:
+        try:
+            with open(self.transport_cache_file, 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _remember(self, transport: str) -> None:
+        if transport == self._load_remembered():
+            return
+        try:
+            tmp_file = self.transport_cache_file + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(transport)
+            os.replace(tmp_file, self.transport_cache_file)
+        except OSError as e:
+            log.warning(f"Could not remember SMTP transport: {e}")
+
+    def _session(self, transport: str):
+        """Return an authenticated SMTP session for transport, opening it if needed"""
+        if self._server is not None and self._transport == transport:
+            return self._server
+        self._drop_session()
+        if self._smtp_factory is not None:
+            server = self._smtp_factory(transport)
+        else:
+            server = self._connect(transport)
+        self._server = server
+        self._transport = transport
+        return server
+
+    def _connect(self, transport: str):
+        import smtplib
+        import ssl
+
+        smtp_server = self.config["Email"]["smtp_server"]
+        smtp_port = int(self.config["Email"]["smtp_port"])
+        sender = self.config["Email"]["sender"]
+        password = self.config["Email"]["password"]
+        timeout = self.config.getfloat("Email", "smtp_timeout", fallback=15.0)
+
+        if transport == "ssl":
+            context = ssl.create_default_context()
+            server = smtplib.SMTP_SSL(smtp_server, 465, context=context, timeout=timeout)
+        else:
+            server = smtplib.SMTP(smtp_server, smtp_port, timeout=timeout)
+            if transport == "starttls":
+                server.starttls(context=ssl.create_default_context())
+        # "plain" is meant for local SMTP stand-ins and relays without auth
+        if transport != "plain" or password:
+            server.login(sender, password)
+        return server
+
+    def _drop_session(self) -> None:
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _quit(self) -> None:
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                # Includes QQ mail's connection close quirk
+                pass
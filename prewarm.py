@@ -0,0 +1,192 @@
+import argparse
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from adb_client import AdbClient, AdbError
+from adb_connection import AdbConnectionManager
+from app_config import load_config
+from app_launcher import AppLauncher
+from device_config import DeviceConfig, load_devices
+from device_lease import DeviceLease, LeaseTimeout
+from keyguard_probe import KeyguardProbe
+from log_buffer import configure as configure_logging, get_logger
+from resolution_manager import ResolutionManager
+from tracing import configure as configure_tracing, traced
+
+log = get_logger("prewarm")
+
+
+def parse_schedule(value: str) -> List[Tuple[int, int]]:
+    """Parse "07:00, 19:30" into sorted (hour, minute) pairs"""
+    times = []
+    for item in value.replace(";", ",").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            parsed = datetime.strptime(item, "%H:%M")
+        except ValueError:
+            raise ValueError(f"Bad [Prewarm] schedule entry {item!r}, expected HH:MM")
+        times.append((parsed.hour, parsed.minute))
+    return sorted(set(times))
+
+
+def next_task_time(schedule: List[Tuple[int, int]], now: datetime) -> datetime:
+    """The first scheduled task time after now"""
+    for day in range(2):
+        date = (now + timedelta(days=day)).date()
+        for hour, minute in schedule:
+            candidate = datetime.combine(date, datetime.min.time()).replace(hour=hour, minute=minute)
+            if candidate > now:
+                return candidate
+    raise ValueError("empty schedule")
+
+
+class Prewarmer:
+    """Readies one device ahead of a scheduled task
+
+    Everything the unlock hook would otherwise do on the critical path
+    before touching the screen is done here: the Wi-Fi adb transport is
+    connected (and kept busy until the task starts), the display state is
+    snapshotted, and the keyguard probe choice and launcher activity are
+    detected and stored in the state store for the hooks to reuse. It
+    holds the device lease meanwhile, so it cannot overlap a hook.
+    """
+
+    def __init__(self, config, device: DeviceConfig, adb: Optional[AdbClient] = None,
+                 resolution_manager: Optional[ResolutionManager] = None,
+                 app_launcher: Optional[AppLauncher] = None):
+        self.config = config
+        self.device = device
+        self.adb = adb or AdbClient.from_config(config, serial=device.serial)
+        self.connection_manager = AdbConnectionManager.from_config(config, self.adb, device.device_ip,
+                                                                   device.serial_number)
+        self.resolution_manager = resolution_manager or ResolutionManager(adb=self.adb, device=device, config=config)
+        self.app_launcher = app_launcher or AppLauncher(self.adb, self.resolution_manager.store)
+
+    @traced("prewarm")
+    def prewarm(self) -> bool:
+        """Connect and fill every cache; returns False if the device is unusable"""
+        # A lock hook still running would change the display state under the snapshot
+        lease = DeviceLease.from_config(self.config, self.device.serial, "prewarm", store=self.resolution_manager.store)
+        try:
+            return lease.run(self._prewarm)
+        except LeaseTimeout as e:
+            log.error(f"Pre-warm of {self.device.name} skipped: {e}")
+            return False
+
+    def _prewarm(self) -> bool:
+        log.info(f"Pre-warming {self.device.name} ({self.device.device_ip})")
+        try:
+            state = self.connection_manager.ensure_device()
+            if state != "device":
+                log.error(f"Device {self.device.device_ip} not ready for pre-warm: {state}")
+                return False
+
+            display = self.resolution_manager.snapshot_display_state()
+            log.info(f"Display state snapshot: {display}")
+
+            name, style = KeyguardProbe(self.adb, self.resolution_manager.store).refresh()
+            log.info(f"Keyguard probe: {name} ({style} markers)")
+
+            package = self.device.package_name
+            version_code = self.app_launcher.version_code(package) if package else None
+            if version_code:
+                component = self.app_launcher.launcher_activity(package, version_code)
+                log.info(f"Launcher activity: {component}")
+            elif package:
+                log.info(f"{package} is not installed, nothing to resolve")
+            return True
+        except AdbError as e:
+            log.error(f"Pre-warm of {self.device.name} failed: {e}")
+            return False
+
+    def keep_alive(self, until: float, interval: float = 30.0) -> None:
+        """Exercise the transport until the task starts so Wi-Fi adb does not go idle"""
+        while True:
+            remaining = until - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(interval, remaining))
+            try:
+                self.adb.shell("true")
+            except AdbError as e:
+                log.warning(f"Keep-alive for {self.device.name} failed ({e}), reconnecting...")
+                try:
+                    self.connection_manager.ensure_device()
+                except AdbError as e2:
+                    log.error(f"Reconnect of {self.device.name} failed: {e2}")
+
+
+def prewarm_devices(config, devices: List[DeviceConfig], keep_alive_until: Optional[float] = None) -> bool:
+    """Pre-warm every device in parallel, then keep them alive until keep_alive_until"""
+    interval = config.getfloat("Prewarm", "keepalive_interval", fallback=30.0)
+    results = {}
+
+    def run(device: DeviceConfig) -> None:
+        prewarmer = Prewarmer(config, device)
+        results[device.name] = prewarmer.prewarm()
+        if results[device.name] and keep_alive_until is not None:
+            prewarmer.keep_alive(keep_alive_until, interval)
+
+    threads = [threading.Thread(target=run, args=(device,), name=f"prewarm-{device.name}") for device in devices]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return all(results.get(device.name) for device in devices)
+
+
+def run_schedule(config, devices: List[DeviceConfig]) -> int:
+    """Pre-warm lead_time seconds before every task in [Prewarm] schedule, forever"""
+    schedule = parse_schedule(config.get("Prewarm", "schedule", fallback=""))
+    if not schedule:
+        log.error("No [Prewarm] schedule configured")
+        return 1
+    lead_time = config.getfloat("Prewarm", "lead_time", fallback=120.0)
+    # Keep the transport up a little past the task start, while the hook runs
+    linger = config.getfloat("Prewarm", "keepalive_after", fallback=60.0)
+    log.info(f"Pre-warm schedule: {', '.join(f'{h:02d}:{m:02d}' for h, m in schedule)} (lead {lead_time:.0f}s)")
+
+    while True:
+        task = next_task_time(schedule, datetime.now())
+        start = task - timedelta(seconds=lead_time)
+        wait = (start - datetime.now()).total_seconds()
+        if wait > 0:
+            log.info(f"Next task at {task:%Y-%m-%d %H:%M}, pre-warming at {start:%H:%M:%S}")
+            time.sleep(wait)
+        prewarm_devices(config, devices, keep_alive_until=task.timestamp() + linger)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Ready the devices shortly before scheduled MAA tasks")
+    parser.add_argument("--once", action="store_true", help="Pre-warm now instead of following the schedule")
+    parser.add_argument("--keep-alive", type=float, default=0.0, metavar="SECONDS",
+                        help="With --once, keep the transport alive this long afterwards")
+    parser.add_argument("--device", action="append", dest="names", help="Only these device names")
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    configure_logging(config)
+    configure_tracing(config)
+    devices = load_devices(config)
+    if args.names:
+        devices = [device for device in devices if device.name in args.names]
+    if not devices:
+        log.error("No matching devices configured")
+        return 1
+
+    if args.once:
+        until = time.time() + args.keep_alive if args.keep_alive > 0 else None
+        return 0 if prewarm_devices(config, devices, keep_alive_until=until) else 1
+    try:
+        return run_schedule(config, devices)
+    except KeyboardInterrupt:
+        print("\nPre-warm scheduler stopped by user")
+        return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
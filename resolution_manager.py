@@ -1,176 +1,378 @@
-import subprocess
 import os
+import re
+import time
 import configparser
-from typing import Optional, Tuple
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from adb_client import AdbClient, AdbError
+from app_config import load_config
+from device_config import DeviceConfig
+from log_buffer import configure as configure_logging, get_logger
+from retry_policy import RetryPolicy
+from state_store import DEFAULT_SERIAL, RUN_ID, StateStore
+from tracing import TRACER, configure as configure_tracing, traced
+from waiting import wait_until
+
+
+# Fetches size and density in a single round-trip
+DISPLAY_STATE_COMMAND = "wm size; wm density"
+
+_SIZE_LINE = re.compile(r"^\s*(Physical|Override) size:\s*(\d+x\d+)", re.MULTILINE)
+_DENSITY_LINE = re.compile(r"^\s*(Physical|Override) density:\s*(\d+)", re.MULTILINE)
+_ANY_SIZE = re.compile(r"\b\d+x\d+\b")
+
+log = get_logger("resolution")
+
+
+class DisplayState:
+    """Display size and density as reported by wm; overrides win over physical values"""
+
+    def __init__(self, physical_size: Optional[str] = None, override_size: Optional[str] = None,
+                 physical_density: Optional[int] = None, override_density: Optional[int] = None):
+        self.physical_size = physical_size
+        self.override_size = override_size
+        self.physical_density = physical_density
+        self.override_density = override_density
+
+    @property
+    def size(self) -> Optional[str]:
+        """The size the display is actually using"""
+        return self.override_size or self.physical_size
+
+    @property
+    def density(self) -> Optional[int]:
+        return self.override_density or self.physical_density
+
+    @classmethod
+    def parse(cls, output: str) -> "DisplayState":
+        state = cls()
+        for kind, size in _SIZE_LINE.findall(output):
+            if kind == "Physical":
+                state.physical_size = size
+            else:
+                state.override_size = size
+        for kind, density in _DENSITY_LINE.findall(output):
+            if kind == "Physical":
+                state.physical_density = int(density)
+            else:
+                state.override_density = int(density)
+        if state.size is None:
+            # Unknown vendor format: take the first WxH token
+            match = _ANY_SIZE.search(output)
+            if match:
+                state.physical_size = match.group(0)
+        return state
+
+    def __repr__(self) -> str:
+        return (f"DisplayState(size={self.size}, physical={self.physical_size}, "
+                f"override={self.override_size}, density={self.density})")
 
 
 class ResolutionManager:
     """Manages screen resolution for ADB operations"""
     
-    def __init__(self, config_file: str = "config.ini"):
-        self.config = configparser.ConfigParser()
-        self.config.read(config_file, encoding='utf-8')
+    def __init__(self, config_file: str = "config.ini", adb: Optional[AdbClient] = None,
+                 device: Optional[DeviceConfig] = None, store: Optional[StateStore] = None,
+                 config: Optional[configparser.ConfigParser] = None):
+        # Shared parse of config_file unless the caller already has one
+        self.config = config if config is not None else load_config(config_file)
+        # Commands go to device's serial when a device is given, else to adb's default device
+        self.adb = adb or AdbClient.from_config(self.config, serial=device.serial if device else None)
         
         # Get configuration values
-        self.unlock_resolution = self.config.get("Resolution", "unlock_resolution", fallback="720x1280")
-        self.lock_resolution = self.config.get("Resolution", "lock_resolution", fallback="1080x2400")
-        self.save_original = self.config.getboolean("Resolution", "save_original_resolution", fallback=True)
-        self.original_file = self.config.get("Resolution", "original_resolution_file", fallback="original_resolution.txt")
+        if device is not None:
+            self.unlock_resolution = device.unlock_resolution
+            self.lock_resolution = device.lock_resolution
+            self.save_original = device.save_original_resolution
+            self.original_file = device.original_resolution_file
+        else:
+            self.unlock_resolution = self.config.get("Resolution", "unlock_resolution", fallback="720x1280")
+            self.lock_resolution = self.config.get("Resolution", "lock_resolution", fallback="1080x2400")
+            self.save_original = self.config.getboolean("Resolution", "save_original_resolution", fallback=True)
+            self.original_file = self.config.get("Resolution", "original_resolution_file", fallback="original_resolution.txt")
+        self.apply_timeout = self.config.getfloat("Timing", "resolution_timeout", fallback=3.0)
+        # wm writes that fail or don't show up within apply_timeout are retried
+        self.retry = RetryPolicy.from_config(self.config, "resolution")
+        self.store = store or StateStore.from_config(self.config)
+        # How old a display snapshot taken by prewarm.py may be and still be trusted
+        self.snapshot_max_age = self.config.getfloat("Prewarm", "snapshot_max_age", fallback=300.0)
+        self._display_state: Optional[DisplayState] = None
+        if not TRACER.enabled:
+            # Used on its own, not from one of the scripts that already set it up
+            configure_tracing(self.config)
+        # No-op once a script has set up logging
+        configure_logging(self.config)
+
+    @property
+    def serial(self) -> str:
+        """Key for this device in the state store"""
+        return self.adb.serial or DEFAULT_SERIAL
     
-    def get_current_resolution(self) -> Optional[str]:
-        """Get current screen resolution from device"""
+    def get_display_state(self, refresh: bool = False) -> Optional[DisplayState]:
+        """Get size and density from the device, cached until the next write"""
+        if self._display_state is not None and not refresh:
+            return self._display_state
+        if not refresh:
+            state = self._load_snapshot()
+            if state is not None:
+                return state
         try:
-            result = subprocess.run(
-                "adb shell wm size",
-                shell=True,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            
-            # Parse output like "Physical size: 1080x2400"
-            output = result.stdout.strip()
-            if "Physical size:" in output:
-                resolution = output.split("Physical size:")[-1].strip()
-                print(f"Current resolution: {resolution}")
-                return resolution
-            elif "Override size:" in output:
-                # If there's an override, get that instead
-                lines = output.split('\n')
-                for line in lines:
-                    if "Override size:" in line:
-                        resolution = line.split("Override size:")[-1].strip()
-                        print(f"Current override resolution: {resolution}")
-                        return resolution
-            else:
-                # Try to extract resolution from any format
-                words = output.split()
-                for word in words:
-                    if 'x' in word and word.replace('x', '').replace('0', '').replace('1', '').replace('2', '').replace('3', '').replace('4', '').replace('5', '').replace('6', '').replace('7', '').replace('8', '').replace('9', '') == '':
-                        print(f"Extracted resolution: {word}")
-                        return word
-                        
-            print(f"Could not parse resolution from: {output}")
+            result = self.adb.shell(DISPLAY_STATE_COMMAND)
+            if not result.ok:
+                raise AdbError(f"wm size exited with {result.returncode}: {result.text.strip()}")
+        except AdbError as e:
+            log.error(f"Error getting display state: {e}")
             return None
-            
-        except subprocess.CalledProcessError as e:
-            print(f"Error getting current resolution: {e}")
+
+        state = DisplayState.parse(result.text)
+        if state.size is None:
+            log.warning(f"Could not parse resolution from: {result.text.strip()}")
+            return None
+        self._display_state = state
+        return state
+
+    def invalidate_display_state(self) -> None:
+        """Forget the cached display state, e.g. after something else changed it"""
+        self._display_state = None
+        # The display may have changed since any snapshot, so nobody may reuse it
+        try:
+            if self.store.get_field(self.serial, "display_snapshot") is not None:
+                self.store.clear(self.serial, "display_snapshot")
+        except OSError as e:
+            log.warning(f"Could not drop display snapshot: {e}")
+
+    def snapshot_display_state(self) -> Optional[DisplayState]:
+        """Read the display state now and keep it for the next run (prewarm.py)"""
+        state = self.get_display_state(refresh=True)
+        if state is not None:
+            self.store.record(self.serial, display_snapshot={
+                "physical_size": state.physical_size,
+                "override_size": state.override_size,
+                "physical_density": state.physical_density,
+                "override_density": state.override_density,
+                "taken_at": time.time(),
+            })
+        return state
+
+    def _load_snapshot(self) -> Optional[DisplayState]:
+        snapshot = self.store.get_field(self.serial, "display_snapshot")
+        if not isinstance(snapshot, dict):
             return None
+        age = time.time() - snapshot.get("taken_at", 0)
+        if not 0 <= age <= self.snapshot_max_age:
+            return None
+        state = DisplayState(snapshot.get("physical_size"), snapshot.get("override_size"),
+                             snapshot.get("physical_density"), snapshot.get("override_density"))
+        if state.size is None:
+            return None
+        log.info(f"Using display state snapshot from {age:.0f}s ago")
+        self._display_state = state
+        return state
+    
+    def get_current_resolution(self) -> Optional[str]:
+        """Get current screen resolution from device"""
+        state = self.get_display_state()
+        if state is None:
+            return None
+        if state.override_size:
+            log.info(f"Current override resolution: {state.override_size} (physical {state.physical_size})")
+        else:
+            log.info(f"Current resolution: {state.size}")
+        return state.size
     
+    @traced("resolution.save")
     def save_original_resolution(self) -> bool:
-        """Save current resolution to file for later restoration"""
+        """Save current display state to the state store for later restoration"""
         if not self.save_original:
-            print("Original resolution saving is disabled in config")
+            log.info("Original resolution saving is disabled in config")
             return True
             
         current_res = self.get_current_resolution()
-        if current_res:
-            try:
-                with open(self.original_file, 'w', encoding='utf-8') as f:
-                    f.write(current_res)
-                print(f"Original resolution {current_res} saved to {self.original_file}")
-                return True
-            except Exception as e:
-                print(f"Error saving original resolution: {e}")
-                return False
-        else:
-            print("Could not get current resolution to save")
+        if not current_res:
+            log.warning("Could not get current resolution to save")
+            return False
+
+        state = self._display_state
+        try:
+            with self.store.transaction() as data:
+                record = data.setdefault(self.serial, {})
+                # A previous unlock that was never restored already holds the real original;
+                # saving now would record our own unlock resolution instead
+                if record.get("original_pending") and current_res == self.unlock_resolution:
+                    log.info(f"Keeping unrestored original resolution {record.get('original_size')}")
+                    return True
+                record.update(
+                    original_size=current_res,
+                    original_density=state.density if state else None,
+                    original_was_override=bool(state and state.override_size),
+                    original_pending=True,
+                    saved_at=datetime.now().isoformat(timespec="seconds"),
+                    saved_by=RUN_ID,
+                )
+            log.info(f"Original resolution {current_res} saved to {self.store.path}")
+            return True
+        except Exception as e:
+            log.error(f"Error saving original resolution: {e}")
             return False
     
     def load_original_resolution(self) -> Optional[str]:
-        """Load original resolution from file"""
+        """Load original resolution from the state store (or a legacy resolution file)"""
+        try:
+            resolution = self.store.get(self.serial).get("original_size")
+        except Exception as e:
+            log.error(f"Error loading original resolution: {e}")
+            resolution = None
+        if resolution:
+            log.info(f"Loaded original resolution: {resolution}")
+            return resolution
+
+        # Files written by older versions of these scripts
         if not os.path.exists(self.original_file):
-            print(f"Original resolution file {self.original_file} not found")
+            log.warning(f"No original resolution recorded for {self.serial}")
             return None
-            
         try:
             with open(self.original_file, 'r', encoding='utf-8') as f:
                 resolution = f.read().strip()
-                print(f"Loaded original resolution: {resolution}")
+                log.info(f"Loaded original resolution: {resolution}")
                 return resolution
         except Exception as e:
-            print(f"Error loading original resolution: {e}")
+            log.error(f"Error loading original resolution: {e}")
             return None
     
+    @traced("resolution.wait")
+    def _wait_for_size(self, resolution: str) -> bool:
+        """Move on as soon as the window manager reports the new size"""
+        def applied() -> bool:
+            state = self.get_display_state(refresh=True)
+            return state is not None and state.size == resolution
+
+        if wait_until(applied, timeout=self.apply_timeout):
+            return True
+        log.warning(f"Device did not report {resolution} within {self.apply_timeout}s")
+        return False
+
+    def _apply(self, command: str, expected: Optional[str]) -> None:
+        """Run a wm write and wait for expected, retrying both per [Retry:resolution]"""
+        def attempt() -> bool:
+            result = self.adb.shell(command)
+            self.invalidate_display_state()
+            if not result.ok:
+                raise AdbError(f"{command} exited with {result.returncode}: {result.text.strip()}")
+            return expected is None or self._wait_for_size(expected)
+
+        self.retry.call(attempt, retry_if=lambda applied: not applied, description=command)
+
+    @traced("resolution.set")
     def set_resolution(self, resolution: str) -> bool:
-        """Set screen resolution"""
+        """Set screen resolution (no-op if the display already uses it)"""
+        state = self.get_display_state()
+        if state is not None and state.size == resolution:
+            log.info(f"Resolution already {resolution}, nothing to change")
+            return True
+        if state is not None and resolution == state.physical_size:
+            # Same as the panel's native size: drop the override instead of pinning one
+            return self.reset_resolution()
         try:
-            cmd = f"adb shell wm size {resolution}"
-            subprocess.run(cmd, shell=True, check=True)
-            print(f"Resolution set to: {resolution}")
+            self._apply(f"wm size {resolution}", resolution)
+            log.info(f"Resolution set to: {resolution}")
             return True
-        except subprocess.CalledProcessError as e:
-            print(f"Error setting resolution to {resolution}: {e}")
+        except AdbError as e:
+            self.invalidate_display_state()
+            log.error(f"Error setting resolution to {resolution}: {e}")
             return False
     
+    @traced("resolution.reset")
     def reset_resolution(self) -> bool:
         """Reset resolution to device default"""
+        state = self.get_display_state()
+        if state is not None and state.override_size is None:
+            log.info("Resolution already at device default")
+            return True
         try:
-            subprocess.run("adb shell wm size reset", shell=True, check=True)
-            print("Resolution reset to device default")
+            self._apply("wm size reset", state.physical_size if state is not None else None)
+            log.info("Resolution reset to device default")
             return True
-        except subprocess.CalledProcessError as e:
-            print(f"Error resetting resolution: {e}")
+        except AdbError as e:
+            self.invalidate_display_state()
+            log.error(f"Error resetting resolution: {e}")
             return False
     
     def set_unlock_resolution(self) -> bool:
         """Set resolution for unlock operation"""
-        print(f"Setting unlock resolution: {self.unlock_resolution}")
+        log.info(f"Setting unlock resolution: {self.unlock_resolution}")
         return self.set_resolution(self.unlock_resolution)
     
     def set_lock_resolution(self) -> bool:
         """Set resolution for lock operation"""
-        print(f"Setting lock resolution: {self.lock_resolution}")
+        log.info(f"Setting lock resolution: {self.lock_resolution}")
         return self.set_resolution(self.lock_resolution)
     
+    @traced("resolution.restore")
     def restore_original_resolution(self) -> bool:
         """Restore the original resolution from saved file"""
         if not self.save_original:
-            print("Original resolution restoration is disabled in config")
+            log.info("Original resolution restoration is disabled in config")
             # Fallback to configured lock resolution
             return self.set_lock_resolution()
             
         original_res = self.load_original_resolution()
         if original_res:
-            return self.set_resolution(original_res)
+            restored = self.set_resolution(original_res)
+            if restored:
+                self.store.record(self.serial, original_pending=False)
+            return restored
         else:
-            print("Could not load original resolution, using configured lock resolution")
+            log.warning("Could not load original resolution, using configured lock resolution")
             return self.set_lock_resolution()
     
     def cleanup_resolution_file(self) -> bool:
-        """Remove the original resolution file"""
+        """Forget the saved original resolution (state store entry and legacy file)"""
         try:
+            self.store.clear(self.serial, "original_size", "original_density", "original_was_override",
+                             "original_pending", "saved_at", "saved_by")
             if os.path.exists(self.original_file):
                 os.remove(self.original_file)
-                print(f"Cleaned up resolution file: {self.original_file}")
+                log.info(f"Cleaned up resolution file: {self.original_file}")
             return True
         except Exception as e:
-            print(f"Error cleaning up resolution file: {e}")
+            log.error(f"Error cleaning up resolution file: {e}")
             return False
 
 
+# One manager per config file, shared by the convenience functions below
+_managers: Dict[str, ResolutionManager] = {}
+
+
+def _shared_manager(config_file: str) -> ResolutionManager:
+    manager = _managers.get(config_file)
+    if manager is None:
+        manager = _managers[config_file] = ResolutionManager(config_file)
+    return manager
+
+
 # Convenience functions for backward compatibility
 def save_current_resolution(config_file: str = "config.ini") -> bool:
     """Save current resolution (convenience function)"""
-    manager = ResolutionManager(config_file)
+    manager = _shared_manager(config_file)
     return manager.save_original_resolution()
 
 
 def restore_original_resolution(config_file: str = "config.ini") -> bool:
     """Restore original resolution (convenience function)"""
-    manager = ResolutionManager(config_file)
+    manager = _shared_manager(config_file)
     return manager.restore_original_resolution()
 
 
 def set_unlock_resolution(config_file: str = "config.ini") -> bool:
     """Set unlock resolution (convenience function)"""
-    manager = ResolutionManager(config_file)
+    manager = _shared_manager(config_file)
     return manager.set_unlock_resolution()
 
 
 def set_lock_resolution(config_file: str = "config.ini") -> bool:
     """Set lock resolution (convenience function)"""
-    manager = ResolutionManager(config_file)
+    manager = _shared_manager(config_file)
     return manager.set_lock_resolution()
 
 
@@ -0,0 +1,181 @@
+import random
+import time
+from typing import Any, Callable, Iterator, Optional, Tuple, Type
+
+from adb_client import AdbError
+from log_buffer import get_logger
+from state_store import StateStore
+
+log = get_logger("retry")
+
+
+RETRY_SECTION = "Retry"
+RETRY_SECTION_PREFIX = "Retry:"
+
+# Built-in settings per operation; [Retry] and then [Retry:<operation>] override them
+DEFAULTS = {
+    # adb connect plus waiting for the device to show up
+    "connect": dict(attempts=3, initial_delay=1.0, max_delay=8.0, deadline=30.0),
+    # Opening a device service (the command has not run yet when this fails)
+    "shell": dict(attempts=3, initial_delay=0.2, max_delay=2.0, deadline=10.0),
+    # Retyping the PIN when the device still reports the keyguard
+    "unlock": dict(attempts=2, initial_delay=0.5, max_delay=2.0, deadline=None),
+    # wm size writes that fail or do not take effect
+    "resolution": dict(attempts=2, initial_delay=0.5, max_delay=2.0, deadline=None),
+}
+_FALLBACK = dict(attempts=3, initial_delay=0.5, max_delay=5.0, deadline=None)
+
+
+class RetryPolicy:
+    """How often, how patiently and for how long to retry one kind of operation
+
+    Delays grow exponentially from initial_delay by multiplier up to
+    max_delay, each randomised by +/- jitter so that several devices that
+    failed together do not retry in lockstep. No retry starts after
+    deadline seconds from the first attempt.
+    """
+
+    def __init__(self, name: str, attempts: int = 3, initial_delay: float = 0.5, max_delay: float = 5.0,
+                 multiplier: float = 2.0, jitter: float = 0.1, deadline: Optional[float] = None):
+        self.name = name
+        self.attempts = max(1, attempts)
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+
+    @classmethod
+    def from_config(cls, config, name: str) -> "RetryPolicy":
+        """Read the policy for name from [Retry:<name>], then [Retry], then DEFAULTS"""
+        defaults = DEFAULTS.get(name, _FALLBACK)
+        sections = [section for section in (RETRY_SECTION_PREFIX + name, RETRY_SECTION) if config.has_section(section)]
+
+        def get(key: str, fallback, convert):
+            for section in sections:
+                if config.has_option(section, key):
+                    return convert(config.get(section, key))
+            return fallback
+
+        deadline = get("deadline", defaults["deadline"], lambda v: float(v) if v.strip() else None)
+        return cls(
+            name,
+            attempts=get("attempts", defaults["attempts"], int),
+            initial_delay=get("initial_delay", defaults["initial_delay"], float),
+            max_delay=get("max_delay", defaults["max_delay"], float),
+            multiplier=get("multiplier", 2.0, float),
+            jitter=get("jitter", 0.1, float),
+            deadline=deadline if deadline else None,
+        )
+
+    @classmethod
+    def once(cls, name: str = "once") -> "RetryPolicy":
+        """A policy that never retries"""
+        return cls(name, attempts=1)
+
+    def delays(self) -> Iterator[float]:
+        """Yield the pause before each retry, stopping when attempts or deadline run out"""
+        start = time.monotonic()
+        delay = self.initial_delay
+        for _ in range(self.attempts - 1):
+            pause = delay * random.uniform(1 - self.jitter, 1 + self.jitter) if self.jitter else delay
+            if self.deadline is not None and time.monotonic() + pause - start > self.deadline:
+                return
+            yield pause
+            delay = min(delay * self.multiplier, self.max_delay)
+
+    def call(self, function: Callable[[], Any], retry_on: Tuple[Type[BaseException], ...] = (AdbError,),
+             retry_if: Optional[Callable[[Any], bool]] = None, description: Optional[str] = None) -> Any:
+        """Call function until it neither raises retry_on nor returns a value retry_if rejects
+
+        When the attempts run out the last exception is raised again, or the
+        last (rejected) result is returned.
+        """
+        description = description or self.name
+        delays = self.delays()
+        attempt = 1
+        while True:
+            try:
+                result = function()
+                if retry_if is None or not retry_if(result):
+                    return result
+                reason = f"got {result!r}"
+                error: Optional[BaseException] = None
+            except retry_on as e:
+                reason = str(e)
+                error = e
+            pause = next(delays, None)
+            if pause is None:
+                if error is not None:
+                    raise error
+                return result
+            attempt += 1
+            log.warning(f"{description} failed ({reason}), retry {attempt}/{self.attempts} in {pause:.1f}s")
+            time.sleep(pause)
+
+    def __repr__(self) -> str:
+        return (f"RetryPolicy({self.name!r}, attempts={self.attempts}, delay={self.initial_delay}"
+                f"..{self.max_delay}s, deadline={self.deadline})")
+
+
+class CircuitOpenError(AdbError):
+    """Raised instead of trying a device that recently failed too often"""
+
+
+class CircuitBreaker:
+    """Fails fast for a device that stayed unreachable for failure_threshold attempts in a row
+
+    The count lives in the state store, so it carries over between the
+    separate hook runs of a schedule. After open_seconds one attempt is let
+    through again; success closes the circuit, failure keeps it open for
+    another open_seconds.
+    """
+
+    def __init__(self, store: StateStore, serial: str, failure_threshold: int = 5, open_seconds: float = 600.0):
+        self.store = store
+        self.serial = serial
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        # Failure count seen by check(), saves another read on the happy path
+        self._failures: Optional[int] = None
+
+    @classmethod
+    def from_config(cls, config, serial: str, store: Optional[StateStore] = None) -> Optional["CircuitBreaker"]:
+        """Breaker for serial from [Retry]; None when failure_threshold is 0"""
+        threshold = config.getint(RETRY_SECTION, "failure_threshold", fallback=5)
+        if threshold <= 0:
+            return None
+        return cls(store or StateStore.from_config(config), serial, threshold,
+                   config.getfloat(RETRY_SECTION, "open_seconds", fallback=600.0))
+
+    def check(self) -> None:
+        """Raise CircuitOpenError while the circuit is open"""
+        record = self.store.get(self.serial)
+        self._failures = record.get("breaker_failures", 0)
+        opened_at = record.get("breaker_opened_at")
+        if opened_at is None:
+            return
+        remaining = opened_at + self.open_seconds - time.time()
+        if remaining > 0:
+            raise CircuitOpenError(f"{self.serial} failed {self._failures} times in a row, "
+                                   f"not trying again for {remaining:.0f}s")
+        log.info(f"Trying {self.serial} again after {self.open_seconds:.0f}s of failing fast")
+
+    def record_success(self) -> None:
+        failures = self._failures if self._failures is not None else self.store.get_field(self.serial, "breaker_failures")
+        if failures:
+            self.store.clear(self.serial, "breaker_failures", "breaker_opened_at")
+        self._failures = 0
+
+    def record_failure(self) -> bool:
+        """Count a failure; returns True if this one opened the circuit"""
+        with self.store.transaction() as data:
+            record = data.setdefault(self.serial, {})
+            failures = record.get("breaker_failures", 0) + 1
+            record["breaker_failures"] = failures
+            self._failures = failures
+            if failures < self.failure_threshold:
+                return False
+            opened = record.get("breaker_opened_at") is None
+            record["breaker_opened_at"] = time.time()
+        return opened
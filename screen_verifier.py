@@ -0,0 +1,226 @@
+import argparse
+import struct
+from typing import Any, Dict, List, Optional
+
+from adb_client import AdbClient, AdbError
+from log_buffer import get_logger
+from state_store import DEFAULT_SERIAL, StateStore
+from tracing import span
+
+log = get_logger("screen")
+
+
+# States a reference can be recorded for
+SCREEN_STATES = ("lock", "pin", "home")
+
+# Fingerprint grid (rows x columns of averaged cells), portrait or landscape alike
+GRID = (32, 16)
+
+# screencap raw formats with 4 bytes per pixel, red first (RGBA_8888, RGBX_8888)
+_RGBA_FORMATS = (1, 2)
+
+# Average brightness (0..1) below which the screen counts as off
+_DARK = 0.02
+
+_LUMA = (0.299, 0.587, 0.114)
+
+
+def _numpy():
+    """numpy, or None when it is not installed (the verifier is optional)"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class ScreenVerifier:
+    """Tells the lock screen, PIN pad and home screen apart from the framebuffer
+
+    For ROMs whose dumpsys output lacks every keyguard marker. The raw
+    frame (no PNG encoding) is received into a buffer kept between calls
+    and viewed as a numpy array without copying; a sparse sample of it is
+    averaged into a small brightness grid and compared with the grids
+    recorded for this device (python screen_verifier.py record <state>).
+    Once received, classifying a frame takes a few milliseconds.
+    """
+
+    def __init__(self, adb: AdbClient, store: StateStore, threshold: float = 0.08, only: bool = False):
+        self.adb = adb
+        self.store = store
+        self.threshold = threshold
+        # Whether the flows check the screen instead of dumpsys, not only when dumpsys cannot tell
+        self.only = only
+        self.np = _numpy()
+        self._buffer = bytearray()
+        self._references: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_config(cls, config, adb: AdbClient, store: Optional[StateStore] = None) -> Optional["ScreenVerifier"]:
+        """Verifier from [Verify]; None when it is off or numpy is missing"""
+        mode = config.get("Verify", "screen", fallback="fallback").strip().lower()
+        if mode == "off":
+            return None
+        if _numpy() is None:
+            if mode == "only":
+                log.warning("[Verify] screen = only needs numpy (pip install numpy), using dumpsys")
+            return None
+        return cls(adb, store or StateStore.from_config(config),
+                   threshold=config.getfloat("Verify", "threshold", fallback=0.08), only=mode == "only")
+
+    @property
+    def serial(self) -> str:
+        return self.adb.serial or DEFAULT_SERIAL
+
+    # ------------------------------------------------------------------
+    # Frames
+    # ------------------------------------------------------------------
+    def capture(self, size: Optional[str] = None):
+        """The current frame as a (height, width, 4) uint8 array viewing the receive buffer
+
+        size (WxH of the display) presizes the buffer; a wrong guess only
+        costs one more capture. The array is only valid until the next call.
+        """
+        if size:
+            width, height = (int(v) for v in size.split("x"))
+            self._reserve(16 + width * height * 4)
+        with span("screen.capture", serial=self.serial) as step:
+            received = self.adb.exec_out_into("screencap", self._buffer)
+            if received > len(self._buffer):
+                self._reserve(received)
+                received = self.adb.exec_out_into("screencap", self._buffer)
+            step.set(bytes=received)
+        if received < 12 or received > len(self._buffer):
+            raise AdbError(f"screencap returned {received} bytes")
+        width, height, pixel_format = struct.unpack_from("<III", self._buffer)
+        pixels = width * height * 4
+        # Android 9+ adds a color space word to the 12-byte header
+        header = received - pixels
+        if header not in (12, 16):
+            raise AdbError(f"Unexpected screencap output: {received} bytes for {width}x{height}")
+        if pixel_format not in _RGBA_FORMATS:
+            raise AdbError(f"Unsupported screencap pixel format {pixel_format}")
+        return self.np.frombuffer(self._buffer, dtype=self.np.uint8, count=pixels,
+                                  offset=header).reshape(height, width, 4)
+
+    def _reserve(self, size: int) -> None:
+        if len(self._buffer) < size:
+            # A new buffer: arrays from the previous capture may still view the old one
+            self._buffer = bytearray(size)
+
+    def fingerprint(self, frame):
+        """Average brightness (0..1) of each GRID cell, from about 4x4 samples per cell"""
+        np = self.np
+        rows, columns = GRID
+        height, width = frame.shape[:2]
+        step = max(1, min(height // (rows * 4), width // (columns * 4)))
+        sample = frame[::step, ::step, :3]
+        height, width = sample.shape[0] // rows * rows, sample.shape[1] // columns * columns
+        cells = sample[:height, :width].reshape(rows, height // rows, columns, width // columns, 3)
+        return cells.mean(axis=(1, 3), dtype=np.float32) @ np.array(_LUMA, dtype=np.float32) / 255
+
+    # ------------------------------------------------------------------
+    # References
+    # ------------------------------------------------------------------
+    @property
+    def references(self) -> Dict[str, Any]:
+        if self._references is None:
+            stored = self.store.get_field(self.serial, "screen_fingerprints") or {}
+            self._references = {state: self.np.array(grid, dtype=self.np.float32)
+                                 for state, grid in stored.items()
+                                 if state in SCREEN_STATES and self.np.shape(grid) == GRID}
+        return self._references
+
+    def record(self, state: str, size: Optional[str] = None) -> None:
+        """Keep the current screen as the reference for state"""
+        if state not in SCREEN_STATES:
+            raise ValueError(f"unknown screen state {state!r}, use one of: {', '.join(SCREEN_STATES)}")
+        grid = self.fingerprint(self.capture(size))
+        with self.store.transaction() as data:
+            stored = data.setdefault(self.serial, {}).setdefault("screen_fingerprints", {})
+            stored[state] = [[round(float(v), 3) for v in row] for row in grid]
+        self._references = None
+
+    # ------------------------------------------------------------------
+    # Classification
+    # ------------------------------------------------------------------
+    def distances(self, grid) -> Dict[str, float]:
+        return {state: float(self.np.abs(grid - reference).mean()) for state, reference in self.references.items()}
+
+    def classify(self, size: Optional[str] = None) -> Optional[str]:
+        """The recorded state the screen matches, "off", "other" (none matches) or None (nothing recorded)"""
+        if not self.references:
+            return None
+        with span("screen.classify", serial=self.serial) as step:
+            grid = self.fingerprint(self.capture(size))
+            if float(grid.mean()) < _DARK:
+                state = "off"
+            else:
+                distances = self.distances(grid)
+                nearest = min(distances, key=distances.get)
+                state = nearest if distances[nearest] <= self.threshold else "other"
+                step.set(distance=round(distances[nearest], 4))
+            step.set(state=state)
+        log.debug("screen of %s looks like: %s", self.serial, state)
+        return state
+
+    def unlocked(self, size: Optional[str] = None) -> Optional[bool]:
+        """Whether the screen shows neither the lock screen nor the PIN pad; None if it cannot tell
+
+        Needs the lock screen or PIN pad reference: "other" is only
+        trusted as unlocked (an app in front) when both are recorded.
+        """
+        try:
+            state = self.classify(size)
+        except AdbError as e:
+            log.warning(f"Screen check failed: {e}")
+            return None
+        if state == "home":
+            return True
+        if state in ("lock", "pin", "off"):
+            return False
+        if state == "other" and {"lock", "pin"} <= set(self.references):
+            return True
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from app_config import load_config
+    from device_config import load_devices
+
+    parser = argparse.ArgumentParser(description="Record and check the screen references used to verify unlocking")
+    parser.add_argument("action", choices=("record", "classify"))
+    parser.add_argument("state", nargs="?", choices=SCREEN_STATES, help="With record: what the screen shows now")
+    parser.add_argument("--device", help="Device name, when several are configured")
+    args = parser.parse_args(argv)
+    if args.action == "record" and args.state is None:
+        parser.error("record needs the state the screen shows now")
+
+    if _numpy() is None:
+        print("numpy is required: pip install numpy")
+        return 1
+    config = load_config()
+    devices = [device for device in load_devices(config) if args.device in (None, device.name)]
+    if len(devices) != 1:
+        print(f"Pass one of --device {', '.join(device.name for device in load_devices(config))}")
+        return 1
+    adb = AdbClient.from_config(config, serial=devices[0].serial)
+    verifier = ScreenVerifier(adb, StateStore.from_config(config),
+                              threshold=config.getfloat("Verify", "threshold", fallback=0.08))
+    try:
+        if args.action == "record":
+            verifier.record(args.state)
+            print(f"Recorded the {args.state} screen of {devices[0].name}")
+            return 0
+        grid = verifier.fingerprint(verifier.capture())
+        for state, distance in sorted(verifier.distances(grid).items(), key=lambda item: item[1]):
+            print(f"{state:5} {distance:.4f}")
+        print(verifier.classify())
+        return 0
+    except AdbError as e:
+        print(f"Error: {e}")
+        return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,143 @@
+import socket
+import threading
+import time
+from typing import List, Optional
+
+from adb_client import OUTPUT_PREVIEW, AdbClient, AdbError, CommandResult, CommandTimeout
+from command_executor import redact
+from log_buffer import get_logger
+from tracing import TRACER, span
+
+log = get_logger("session")
+
+
+# Printed after every command; the format string is split with '' so the
+# terminal echo of the command line itself (old pty-based adbd) never matches.
+END_MARKER = b"__MAA_END_"
+_MARKER_FORMAT = "printf '\\n__MAA_E''ND_%s__:%s\\n' {index} $?"
+
+
+class ShellSession:
+    """One long-lived adb shell that runs queued commands in order
+
+    Commands are written through a single connection and each is followed
+    by a sentinel line carrying its exit status, so a whole sequence can be
+    pipelined in one write and still yield per-command output and status.
+    """
+
+    def __init__(self, adb: AdbClient, timeout: Optional[float] = None):
+        self.adb = adb
+        self.timeout = timeout if timeout is not None else adb.timeout
+        self._sock: Optional[socket.socket] = None
+        self._buffer = bytearray()
+        self._queue: List[str] = []
+        self._counter = 0
+        self._lock = threading.RLock()
+
+    def open(self) -> "ShellSession":
+        if self._sock is None:
+            # cat keeps sh off the tty, so it runs non-interactively (no prompt)
+            self._sock = self.adb.open_service("shell:stty -echo 2>/dev/null; cat | sh 2>&1")
+            self._sock.settimeout(self.timeout)
+        return self
+
+    def close(self) -> None:
+        if self._sock is not None:
+            try:
+                self._sock.sendall(b"exit\n")
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+            self._buffer.clear()
+
+    def __enter__(self) -> "ShellSession":
+        return self.open()
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @property
+    def is_open(self) -> bool:
+        return self._sock is not None
+
+    def queue(self, command: str) -> "ShellSession":
+        """Add a command to the next batch"""
+        self._queue.append(command)
+        return self
+
+    def run_batch(self) -> List[CommandResult]:
+        """Send every queued command in one write and collect their results in order"""
+        with self._lock:
+            commands, self._queue = self._queue, []
+            if not commands:
+                return []
+            if not self.adb.supports_sessions:
+                # Recording/replaying clients see each command on its own
+                return [self.adb.shell(command) for command in commands]
+            self.open()
+            indices = []
+            payload = []
+            for command in commands:
+                self._counter += 1
+                indices.append(self._counter)
+                payload.append(f"{command}\n{_MARKER_FORMAT.format(index=self._counter)}\n")
+            with span("session.batch", "command", serial=self.adb.serial, commands=len(commands)) as step:
+                try:
+                    self._sock.sendall("".join(payload).encode("utf-8"))
+                    results = []
+                    started, wall = time.perf_counter(), time.time()
+                    for command, index in zip(commands, indices):
+                        results.append(self._read_result(command, index))
+                        log.debug("session %s -> %s: %r", redact(command), results[-1].returncode,
+                                  results[-1].stdout[:OUTPUT_PREVIEW])
+                        if TRACER.enabled:
+                            # Commands run back to back, so each one took from
+                            # the previous result until its own result arrived
+                            finished = time.perf_counter()
+                            TRACER.record("session.command", "command", wall, finished - started,
+                                          serial=self.adb.serial, command=redact(command),
+                                          exit_code=results[-1].returncode, bytes=len(results[-1].stdout))
+                            started, wall = finished, wall + (finished - started)
+                    step.set(exit_codes=[result.returncode for result in results])
+                    return results
+                except socket.timeout:
+                    self.close()
+                    raise CommandTimeout(f"Shell session got no output for {self.timeout:.1f}s")
+                except (OSError, AdbError) as e:
+                    # The stream is out of sync after a failure, start over next time
+                    self.close()
+                    raise AdbError(f"Shell session failed: {e}")
+
+    def run(self, command: str) -> CommandResult:
+        """Run a single command through the session"""
+        with self._lock:
+            self._queue.append(command)
+            return self.run_batch()[-1]
+
+    # Lets a session stand in for AdbClient in the waiting.py predicates
+    shell = run
+
+    def _read_result(self, command: str, index: int) -> CommandResult:
+        marker = b"\n" + END_MARKER + b"%d__:" % index
+        while True:
+            start = self._buffer.find(marker)
+            if start != -1:
+                end = self._buffer.find(b"\n", start + len(marker))
+                if end != -1:
+                    break
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise AdbError("Shell session closed by device")
+            self._buffer += chunk
+        # Old adbd runs the shell in a pty, which turns \n into \r\n
+        output = bytes(self._buffer[:start])
+        if b"\r" in output:
+            output = output.replace(b"\r\n", b"\n").rstrip(b"\r")
+        status = bytes(self._buffer[start + len(marker):end])
+        del self._buffer[:end + 1]
+        try:
+            returncode: Optional[int] = int(status)
+        except ValueError:
+            returncode = None
+        return CommandResult(command, output, returncode)
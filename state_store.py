@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional
+
+from log_buffer import get_logger
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+log = get_logger("state")
+
+
+# Record key for a client without a serial, which talks to adb's only device
+DEFAULT_SERIAL = "default"
+
+# Identifies the process that wrote a record
+RUN_ID = f"{os.getpid()}-{int(time.time())}"
+
+# Windows refuses to replace a file someone is reading (reads take no lock);
+# those reads are short, so the rename is tried again for up to about a second
+_REPLACE_ATTEMPTS = 10
+
+
+@contextmanager
+def _locked(lock_path: str) -> Iterator[None]:
+    """Exclusive OS-level lock held on lock_path for the duration of the block"""
+    with open(lock_path, "a+b") as handle:
+        if os.name == "nt":
+            handle.seek(0)
+            # LK_LOCK retries for ~10 s before giving up; keep trying after that
+            while True:
+                try:
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+class StateStore:
+    """Small JSON store of per-device state, keyed by adb serial
+
+    Writes go to a temporary file that is fsynced and renamed over the
+    store, so a crash never leaves a half-written file. Read-modify-write
+    cycles hold an OS file lock, so overlapping runs and several devices
+    can share one store safely. Plain reads take no lock; on Windows a
+    rename that collides with one is retried.
+    """
+
+    def __init__(self, path: str = "device_state.json"):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self._thread_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> "StateStore":
+        return cls(config.get("State", "state_file", fallback="device_state.json"))
+
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable state file {self.path}: {e}")
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _write(self, data: Dict[str, Dict[str, Any]]) -> None:
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        for attempt in range(1, _REPLACE_ATTEMPTS + 1):
+            try:
+                os.replace(tmp_path, self.path)
+                return
+            except PermissionError:
+                if attempt == _REPLACE_ATTEMPTS:
+                    os.remove(tmp_path)
+                    raise
+                time.sleep(0.02 * attempt)
+
+    @contextmanager
+    def transaction(self) -> Iterator[Dict[str, Dict[str, Any]]]:
+        """Lock the store and yield all records; changes are written back on exit"""
+        with self._thread_lock, _locked(self.lock_path):
+            data = self._read()
+            yield data
+            self._write(data)
+
+    def get(self, serial: str) -> Dict[str, Any]:
+        """Return a copy of everything recorded for serial (one local read, no lock needed)"""
+        return dict(self._read().get(serial, {}))
+
+    def all(self) -> Dict[str, Dict[str, Any]]:
+        return self._read()
+
+    def update(self, serial: str, **fields: Any) -> Dict[str, Any]:
+        """Merge fields into serial's record and stamp it with the time and run id"""
+        with self.transaction() as data:
+            record = data.setdefault(serial, {})
+            record.update(fields)
+            record["updated_at"] = datetime.now().isoformat(timespec="seconds")
+            record["updated_by"] = RUN_ID
+            return dict(record)
+
+    def record(self, serial: str, **fields: Any) -> None:
+        """Best-effort update for bookkeeping; failures are printed, never raised"""
+        try:
+            self.update(serial, **fields)
+        except Exception as e:
+            log.warning(f"Could not update state store {self.path}: {e}")
+
+    def clear(self, serial: str, *fields: str) -> None:
+        """Remove fields from serial's record, or the whole record if none are given"""
+        with self.transaction() as data:
+            if not fields:
+                data.pop(serial, None)
+                return
+            record = data.get(serial)
+            if record is None:
+                return
+            for field in fields:
+                record.pop(field, None)
+
+    def get_field(self, serial: str, field: str, default: Optional[Any] = None) -> Any:
+        return self.get(serial).get(field, default)
@@ -0,0 +1,123 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from tracing import span
+
+
+class StepResult:
+    """Outcome of one step; skipped steps never ran because a step they need failed"""
+
+    def __init__(self, name: str, ok: bool, value: Any = None, error: Optional[BaseException] = None,
+                 duration: float = 0.0, skipped: bool = False):
+        self.name = name
+        self.ok = ok
+        self.value = value
+        self.error = error
+        self.duration = duration
+        self.skipped = skipped
+
+    def __repr__(self) -> str:
+        status = "skipped" if self.skipped else "OK" if self.ok else f"FAILED ({self.error})" if self.error else "FAILED"
+        return f"{self.name}: {status} in {self.duration * 1000:.0f} ms"
+
+
+class Step:
+    def __init__(self, name: str, function: Callable[[], Any], after: Tuple[str, ...], critical: bool):
+        self.name = name
+        self.function = function
+        self.after = after
+        self.critical = critical
+
+
+class StepRunner:
+    """Runs the steps of one flow as soon as the steps they depend on are done
+
+    Each step is a callable returning a truthy value on success; it keeps
+    doing its own reporting (prints, error emails). Independent steps run
+    in parallel threads, each on its own adb connection, so a flow waits
+    for its longest chain of dependent steps instead of the sum of all.
+
+    When a critical step fails, the steps after it are skipped; a
+    non-critical failure (e.g. a resolution change) does not hold the rest
+    up. The first exception of a critical step is raised again by run()
+    once the steps already running have finished.
+    """
+
+    def __init__(self, max_workers: int = 4, name: str = "flow"):
+        self.max_workers = max(1, max_workers)
+        self.name = name
+        self._steps: Dict[str, Step] = {}
+
+    def add(self, name: str, function: Callable[[], Any], after: Tuple[str, ...] = (),
+            critical: bool = True) -> "StepRunner":
+        if name in self._steps:
+            raise ValueError(f"duplicate step: {name}")
+        self._steps[name] = Step(name, function, tuple(after), critical)
+        return self
+
+    def _check(self) -> None:
+        """Reject unknown dependencies and cycles before anything runs"""
+        for step in self._steps.values():
+            for dependency in step.after:
+                if dependency not in self._steps:
+                    raise ValueError(f"step {step.name} depends on unknown step {dependency}")
+        done: set = set()
+        remaining = dict(self._steps)
+        while remaining:
+            ready = [name for name, step in remaining.items() if all(d in done for d in step.after)]
+            if not ready:
+                raise ValueError(f"dependency cycle between steps: {', '.join(sorted(remaining))}")
+            for name in ready:
+                done.add(name)
+                del remaining[name]
+
+    def _run_step(self, step: Step) -> StepResult:
+        start = time.monotonic()
+        with span(f"{self.name}.{step.name}", "step") as traced_step:
+            try:
+                value = step.function()
+            except Exception as e:
+                traced_step.set(ok=False)
+                return StepResult(step.name, False, error=e, duration=time.monotonic() - start)
+            ok = bool(value)
+            traced_step.set(ok=ok)
+        return StepResult(step.name, ok, value, duration=time.monotonic() - start)
+
+    def run(self) -> Dict[str, StepResult]:
+        """Run every step; returns the results by step name"""
+        self._check()
+        results: Dict[str, StepResult] = {}
+        pending = dict(self._steps)
+        running: Dict[Future, Step] = {}
+        error: Optional[BaseException] = None
+
+        def blocked(step: Step) -> bool:
+            return any(not results[d].ok and self._steps[d].critical for d in step.after)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name) as executor:
+            while pending or running:
+                for name, step in list(pending.items()):
+                    if not all(d in results for d in step.after):
+                        continue
+                    del pending[name]
+                    if blocked(step) or error is not None:
+                        results[name] = StepResult(name, False, skipped=True)
+                    elif len(pending) == 0 and not running:
+                        # Last runnable step: no need for a thread hop
+                        results[name] = self._run_step(step)
+                        if results[name].error is not None and step.critical and error is None:
+                            error = results[name].error
+                    else:
+                        running[executor.submit(self._run_step, step)] = step
+                if not running:
+                    continue
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    result = results[step.name] = future.result()
+                    if result.error is not None and step.critical and error is None:
+                        error = result.error
+        if error is not None:
+            raise error
+        return results
@@ -0,0 +1,31 @@
+import gzip
+import re
+
+import pytest
+
+from adb_cassette import Cassette, RecordingAdbClient, ReplayAdbClient
+from adb_client import AdbError
+from fake_adb_server import FakeAdbServer, FakeDevice
+
+
+def test_cassette_masks_pin_and_replays_errors(tmp_path):
+    path = str(tmp_path / "unlock.jsonl.gz")
+    cassette = Cassette(path)
+    with FakeAdbServer() as server:
+        FakeDevice().install(server)
+        adb = RecordingAdbClient(cassette, serial="127.0.0.1:5555", port=server.port)
+        assert adb.shell("input text 1234").ok
+        offline = RecordingAdbClient(cassette, serial="10.0.0.9:5555", port=server.port)
+        with pytest.raises(AdbError) as recorded:
+            offline.shell("getprop ro.serialno")
+    cassette.save()
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        content = f.read()
+    assert "input text ***" in content
+    assert "1234" not in content
+
+    replayed = Cassette.load(path)
+    assert ReplayAdbClient(replayed, speed="fast", serial="127.0.0.1:5555").shell("input text 1234").ok
+    with pytest.raises(AdbError, match=re.escape(str(recorded.value))):
+        ReplayAdbClient(replayed, speed="fast", serial="10.0.0.9:5555").shell("getprop ro.serialno")
@@ -0,0 +1,52 @@
+import configparser
+import http.client
+import json
+import os
+
+import pytest
+
+from benchmark import LATENCY_PROFILES, Bench
+from daemon import TOKEN_HEADER
+from fake_adb_server import FakeDevice
+
+
+@pytest.fixture(scope="module")
+def daemon():
+    bench = Bench(sorted(LATENCY_PROFILES)[0], FakeDevice())
+    try:
+        bench.start_daemon()
+        config = configparser.ConfigParser()
+        config.read(os.path.join(bench.workdir, "config.ini"))
+        with open(os.path.join(bench.workdir, "daemon_token.txt"), encoding="utf-8") as f:
+            yield config.getint("Daemon", "port"), f.read()
+    finally:
+        bench.close()
+
+
+def _post(port: int, path: str, headers: dict):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("POST", path, headers=headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("path", ["/unlock", "/shutdown"])
+def test_actions_need_the_token(daemon, path):
+    port, token = daemon
+    assert _post(port, path, {})[0] == 403
+    assert _post(port, path, {TOKEN_HEADER: token + "x"})[0] == 403
+
+
+def test_requests_from_web_pages_are_refused(daemon):
+    port, token = daemon
+    status, body = _post(port, "/unlock", {TOKEN_HEADER: token, "Origin": "http://example.com"})
+    assert status == 403 and not body["ok"]
+
+
+def test_action_with_the_token_runs(daemon):
+    port, token = daemon
+    status, body = _post(port, "/unlock", {TOKEN_HEADER: token})
+    assert status == 200 and body["ok"]
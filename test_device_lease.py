@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+import time
+
+from device_lease import DeviceLease
+from state_store import StateStore
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Holds the lease in another process for a while, logging when it worked on the device
+HOLDER = """
+import sys, time
+sys.path.insert(0, {here!r})
+from device_lease import DeviceLease
+from state_store import StateStore
+
+def work():
+    with open({log!r}, "a") as f:
+        f.write("start %f\\n" % time.time())
+    time.sleep({hold})
+    with open({log!r}, "a") as f:
+        f.write("end %f\\n" % time.time())
+    return True
+
+DeviceLease(StateStore({state!r}), "dev", {flow!r}, ttl={ttl}).run(work)
+"""
+
+
+def _holder(tmp_path, flow: str, hold: float, ttl: float) -> subprocess.Popen:
+    script = HOLDER.format(here=HERE, log=str(tmp_path / "runs.log"), state=str(tmp_path / "state.json"),
+                           flow=flow, hold=hold, ttl=ttl)
+    return subprocess.Popen([sys.executable, "-c", script])
+
+
+def test_live_owner_keeps_the_lease_past_its_ttl(tmp_path):
+    first = _holder(tmp_path, "unlock", hold=1.5, ttl=0.3)
+    time.sleep(0.4)
+    second = _holder(tmp_path, "lock", hold=0.1, ttl=0.3)
+    assert first.wait(10) == 0 and second.wait(10) == 0
+
+    events = [line.split() for line in (tmp_path / "runs.log").read_text().splitlines()]
+    assert [kind for kind, _ in events] == ["start", "end", "start", "end"]
+
+
+def test_merge_does_not_skip_a_different_flow_queued_ahead(tmp_path):
+    store = StateStore(str(tmp_path / "state.json"))
+    since = time.time()
+    # Unlock A just finished; lock B was queued before unlock C started waiting
+    with store.transaction() as data:
+        data["dev"] = {
+            "lease_result": {"flow": "unlock", "ok": True, "finished_at": since + 1, "pid": os.getpid()},
+            "lease_queue": [{"owner": "B", "pid": os.getpid(), "flow": "lock", "enqueued_at": since - 1}],
+        }
+    waiter = DeviceLease(store, "dev", "unlock")
+    assert waiter._try_acquire(since) == (False, None, None)
+
+    # Once B ran, its result is the last one and C has to run itself
+    store.clear("dev", "lease_queue")
+    with store.transaction() as data:
+        data["dev"]["lease_result"] = {"flow": "lock", "ok": True, "finished_at": since + 2, "pid": os.getpid()}
+    acquired, merged, _ = waiter._try_acquire(since)
+    assert acquired and merged is None
+
+
+def test_merge_after_the_same_flow(tmp_path):
+    store = StateStore(str(tmp_path / "state.json"))
+    since = time.time()
+    with store.transaction() as data:
+        data["dev"] = {"lease_result": {"flow": "unlock", "ok": True, "finished_at": since + 1, "pid": 1}}
+    acquired, merged, _ = DeviceLease(store, "dev", "unlock")._try_acquire(since)
+    assert not acquired and merged["pid"] == 1
@@ -0,0 +1,51 @@
+import pytest
+
+from adb_client import EXIT_MARKER, AdbClient
+from fake_adb_server import FakeAdbServer
+from resolution_manager import DisplayState
+
+
+def test_parse_physical_only():
+    state = DisplayState.parse("Physical size: 1080x2400\nPhysical density: 420\n")
+    assert (state.physical_size, state.override_size) == ("1080x2400", None)
+    assert state.size == "1080x2400"
+    assert state.density == 420
+
+
+def test_parse_override_wins():
+    state = DisplayState.parse("Physical size: 1080x2400\nOverride size: 720x1600\n"
+                               "Physical density: 420\nOverride density: 280\n")
+    assert (state.physical_size, state.override_size) == ("1080x2400", "720x1600")
+    assert state.size == "720x1600"
+    assert (state.physical_density, state.density) == (420, 280)
+
+
+def test_parse_vendor_format_falls_back_to_the_first_size():
+    state = DisplayState.parse("Display 0: real 1440x3200, cur 1080x2400\n")
+    assert state.physical_size == "1440x3200"
+    assert state.override_size is None
+    assert state.density is None
+
+
+@pytest.mark.parametrize("response, stdout, returncode", [
+    ("Physical size: 1080x2400\n", b"Physical size: 1080x2400\n", 0),
+    (("", 1), b"", 1),
+    (("not found\n", 127), b"not found\n", 127),
+    # Old adbd runs commands in a pty
+    (("a\r\nb\r\n", 0), b"a\nb\n", 0),
+    # Output that itself ends in the status digits of another command
+    (("rc 42\n", 3), b"rc 42\n", 3),
+])
+def test_shell_splits_output_and_exit_code(response, stdout, returncode):
+    with FakeAdbServer() as server:
+        server.shell_responses["probe"] = response
+        result = AdbClient(serial="127.0.0.1:5555", port=server.port).shell("probe")
+    assert result.stdout == stdout
+    assert result.returncode == returncode
+
+
+def test_shell_without_the_exit_marker_has_no_exit_code():
+    result = AdbClient._split_exit_status("probe", b"output\n")
+    assert (result.stdout, result.returncode) == (b"output\n", None)
+    result = AdbClient._split_exit_status("probe", b"output\n" + EXIT_MARKER + b"garbled\n")
+    assert (result.stdout, result.returncode) == (b"output\n", None)
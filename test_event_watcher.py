@@ -0,0 +1,20 @@
+import pytest
+
+from adb_client import AdbClient
+from event_watcher import DeviceEventWatcher
+from fake_adb_server import FakeAdbServer, FakeDevice
+
+
+@pytest.mark.parametrize("sdk", ["33", "34"])
+def test_keyguard_transitions_from_the_event_stream(sdk):
+    with FakeAdbServer() as server:
+        device = FakeDevice(sdk=sdk).install(server)
+        device.screen_on = True
+        watcher = DeviceEventWatcher(AdbClient(serial="127.0.0.1:5555", port=server.port), probe_interval=5)
+        with watcher:
+            assert watcher.running
+            device._unlock()
+            assert watcher.wait_for("keyguard", False, timeout=2)
+            device.lock()
+            assert watcher.wait_for("keyguard", True, timeout=2)
+            assert watcher.wait_for("screen", False, timeout=2)
@@ -0,0 +1,55 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from benchmark import IMPORT_BUDGET_MS, LAZY_MODULES
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# What the hook client must not pull in: the flows and everything behind them
+# (ssl is not listed: http.client imports it)
+FLOW_MODULES = ("unlock_phone_new_with_config", "lock_phone_and_recovery_resolution_with_config",
+                "adb_client", "resolution_manager", "notifier", "smtplib", "subprocess")
+
+REPORT = """
+import json, sys, time
+start = time.perf_counter()
+import {modules}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"import_ms": elapsed * 1000, "modules": sorted(sys.modules)}}))
+"""
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    # The flows read config.ini from the working directory when imported
+    shutil.copy(os.path.join(HERE, "config.example.ini"), tmp_path / "config.ini")
+    return tmp_path
+
+
+def _import(workdir, modules: str) -> dict:
+    """Import modules in a fresh interpreter; the fastest of three runs"""
+    env = dict(os.environ, PYTHONPATH=HERE, PYTHONDONTWRITEBYTECODE="1")
+    reports = []
+    for _ in range(3):
+        completed = subprocess.run([sys.executable, "-c", REPORT.format(modules=modules)], cwd=workdir, env=env,
+                                   capture_output=True, text=True, timeout=60)
+        assert completed.returncode == 0, completed.stderr
+        reports.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return min(reports, key=lambda report: report["import_ms"])
+
+
+def test_flows_import_within_budget_and_leave_heavy_modules_lazy(workdir):
+    report = _import(workdir, "unlock_phone_new_with_config, lock_phone_and_recovery_resolution_with_config")
+    assert [module for module in LAZY_MODULES if module in report["modules"]] == []
+    assert report["import_ms"] <= IMPORT_BUDGET_MS
+
+
+def test_hook_client_does_not_import_the_flows(workdir):
+    report = _import(workdir, "daemon")
+    assert [module for module in FLOW_MODULES if module in report["modules"]] == []
+    assert report["import_ms"] <= IMPORT_BUDGET_MS
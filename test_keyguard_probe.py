@@ -0,0 +1,49 @@
+from adb_client import AdbClient
+from fake_adb_server import FakeAdbServer, FakeDevice
+from keyguard_probe import KeyguardProbe
+from state_store import StateStore
+
+SERIAL = "127.0.0.1:5555"
+
+
+def _probe(server, store) -> KeyguardProbe:
+    KeyguardProbe._probe_cache.clear()
+    return KeyguardProbe(AdbClient(serial=SERIAL, port=server.port), store)
+
+
+def test_stored_probe_is_detected_again_after_an_sdk_change(tmp_path):
+    store = StateStore(str(tmp_path / "state.json"))
+    store.record(SERIAL, keyguard_probe={"sdk": "33", "name": "window", "style": "markers"})
+    with FakeAdbServer() as server:
+        FakeDevice(sdk="34", keyguard_style="delegate").install(server)
+        probe = _probe(server, store)
+        assert probe.probe == ("window_policy", "delegate")
+        assert probe.keyguard_showing() is True
+    assert store.get_field(SERIAL, "keyguard_probe") == {"sdk": "34", "name": "window_policy", "style": "delegate"}
+
+
+def test_stored_probe_is_dropped_when_its_section_stops_saying(tmp_path):
+    store = StateStore(str(tmp_path / "state.json"))
+    store.record(SERIAL, keyguard_probe={"sdk": "33", "name": "window_policy", "style": "markers"})
+    with FakeAdbServer() as server:
+        FakeDevice(sdk="33", keyguard_style="none").install(server)
+        probe = _probe(server, store)
+        assert probe.probe == ("window_policy", "markers")
+        assert probe.keyguard_showing() is None
+        assert probe.probe == ("window", "markers")
+    assert store.get_field(SERIAL, "keyguard_probe") is None
+
+
+def test_bouncer_check_waits_for_the_pin_pad_not_the_lock_screen(tmp_path):
+    with FakeAdbServer() as server:
+        device = FakeDevice(sdk="33").install(server)
+        device.screen_on = True
+        probe = _probe(server, None)
+        check = probe.bouncer_check()
+        # Android 12+ focuses NotificationShade for the plain lock screen as well
+        assert "NotificationShade" in probe.adb.shell("dumpsys window windows").text
+        assert not probe.adb.shell(check).ok
+        device.bouncer = True
+        assert probe.adb.shell(check).ok
+        device._unlock()
+        assert probe.adb.shell(check).ok
@@ -0,0 +1,97 @@
+import configparser
+import email
+import smtplib
+import time
+
+from notifier import Notifier
+
+
+class FakeSMTP:
+    """SMTP stand-in: keeps every message it is handed"""
+
+    def __init__(self, transport: str, outbox: list):
+        self.transport = transport
+        self.outbox = outbox
+        self.closed = False
+
+    def sendmail(self, sender, receivers, message):
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected("session closed")
+        self.outbox.append((self, email.message_from_string(message)))
+
+    def quit(self):
+        self.closed = True
+
+    close = quit
+
+
+def _notifier(tmp_path, outbox: list, coalesce_window: float = 0, failing=()) -> Notifier:
+    config = configparser.ConfigParser()
+    config.read_dict({"Email": {"sender": "maa@example.com", "receiver": "me@example.com",
+                                "transport_cache_file": str(tmp_path / "smtp_transport.txt")}})
+
+    def factory(transport):
+        if transport in failing:
+            raise smtplib.SMTPConnectError(421, f"{transport} refused")
+        return FakeSMTP(transport, outbox)
+
+    return Notifier(config, coalesce_window=coalesce_window, smtp_factory=factory, log_tail=None)
+
+
+def _body(message) -> str:
+    return message.get_payload(decode=True).decode("utf-8")
+
+
+def _wait_sent(notifier: Notifier, count: int) -> None:
+    deadline = time.monotonic() + 5
+    while notifier.sent_count < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert notifier.sent_count == count
+
+
+def test_worker_keeps_sending_after_the_first_digest(tmp_path):
+    outbox = []
+    notifier = _notifier(tmp_path, outbox)
+    notifier.notify("first failure")
+    _wait_sent(notifier, 1)
+    notifier.notify("second failure")
+    notifier.close()
+    assert notifier.sent_count == 2
+    assert ["first failure" in _body(message) for _, message in outbox] == [True, False]
+    assert "second failure" in _body(outbox[1][1])
+
+
+def test_failures_within_the_window_are_merged_into_one_digest(tmp_path):
+    outbox = []
+    notifier = _notifier(tmp_path, outbox, coalesce_window=0.5)
+    for message in ("adb timed out", "adb timed out", "screen still locked"):
+        notifier.notify(message)
+    notifier.close()
+    assert notifier.sent_count == 1
+    body = _body(outbox[0][1])
+    assert "- adb timed out (x2)" in body
+    assert "- screen still locked" in body
+
+
+def test_working_transport_is_remembered_for_the_next_run(tmp_path):
+    outbox = []
+    notifier = _notifier(tmp_path, outbox, failing=("starttls",))
+    notifier.notify("failure")
+    notifier.close()
+    assert [session.transport for session, _ in outbox] == ["ssl"]
+    assert (tmp_path / "smtp_transport.txt").read_text(encoding="utf-8") == "ssl"
+
+    # Next run: the remembered transport is tried first
+    assert _notifier(tmp_path, outbox)._transport_order() == ["ssl", "starttls"]
+
+
+def test_second_digest_reuses_the_session(tmp_path):
+    outbox = []
+    notifier = _notifier(tmp_path, outbox)
+    notifier.notify("first failure")
+    _wait_sent(notifier, 1)
+    notifier.notify("second failure")
+    notifier.close()
+    (first, _), (second, _) = outbox
+    assert first is second
+    assert first.closed
@@ -0,0 +1,72 @@
+import configparser
+import logging
+
+from adb_client import AdbClient
+from command_executor import redact
+from fake_adb_server import FakeAdbServer, FakeDevice
+from log_buffer import LOGGER_NAME, RingBufferHandler
+from notifier import Notifier
+from shell_session import ShellSession
+from tracing import TRACER
+
+PIN = "482916"
+
+
+def test_redact_masks_typed_text_only():
+    assert redact(f"input text {PIN}") == "input text ***"
+    assert redact(f"input keyboard text '{PIN} 1'; echo done") == "input keyboard text ***; echo done"
+    assert redact("input keyevent 26") == "input keyevent 26"
+
+
+def test_failure_digest_never_contains_lock_password():
+    buffer = RingBufferHandler()
+    logger = logging.getLogger(LOGGER_NAME)
+    level = logger.level
+    logger.addHandler(buffer)
+    logger.setLevel(logging.DEBUG)
+    try:
+        with FakeAdbServer() as server:
+            device = FakeDevice(pin="0000").install(server)
+            device.screen_on = device.bouncer = True
+            adb = AdbClient(serial="127.0.0.1:5555", port=server.port)
+            adb.shell(f"input text {PIN}")
+            session = ShellSession(adb)
+            try:
+                session.queue(f"input text {PIN}").run_batch()
+            finally:
+                session.close()
+    finally:
+        logger.removeHandler(buffer)
+        logger.setLevel(level)
+
+    config = configparser.ConfigParser()
+    config.read_dict({"Email": {"sender": "maa@example.com", "receiver": "me@example.com"}})
+    notifier = Notifier(config, coalesce_window=0, log_tail=buffer.lines)
+    lines = buffer.lines()
+    message = notifier._build_message({"Failed to unlock screen after retry": 1}, lines)
+    body = message.get_payload(decode=True).decode("utf-8")
+    assert any("input text ***" in line for line in lines)
+    assert PIN not in "\n".join(lines)
+    assert "Recent log" in body
+    assert PIN not in body
+
+
+def test_trace_file_never_contains_lock_password(tmp_path):
+    trace_file = tmp_path / "trace.jsonl"
+    TRACER.configure(trace_file=str(trace_file))
+    try:
+        with FakeAdbServer() as server:
+            FakeDevice().install(server)
+            adb = AdbClient(serial="127.0.0.1:5555", port=server.port)
+            adb.shell(f"input text {PIN}")
+            session = ShellSession(adb)
+            try:
+                session.queue(f"input text {PIN}").queue("true").run_batch()
+            finally:
+                session.close()
+    finally:
+        TRACER.close()
+        TRACER.configure()
+    trace = trace_file.read_text(encoding="utf-8")
+    assert trace.count("input text ***") == 2
+    assert PIN not in trace
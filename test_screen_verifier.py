@@ -0,0 +1,116 @@
+import struct
+
+import pytest
+
+from adb_client import AdbError
+from screen_verifier import GRID, ScreenVerifier
+from state_store import StateStore
+
+np = pytest.importorskip("numpy")
+
+WIDTH, HEIGHT = 128, 256
+
+
+class FrameAdb:
+    """Hands out raw screencap output the way AdbClient.exec_out_into does"""
+
+    serial = "127.0.0.1:5555"
+
+    def __init__(self):
+        self.output = b""
+
+    def show(self, pixels, pixel_format: int = 1, header: int = 16) -> None:
+        height, width = pixels.shape[:2]
+        prefix = struct.pack("<III", width, height, pixel_format)
+        if header == 16:
+            # Android 9+ adds the color space
+            prefix += struct.pack("<I", 0)
+        self.output = prefix + pixels.astype(np.uint8).tobytes()
+
+    def exec_out_into(self, command, buffer, timeout=None):
+        assert command == "screencap"
+        buffer[:min(len(self.output), len(buffer))] = self.output[:len(buffer)]
+        return len(self.output)
+
+
+def _frame(value=0, width=WIDTH, height=HEIGHT):
+    frame = np.zeros((height, width, 4), dtype=np.uint8)
+    frame[..., :3] = value
+    frame[..., 3] = 255
+    return frame
+
+
+def _top_half_white(width=WIDTH, height=HEIGHT):
+    frame = _frame(width=width, height=height)
+    frame[:height // 2, :, :3] = 255
+    return frame
+
+
+def _left_half_white(width=WIDTH, height=HEIGHT):
+    frame = _frame(width=width, height=height)
+    frame[:, :width // 2, :3] = 255
+    return frame
+
+
+@pytest.fixture
+def verifier(tmp_path):
+    return ScreenVerifier(FrameAdb(), StateStore(str(tmp_path / "state.json")))
+
+
+@pytest.mark.parametrize("header", [12, 16])
+def test_capture_reads_both_header_sizes(verifier, header):
+    frame = _top_half_white()
+    verifier.adb.show(frame, header=header)
+    captured = verifier.capture()
+    assert captured.shape == (HEIGHT, WIDTH, 4)
+    assert (captured == frame).all()
+
+
+def test_capture_rejects_unsupported_pixel_formats(verifier):
+    # RGB_565 has two bytes per pixel
+    verifier.adb.show(_frame(), pixel_format=4)
+    with pytest.raises(AdbError, match="pixel format 4"):
+        verifier.capture()
+
+
+def test_fingerprint_of_portrait_and_landscape_frames(verifier):
+    portrait = verifier.fingerprint(_top_half_white())
+    assert portrait.shape == GRID
+    assert np.allclose(portrait[:GRID[0] // 2], 1) and np.allclose(portrait[GRID[0] // 2:], 0)
+
+    landscape = verifier.fingerprint(_left_half_white(width=HEIGHT, height=WIDTH))
+    assert landscape.shape == GRID
+    assert np.allclose(landscape[:, :GRID[1] // 2], 1) and np.allclose(landscape[:, GRID[1] // 2:], 0)
+
+
+def _record(verifier, state, frame):
+    verifier.adb.show(frame)
+    verifier.record(state)
+
+
+def test_classify(verifier):
+    assert verifier.classify() is None
+    _record(verifier, "lock", _top_half_white())
+    _record(verifier, "home", _left_half_white())
+
+    verifier.adb.show(_frame(0))
+    assert verifier.classify() == "off"
+    verifier.adb.show(_frame(128))
+    assert verifier.classify() == "other"
+    # Close to, not exactly, the recorded home screen
+    home = _left_half_white()
+    home[:8, :, :3] = 200
+    verifier.adb.show(home)
+    assert verifier.classify() == "home"
+
+
+def test_unlocked_only_trusts_other_with_lock_and_pin_recorded(verifier):
+    _record(verifier, "lock", _top_half_white())
+    verifier.adb.show(_frame(128))
+    assert verifier.unlocked() is None
+
+    _record(verifier, "pin", _left_half_white())
+    verifier.adb.show(_frame(128))
+    assert verifier.unlocked() is True
+    verifier.adb.show(_top_half_white())
+    assert verifier.unlocked() is False
@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+import state_store
+from state_store import StateStore
+
+
+def _refuse_replace(monkeypatch, times: int) -> list:
+    """Make os.replace fail like Windows does while another thread has the file open"""
+    calls = []
+    replace = os.replace
+
+    def flaky_replace(src, dst):
+        calls.append(dst)
+        if len(calls) <= times:
+            raise PermissionError(13, "The process cannot access the file because it is being used")
+        replace(src, dst)
+
+    monkeypatch.setattr(state_store.os, "replace", flaky_replace)
+    return calls
+
+
+def test_write_retries_while_a_reader_has_the_file_open(tmp_path, monkeypatch):
+    store = StateStore(str(tmp_path / "state.json"))
+    store.update("dev", probe="window")
+    calls = _refuse_replace(monkeypatch, times=3)
+    store.update("dev", probe="window_policy")
+    assert len(calls) == 4
+    assert store.get_field("dev", "probe") == "window_policy"
+
+
+def test_write_gives_up_and_cleans_up_when_the_file_stays_busy(tmp_path, monkeypatch):
+    store = StateStore(str(tmp_path / "state.json"))
+    store.update("dev", probe="window")
+    monkeypatch.setattr(state_store.time, "sleep", lambda seconds: None)
+    _refuse_replace(monkeypatch, times=state_store._REPLACE_ATTEMPTS)
+    with pytest.raises(PermissionError):
+        store.update("dev", probe="window_policy")
+    assert store.get_field("dev", "probe") == "window"
+    assert sorted(os.listdir(tmp_path)) == ["state.json", "state.json.lock"]
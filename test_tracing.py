@@ -0,0 +1,40 @@
+import pytest
+
+from tracing import METRIC, TRACER, Tracer, traced
+
+
+@pytest.fixture
+def prometheus_file(tmp_path):
+    path = tmp_path / "maa.prom"
+    TRACER.configure(prometheus_file=str(path))
+    try:
+        yield path
+    finally:
+        TRACER.close()
+        TRACER.configure()
+
+
+@traced("test.inner")
+def _inner() -> bool:
+    return True
+
+
+@traced("test.flow")
+def _flow(prometheus_file) -> bool:
+    _inner()
+    # Nested calls leave publishing to the outermost one
+    assert not prometheus_file.exists()
+    return True
+
+
+def test_textfile_is_written_when_a_flow_returns(prometheus_file):
+    _flow(prometheus_file)
+    text = prometheus_file.read_text(encoding="utf-8")
+    assert f'{METRIC}_count{{kind="phase",step="test.flow"}} 1' in text
+    assert f'{METRIC}_count{{kind="phase",step="test.inner"}} 1' in text
+
+    # A long-running process keeps adding to it
+    _inner()
+    histograms = Tracer._read_textfile(str(prometheus_file))
+    assert histograms[("phase", "test.flow")][-2] == 1
+    assert histograms[("phase", "test.inner")][-2] == 2
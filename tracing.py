@@ -0,0 +1,294 @@
+import atexit
+import functools
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+
+# Upper bounds in seconds of the Prometheus latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC = "maa_step_duration_seconds"
+
+_WAIT_LOOP = "(i=0; while ! ("
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+_SAMPLE = r'^' + METRIC + r'_(bucket|sum|count)\{kind="([^"]*)",step="([^"]*)"(?:,le="([^"]*)")?\} (\S+)$'
+
+
+class Span:
+    """A timed step; use as a context manager and attach results with set()"""
+
+    __slots__ = ("tracer", "name", "kind", "attrs", "start", "span_id", "parent_id", "_t0")
+
+    def __init__(self, tracer: "Tracer", name: str, kind: str, attrs: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+        self.start = 0.0
+        self.span_id = 0
+        self.parent_id: Optional[int] = None
+        self._t0 = 0.0
+
+    def set(self, **attrs: Any) -> "Span":
+        self.attrs.update(attrs)
+        return self
+
+    def __enter__(self) -> "Span":
+        self.tracer._begin(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # GeneratorExit only means a streaming reader stopped early, as intended
+        if exc is not None and exc_type is not GeneratorExit:
+            self.attrs.setdefault("error", f"{exc_type.__name__}: {exc}")
+        self.tracer._end(self)
+
+
+class _NoopSpan:
+    """Stands in for Span while tracing is off"""
+
+    __slots__ = ()
+
+    def set(self, **attrs: Any) -> "_NoopSpan":
+        return self
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        return None
+
+
+_NOOP = _NoopSpan()
+
+
+class Tracer:
+    """Writes finished spans as JSON lines and keeps per-step latency histograms
+
+    Disabled until configure() is given a trace or Prometheus file; while
+    disabled span() hands out one shared no-op object.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_file: Optional[str] = None
+        self.prometheus_file: Optional[str] = None
+        self._handle = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_id = 0
+        # (kind, step) -> [bucket counts..., +Inf count, sum]
+        self._histograms: Dict[Tuple[str, str], List[float]] = {}
+        # Serialises read-merge-write of the textfile between threads
+        self._flush_lock = threading.Lock()
+        self._atexit = False
+
+    def configure(self, trace_file: Optional[str] = None, prometheus_file: Optional[str] = None) -> None:
+        with self._lock:
+            if trace_file != self.trace_file and self._handle is not None:
+                self._handle.close()
+                self._handle = None
+            self.trace_file = trace_file or None
+            self.prometheus_file = prometheus_file or None
+            self.enabled = bool(self.trace_file or self.prometheus_file)
+            if self.enabled and not self._atexit:
+                atexit.register(self.close)
+                self._atexit = True
+
+    def span(self, name: str, kind: str = "phase", **attrs: Any):
+        if not self.enabled:
+            return _NOOP
+        return Span(self, name, kind, attrs)
+
+    def record(self, name: str, kind: str, start: float, duration: float, **attrs: Any) -> None:
+        """Record a step whose timing was measured elsewhere (start is a time.time() value)"""
+        if not self.enabled:
+            return
+        stack = getattr(self._local, "stack", None)
+        parent = stack[-1].span_id if stack else None
+        with self._lock:
+            self._next_id += 1
+            span_id = self._next_id
+        self._emit(name, kind, start, duration, span_id, parent, attrs)
+
+    # ------------------------------------------------------------------
+    def _begin(self, span: Span) -> None:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        span.parent_id = stack[-1].span_id if stack else None
+        with self._lock:
+            self._next_id += 1
+            span.span_id = self._next_id
+        stack.append(span)
+        span.start = time.time()
+        span._t0 = time.perf_counter()
+
+    def _end(self, span: Span) -> None:
+        duration = time.perf_counter() - span._t0
+        # A generator's span may be closed from another thread by the GC
+        stack = getattr(self._local, "stack", [])
+        if span in stack:
+            stack.remove(span)
+        self._emit(span.name, span.kind, span.start, duration, span.span_id, span.parent_id, span.attrs)
+
+    def _emit(self, name: str, kind: str, start: float, duration: float,
+              span_id: int, parent_id: Optional[int], attrs: Dict[str, Any]) -> None:
+        entry = {
+            "ts": round(start, 6),
+            "pid": os.getpid(),
+            "span": span_id,
+            "parent": parent_id,
+            "kind": kind,
+            "name": name,
+            "duration_ms": round(duration * 1000, 3),
+        }
+        entry.update(attrs)
+        step = self._step(name, attrs)
+        with self._lock:
+            if self.trace_file:
+                try:
+                    if self._handle is None:
+                        self._handle = open(self.trace_file, "a", encoding="utf-8")
+                    self._handle.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+                    self._handle.flush()
+                except OSError as e:
+                    print(f"Tracing disabled, cannot write {self.trace_file}: {e}")
+                    self.trace_file = None
+            if self.prometheus_file:
+                counts = self._histograms.setdefault((kind, step), [0.0] * (len(BUCKETS) + 2))
+                for i, bound in enumerate(BUCKETS):
+                    if duration <= bound:
+                        counts[i] += 1
+                counts[-2] += 1
+                counts[-1] += duration
+
+    @staticmethod
+    def _step(name: str, attrs: Dict[str, Any]) -> str:
+        """Histogram label: the span name, plus the program for device commands"""
+        command = attrs.get("command")
+        if not isinstance(command, str) or not command:
+            return name
+        prefix = ""
+        if command.startswith(_WAIT_LOOP):
+            # waiting.device_wait loops are labelled by the check they wait for
+            command = command[len(_WAIT_LOOP):]
+            prefix = "wait "
+        head = command.split()
+        return f"{name} {prefix}{' '.join(head[:2])}".replace('"', "'")
+
+    def flush(self) -> None:
+        """Merge this process's histograms into the Prometheus textfile"""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        with self._lock:
+            if not self.prometheus_file or not self._histograms:
+                return
+            merged = {key: list(counts) for key, counts in self._histograms.items()}
+            self._histograms.clear()
+            path = self.prometheus_file
+        for key, counts in self._read_textfile(path).items():
+            total = merged.setdefault(key, [0.0] * (len(BUCKETS) + 2))
+            for i, value in enumerate(counts):
+                total[i] += value
+
+        lines = [f"# HELP {METRIC} Duration of MAA unlock/lock steps and device commands",
+                 f"# TYPE {METRIC} histogram"]
+        for (kind, step), counts in sorted(merged.items()):
+            labels = f'kind="{kind}",step="{step}"'
+            for bound, count in zip(BUCKETS, counts):
+                lines.append(f'{METRIC}_bucket{{{labels},le="{bound}"}} {count:g}')
+            lines.append(f'{METRIC}_bucket{{{labels},le="+Inf"}} {counts[-2]:g}')
+            lines.append(f"{METRIC}_sum{{{labels}}} {counts[-1]:.6f}")
+            lines.append(f"{METRIC}_count{{{labels}}} {counts[-2]:g}")
+        # The textfile collector may read at any moment, so replace the file atomically
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write Prometheus textfile {path}: {e}")
+
+    @staticmethod
+    def _read_textfile(path: str) -> Dict[Tuple[str, str], List[float]]:
+        """Parse the histograms a previous run wrote, so they stay cumulative"""
+        histograms: Dict[Tuple[str, str], List[float]] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return histograms
+        index = {str(bound): i for i, bound in enumerate(BUCKETS)}
+        for line in lines:
+            match = re.match(_SAMPLE, line)
+            if not match:
+                continue
+            series, kind, step, le, value = match.groups()
+            counts = histograms.setdefault((kind, step), [0.0] * (len(BUCKETS) + 2))
+            if series == "bucket" and le in index:
+                counts[index[le]] = float(value)
+            elif series == "count":
+                counts[-2] = float(value)
+            elif series == "sum":
+                counts[-1] = float(value)
+        return histograms
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+
+TRACER = Tracer()
+
+
+def configure(config) -> Tracer:
+    """Enable tracing from the [Trace] section; empty or missing paths keep it off"""
+    TRACER.configure(
+        trace_file=config.get("Trace", "trace_file", fallback="").strip(),
+        prometheus_file=config.get("Trace", "prometheus_file", fallback="").strip(),
+    )
+    return TRACER
+
+
+def span(name: str, kind: str = "phase", **attrs: Any):
+    """Time a block: `with span("unlock.verify") as s: ...; s.set(ok=True)`"""
+    if not TRACER.enabled:
+        return _NOOP
+    return Span(TRACER, name, kind, attrs)
+
+
+def traced(name: str, kind: str = "phase") -> Callable[[F], F]:
+    """Decorator form of span(); a bool return value is recorded as ok
+
+    The Prometheus textfile is updated whenever an outermost traced call
+    (a whole flow) returns, so the daemon and the prewarm scheduler publish
+    while they run instead of only when they exit.
+    """
+    def decorate(function: F) -> F:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not TRACER.enabled:
+                return function(*args, **kwargs)
+            step = Span(TRACER, name, kind, {})
+            try:
+                with step:
+                    result = function(*args, **kwargs)
+                    if isinstance(result, bool):
+                        step.set(ok=result)
+                    return result
+            finally:
+                if step.parent_id is None:
+                    TRACER.flush()
+        return wrapper  # type: ignore[return-value]
+    return decorate
@@ -1,257 +1,287 @@
-import subprocess
-import smtplib
-from email.mime.text import MIMEText
-from email.header import Header
-from datetime import datetime
-from time import sleep
-import configparser
-import ssl
+import time
+from typing import Optional
+from adb_client import AdbClient, AdbError
+from adb_connection import AdbConnectionManager
+from app_config import load_config
+from device_config import DeviceConfig, default_device
+from device_lease import DeviceLease, LeaseTimeout
+from event_watcher import DeviceEventWatcher
+from gestures import load_gestures
+from keyguard_probe import KeyguardProbe
+from log_buffer import configure as configure_logging, get_logger
+from notifier import Notifier
 from resolution_manager import ResolutionManager
+from retry_policy import CircuitOpenError, RetryPolicy
+from screen_verifier import ScreenVerifier
+from shell_session import ShellSession
+from step_runner import StepRunner
+from tracing import configure as configure_tracing, span, traced
+from waiting import SCREEN_ON_CHECK, device_wait, screen_on, wait_until
 
 # 读取配置文件
-config = configparser.ConfigParser()
-config.read("config.ini", encoding='utf-8')
-print(f"Loaded config files: {config.read('config.ini')}")
-print(f"Current device_ip: {config['ADB']['device_ip']}")
+config = load_config()
 
-# 初始化分辨率管理器
-resolution_manager = ResolutionManager()
+# 日志输出到控制台，并在内存中保留最近的记录，失败时随邮件发送
+configure_logging(config)
+log = get_logger("unlock")
+log.info(f"Loaded config files: {config.files}")
+log.info(f"Current device_ip: {config['ADB']['device_ip']}")
 
+# 按[Trace]配置记录每个步骤的耗时，未配置时不产生任何开销
+configure_tracing(config)
 
-def send_error_email(error_message):
-    """Send error notification email"""
-    try:
-        # Email settings
-        smtp_server = config["Email"]["smtp_server"]
-        smtp_port = int(config["Email"]["smtp_port"])
-        sender = config["Email"]["sender"]
-        receiver = config["Email"]["receiver"]
-        password = config["Email"]["password"]
-
-        # Create message
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        subject = f"Phone Unlock Failed - {current_time}"
-        content = f"""
-        Phone unlock task failed at {current_time}
-
-        Error details:
-        {error_message}
-        """
-
-        msg = MIMEText(content, "plain", "utf-8")
-        msg["Subject"] = Header(subject, "utf-8")
-        msg["From"] = sender
-        msg["To"] = receiver
-
-        # Try sending email with different methods
-        email_sent = False
-        last_error = None
-        
-        # Method 1: STARTTLS
-        try:
-            context = ssl.create_default_context()
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls(context=context)
-                server.login(sender, password)
-                server.sendmail(sender, [receiver], msg.as_string())
-                email_sent = True
-                print("Error notification email sent successfully (STARTTLS)")
-        except smtplib.SMTPResponseException as e:
-            # Handle QQ mail's harmless connection close error
-            if (e.smtp_code in [250, 221] or 
-                "successful" in str(e).lower() or 
-                str(e.smtp_code) == "-1" or
-                b'\x00\x00\x00' in str(e).encode('utf-8', errors='ignore')):
-                email_sent = True
-                print("Error notification email sent successfully (STARTTLS)")
-            else:
-                last_error = e
-                print(f"STARTTLS method failed: {str(e)}")
-        except Exception as e:
-            # Special handling for QQ mail connection close error
-            if ("b'\\x00\\x00\\x00'" in str(e) or 
-                "(-1, b'\\x00\\x00\\x00')" in str(e)):
-                email_sent = True
-                print("Error notification email sent successfully (STARTTLS)")
-            else:
-                last_error = e
-                print(f"STARTTLS method failed: {str(e)}")
-            
-        # Method 2: Direct SSL if STARTTLS failed
-        if not email_sent:
-            try:
-                context = ssl.create_default_context()
-                with smtplib.SMTP_SSL(smtp_server, 465, context=context) as server:
-                    server.login(sender, password)
-                    server.sendmail(sender, [receiver], msg.as_string())
-                    email_sent = True
-                    print("Error notification email sent successfully (SSL)")
-            except smtplib.SMTPResponseException as e:
-                # Handle QQ mail's harmless connection close error
-                if (e.smtp_code in [250, 221] or 
-                    "successful" in str(e).lower() or 
-                    str(e.smtp_code) == "-1" or
-                    b'\x00\x00\x00' in str(e).encode('utf-8', errors='ignore')):
-                    email_sent = True
-                    print("Error notification email sent successfully (SSL)")
-                else:
-                    last_error = e
-                    print(f"SSL method failed: {str(e)}")
-            except Exception as e:
-                # Special handling for QQ mail connection close error
-                if ("b'\\x00\\x00\\x00'" in str(e) or 
-                    "(-1, b'\\x00\\x00\\x00')" in str(e)):
-                    email_sent = True
-                    print("Error notification email sent successfully (SSL)")
-                else:
-                    last_error = e
-                    print(f"SSL method failed: {str(e)}")
-                
-        if not email_sent and last_error:
-            print(f"Failed to send error email: {str(last_error)}")
-            
-    except Exception as e:
-        print(f"Failed to send error email: {str(e)}")
+# 每个解锁步骤等待设备就绪的最长时间（秒）
+step_timeout = config.getfloat("Timing", "step_timeout", fallback=5.0)
+# 滑动后等待密码键盘出现的最长时间（秒）；不报告密码键盘的ROM等满这段时间再输入密码
+bouncer_timeout = min(step_timeout, config.getfloat("Timing", "bouncer_timeout", fallback=2.0))
 
+# 密码输入后仍未解锁时的重试次数和间隔（[Retry:unlock]）
+unlock_retry = RetryPolicy.from_config(config, "unlock")
 
-print("start unlock")
+# 互不依赖的步骤最多同时执行的数量（每个步骤使用独立的adb连接）
+parallel_steps = config.getint("ADB", "parallel_steps", fallback=4)
 
+# 失败通知在后台线程发送，短时间内的多条错误合并为一封邮件
+notifier = Notifier(config, subject="Phone Unlock Failed", heading="Phone unlock task failed")
 
-def check_adb_device():
-    """Check if any ADB device is connected and authorized"""
-    try:
-        # Kill existing ADB server to ensure fresh start
-        subprocess.run("adb kill-server", shell=True, check=True)
-        sleep(5)
-        # Start ADB server
-        subprocess.run("adb start-server", shell=True, check=True)
-        sleep(2)
-
-        # Try to connect via IP
-        device_ip = config["ADB"]["device_ip"]
-        print(f"Trying to connect via IP: {device_ip}...")
-        connect_result = subprocess.run(
-            f"adb connect {device_ip}",
-            shell=True,
-            capture_output=True,
-            encoding='utf-8',
-            errors='ignore'
-        )
-        print(f"Connect result: {connect_result.stdout}")
-        sleep(2)
-
-        # Get device list
-        result = subprocess.run(
-            "adb devices", shell=True, capture_output=True, text=True, check=True
-        )
-
-        # Parse the output
-        lines = result.stdout.strip().split("\n")
-        if len(lines) <= 1:  # Only has the "List of devices attached" header
-            error_msg = "No ADB devices found. Please check your connection."
-            print(error_msg)
-            send_error_email(error_msg)
-            return False
 
-        # Check if any device is properly authorized
-        for line in lines[1:]:  # Skip the header line
-            if line.strip() and not line.strip().endswith("unauthorized"):
-                print("Found connected device:", line.strip())
-                return True
+def send_error_email(error_message):
+    """Queue an error notification email; it is sent in the background"""
+    notifier.notify(error_message)
 
-        error_msg = "Found device but it's not authorized. Please check your phone and accept the debugging prompt."
-        print(error_msg)
+
+def check_adb_device(connection_manager: AdbConnectionManager):
+    """Check that the configured ADB device is connected and authorized"""
+    try:
+        state = connection_manager.ensure_device()
+        if state == "device":
+            log.info(f"Found connected device: {connection_manager.device_ip}")
+            return True
+
+        if state == "unauthorized":
+            error_msg = "Found device but it's not authorized. Please check your phone and accept the debugging prompt."
+        else:
+            error_msg = "No ADB devices found. Please check your connection."
+        log.error(error_msg)
         send_error_email(error_msg)
         return False
 
-    except subprocess.CalledProcessError as e:
+    except CircuitOpenError:
+        # Already reported when the breaker opened; the caller skips the device
+        raise
+    except AdbError as e:
         error_msg = f"Error checking ADB devices: {e}"
-        print(error_msg)
+        log.error(error_msg)
         send_error_email(error_msg)
         return False
 
 
-try:
-    # First check ADB device connection
-    if not check_adb_device():
-        error_msg = "Please connect your device and try again."
-        print(error_msg)
+@traced("unlock")
+def unlock_phone(device: Optional[DeviceConfig] = None, adb: Optional[AdbClient] = None,
+                 resolution_manager: Optional[ResolutionManager] = None) -> bool:
+    """Connect, switch to the unlock resolution and unlock one device
+
+    Returns True if the device ended up unlocked (or unlock is disabled).
+    A long-running caller (daemon.py) can pass in the adb client and
+    resolution manager it keeps for the device. Overlapping runs for the
+    same device wait for each other ([Lease]).
+    """
+    device = device or default_device(config)
+    try:
+        return DeviceLease.from_config(config, device.serial, "unlock").run(
+            lambda: _unlock_phone(device, adb, resolution_manager))
+    except LeaseTimeout as e:
+        error_msg = str(e)
+        log.error(error_msg)
         send_error_email(error_msg)
-        raise Exception("ADB device not found")
-
-    # Check if unlock is required
-    require_unlock = config["ADB"].getboolean("require_unlock", True)
-    if not require_unlock:
-        print("Unlock step skipped as per configuration")
-        # 跳过后续解锁步骤
-        exit()
-
-    # Save current resolution before changing it
-    print("Saving current resolution...")
-    if not resolution_manager.save_original_resolution():
-        print("Warning: Could not save original resolution, will use configured lock resolution for restoration")
-
-    # Set resolution for unlock operation
-    print("Setting resolution for unlock operation...")
-    if not resolution_manager.set_unlock_resolution():
+        return False
+
+
+def _unlock_phone(device: DeviceConfig, adb: Optional[AdbClient],
+                  resolution_manager: Optional[ResolutionManager]) -> bool:
+    log.info(f"start unlock: {device.name} ({device.device_ip})")
+
+    # 通过TCP直接与adb server通信，所有命令都指定该设备的serial
+    adb = adb or AdbClient.from_config(config, serial=device.serial)
+    connection_manager = AdbConnectionManager.from_config(config, adb, device.device_ip, device.serial_number)
+
+    # 初始化分辨率管理器
+    resolution_manager = resolution_manager or ResolutionManager(adb=adb, device=device, config=config)
+
+    # 解锁输入通过同一个长连接shell按顺序发送
+    session = ShellSession(adb, timeout=adb.timeout + step_timeout)
+
+    # 锁屏状态检测，自动选择当前系统版本可用的最小dumpsys段（prewarm.py可提前探测并存入状态文件）
+    keyguard_probe = KeyguardProbe(adb, resolution_manager.store)
+
+    # 通过logcat事件流得知亮屏和解锁完成，无需反复执行dumpsys；不可用时退回原来的检测方式
+    watcher = DeviceEventWatcher.from_config(config, adb)
+
+    # 部分ROM的dumpsys没有锁屏标记，此时比对屏幕画面与记录的参考画面（需要numpy，[Verify]）
+    verifier = ScreenVerifier.from_config(config, adb, resolution_manager.store)
+    screen_only = verifier is not None and verifier.only
+
+    # Get unlock password from config
+    lock_password = device.lock_password
+
+    def watching() -> bool:
+        return watcher is not None and watcher.running
+
+    def wake() -> bool:
+        # keyevent 26 toggles power, so it is only sent when the screen is off
+        session.queue(f"{SCREEN_ON_CHECK} || input keyevent 26")
+        if watching():
+            session.run_batch()
+            return watcher.wait_for("screen", True, step_timeout, probe=lambda: screen_on(adb),
+                                    description="Screen on")
+        session.queue(device_wait(SCREEN_ON_CHECK, step_timeout))
+        _, screen_ready = session.run_batch()
+        if not screen_ready.ok:
+            log.warning(f"Timed out after {step_timeout:.1f}s waiting for: Screen on")
+        return screen_ready.ok
+
+    def save() -> bool:
+        # Save current resolution before changing it
+        log.info("Saving current resolution...")
+        if resolution_manager.save_original_resolution():
+            return True
+        log.warning("Could not save original resolution, will use configured lock resolution for restoration")
+        return False
+
+    def resize() -> bool:
+        # Set resolution for unlock operation
+        log.info("Setting resolution for unlock operation...")
+        if resolution_manager.set_unlock_resolution():
+            return True
         error_msg = "Failed to set unlock resolution"
-        print(error_msg)
+        log.error(error_msg)
         send_error_email(error_msg)
-        # Continue anyway, as resolution change is not critical for unlock
+        return False
 
-    sleep(2)
-    subprocess.Popen("adb shell input keyevent 26")
-    sleep(3)
-    subprocess.Popen("adb shell input swipe 400 1000 400 300")
-    sleep(3)
-    # Get unlock password from config
-    lock_password = config["ADB"]["lock_password"]
-    subprocess.Popen(f"adb shell input text {lock_password}")
-    sleep(3)
+    def display_size() -> str:
+        state = resolution_manager.get_display_state()
+        return state.size if state is not None else resolution_manager.unlock_resolution
 
-    # Check if screen is unlocked using dumpsys
-    try:
-        # Get full window state
-        window_state = subprocess.check_output(
-            "adb shell dumpsys window", shell=True
-        ).decode('utf-8', errors='ignore')
-
-        # Check multiple indicators
-        if (
-            "mDreamingLockscreen=false" in window_state
-            or "mKeyguardShowing=false" in window_state
-            or "isStatusBarKeyguard=false" in window_state
-        ):
-            print("Screen is unlocked!")
-        else:
-            error_msg = "Screen might still be locked! Trying unlock again..."
-            print(error_msg)
-            # Try unlock again
-            lock_password = config["ADB"]["lock_password"]
-            subprocess.Popen(f"adb shell input text {lock_password}")
-            sleep(3)
-
-            # Check again
-            window_state = subprocess.check_output(
-                "adb shell dumpsys window", shell=True
-            ).decode('utf-8', errors='ignore')
-            if (
-                "mDreamingLockscreen=false" in window_state
-                or "mKeyguardShowing=false" in window_state
-                or "isStatusBarKeyguard=false" in window_state
-            ):
-                print("Screen is now unlocked!")
+    def confirmed_unlocked() -> bool:
+        # dumpsys decides when it can; the screen when it cannot (or always, with [Verify] screen = only)
+        showing = None if screen_only else keyguard_probe.keyguard_showing()
+        if showing is None and verifier is not None:
+            return verifier.unlocked(display_size()) is True
+        return showing is False
+
+    def wait_unlocked() -> bool:
+        return wait_until(confirmed_unlocked, timeout=step_timeout, interval=0.2, description="Unlocked (screen)")
+
+    def enter_pin() -> bool:
+        nonlocal screen_only
+        if not screen_only and verifier is not None and verifier.references:
+            # References recorded and a dumpsys without keyguard state: the screen decides from the start
+            screen_only = keyguard_probe.keyguard_showing() is None
+        # The swipe is placed on the size the display uses now, i.e. after resize
+        swipe_command = load_gestures(config, device.name)["unlock_swipe"].command(display_size())
+        # Send swipe -> PIN -> verify as one pipelined batch; the device-side
+        # waits keep each step in order without sleeps.
+        session.queue(swipe_command)
+        session.queue(device_wait(keyguard_probe.bouncer_check(), bouncer_timeout))
+        session.queue(f"input text {lock_password}")
+        if not watching() and not screen_only:
+            session.queue(device_wait(keyguard_probe.unlocked_check(), step_timeout))
+        with span("unlock.input", serial=device.serial) as step:
+            swipe, bouncer_ready, pin, *unlocked = session.run_batch()
+            if screen_only:
+                ok = wait_unlocked()
+            elif watching():
+                # The keyguard reports itself gone; the probe only covers ROMs that don't log it
+                ok = watcher.wait_for("keyguard", False, step_timeout, probe=keyguard_probe.unlocked)
             else:
-                error_msg = "Failed to unlock screen after retry"
-                print(error_msg)
-                send_error_email(error_msg)
+                ok = unlocked[0].ok
+            step.set(ok=ok)
+        if not bouncer_ready.ok:
+            log.warning(f"Timed out after {bouncer_timeout:.1f}s waiting for: Bouncer visible")
+        return ok
+
+    # 唤醒屏幕、保存并切换分辨率、探测锁屏检测方式互不依赖，同时进行；输入密码需等它们都完成
+    runner = StepRunner(max_workers=parallel_steps, name="unlock")
+    runner.add("connect", lambda: check_adb_device(connection_manager))
+    if device.require_unlock:
+        # These only report their failures; the PIN is entered regardless
+        runner.add("watch", lambda: watcher is not None and watcher.start(), after=("connect",), critical=False)
+        runner.add("wake", wake, after=("watch",), critical=False)
+        runner.add("save", save, after=("connect",), critical=False)
+        # Continue anyway, as resolution change is not critical for unlock
+        runner.add("resize", resize, after=("save",), critical=False)
+        runner.add("probe", lambda: keyguard_probe.probe, after=("connect",), critical=False)
+        runner.add("input", enter_pin, after=("wake", "resize", "probe"))
+
+    try:
+        results = runner.run()
+        if not results["connect"].ok:
+            error_msg = "Please connect your device and try again."
+            log.error(error_msg)
+            send_error_email(error_msg)
+            raise Exception("ADB device not found")
+
+        # Check if unlock is required
+        if not device.require_unlock:
+            log.info("Unlock step skipped as per configuration")
+            # 跳过后续解锁步骤
+            return True
 
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Could not determine screen lock state: {str(e)}\nReturn code: {e.returncode}\nOutput: {e.output.decode() if e.output else 'No output'}"
-        print(error_msg)
+        unlocked_check = keyguard_probe.unlocked_check()
+
+        # Check if screen is unlocked using dumpsys
+        try:
+            if results["input"].ok or confirmed_unlocked():
+                log.info("Screen is unlocked!")
+                resolution_manager.store.record(device.serial, keyguard="unlocked")
+                return True
+
+            # Retype the PIN with growing pauses, in case the device was just slow
+            for attempt, pause in enumerate(unlock_retry.delays(), start=2):
+                log.warning(f"Screen might still be locked! Trying unlock again "
+                            f"({attempt}/{unlock_retry.attempts}) in {pause:.1f}s...")
+                time.sleep(pause)
+                session.queue(f"input text {lock_password}")
+                if not screen_only:
+                    session.queue(device_wait(unlocked_check, step_timeout))
+
+                # Check again
+                with span("unlock.retry", serial=device.serial, attempt=attempt) as step:
+                    batch = session.run_batch()
+                    retried = wait_unlocked() if screen_only else batch[-1].ok
+                    step.set(ok=retried)
+                if retried or confirmed_unlocked():
+                    log.info("Screen is now unlocked!")
+                    resolution_manager.store.record(device.serial, keyguard="unlocked")
+                    return True
+
+            error_msg = "Failed to unlock screen after retry"
+            log.error(error_msg)
+            resolution_manager.store.record(device.serial, keyguard="locked")
+            # The stored probe choice may be stale (e.g. after an OS update); detect again next time
+            keyguard_probe.forget()
+            send_error_email(error_msg)
+            return False
+
+        except AdbError as e:
+            error_msg = f"Could not determine screen lock state: {str(e)}"
+            log.error(error_msg)
+            send_error_email(error_msg)
+            return False
+
+    except CircuitOpenError as e:
+        log.info(f"Skipping {device.name}: {e}")
+        return False
+    except Exception as e:
+        error_msg = f"Error: {str(e)}"
+        log.error(error_msg)
         send_error_email(error_msg)
+        return False
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        session.close()
+
 
-except Exception as e:
-    error_msg = f"Error: {str(e)}"
-    print(error_msg)
-    send_error_email(error_msg)
+if __name__ == "__main__":
+    unlock_phone()
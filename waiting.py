@@ -0,0 +1,66 @@
+import time
+from typing import Callable, Optional
+
+from adb_client import AdbClient, AdbError
+from log_buffer import get_logger
+from tracing import span
+
+log = get_logger("wait")
+
+
+# Device-side check that exits 0 when the screen is awake. It is a shell
+# command so it can run as a host-side predicate or inside a shell batch;
+# keyguard checks live in keyguard_probe.KeyguardProbe.
+SCREEN_ON_CHECK = "dumpsys power | grep -qE 'mWakefulness=Awake|Display Power: state=ON'"
+
+
+def wait_until(predicate: Callable[[], bool], timeout: float = 5.0, interval: float = 0.05,
+               max_interval: float = 0.5, backoff: float = 1.5, description: Optional[str] = None) -> bool:
+    """Poll predicate until it returns True or timeout seconds have passed
+
+    The poll interval starts small so fast devices are not slowed down and
+    grows by backoff up to max_interval so slow ones are not hammered.
+    Device errors raised by the predicate count as "not yet".
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    polls = 0
+    with span("wait", description=description, timeout=timeout) as step:
+        while True:
+            polls += 1
+            try:
+                if predicate():
+                    step.set(ok=True, polls=polls)
+                    if description:
+                        log.info(f"{description} after {time.monotonic() - start:.2f}s")
+                    return True
+            except AdbError as e:
+                log.warning(f"Check failed, retrying: {e}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                step.set(ok=False, polls=polls)
+                if description:
+                    log.warning(f"Timed out after {timeout:.1f}s waiting for: {description}")
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * backoff, max_interval)
+
+
+def device_wait(check: str, timeout: float = 5.0, interval: float = 0.1) -> str:
+    """Build a shell loop that waits on the device until check succeeds
+
+    This is the device-side counterpart of wait_until, for use inside a
+    pipelined ShellSession batch. The loop exits 0 once check holds and 1
+    when timeout runs out.
+    """
+    tries = max(1, int(timeout / interval))
+    return (f"(i=0; while ! ({check}); do i=$((i+1)); "
+            f"if [ $i -ge {tries} ]; then exit 1; fi; sleep {interval}; done)")
+
+
+# ----------------------------------------------------------------------
+# Cheap device predicates
+# ----------------------------------------------------------------------
+def screen_on(adb: AdbClient) -> bool:
+    """Return True if the device reports it is awake"""
+    return adb.shell(SCREEN_ON_CHECK).ok